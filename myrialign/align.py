@@ -29,7 +29,14 @@
 
 import numpy, random, time, sys, os, string, select, struct, fcntl
 
-import spu, children, sequence, util
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import spu, children, sequence, util, shard, extsort, hitfile, summary
+
+class Error(Exception): pass
 
 def how_many_cpus():
     """Detects the number of effective CPUs in the system,
@@ -61,6 +68,21 @@ def is_cell():
                 return True
     return False
 
+# How many times to try a batch before giving up
+MAX_ATTEMPTS = 3
+
+# Rough Python and numpy overheads, in bytes, of holding a read or a hit
+# in memory, for --max-memory
+READ_OVERHEAD = 200
+HIT_OVERHEAD = 50
+
+# Bytes of hits held in memory for --sorted before spilling to a 
+# temporary file, if --max-memory is not given
+SORT_MEMORY = 128 << 20
+
+def read_memory(read_name, read_seq):
+    return len(read_name) + len(read_seq) + READ_OVERHEAD
+
 # TODO: Be cleverer about Cell SPU count
 CELL_PROCESSOR = is_cell()
 if CELL_PROCESSOR:
@@ -248,17 +270,42 @@ def observe(matchin,matchout, nucmatches, indel_cost):
 
 
 
+# Work done and time spent in each stage of searching, for --stats
+COUNTERS = { }
+
+def count(name, amount):
+    COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+def take_counters():
+    """ Return search and communication counters, and reset them. """
+    result = children.take_counters()
+    result.update(COUNTERS)
+    COUNTERS.clear()
+    return result
+
 def dominates(hit1, hit2):
     return hit1[2] == hit2[2] and abs(hit2[0]-hit1[0]) <= (hit2[3]-hit1[3])
 
+def scan_range(ref_length, readlen, maxerror, indel_cost, region):
+    """ Part of the reference that must be scanned to find every hit ending
+        in region (start, end), with enough context on either side that
+        Hit_eater resolves dominance as it would for the whole reference. """
+    if region is None:
+        return 0, ref_length
+    start, end = region
+    margin = readlen + maxerror//indel_cost + 2*maxerror
+    return max(0, start-margin), min(ref_length, end+maxerror)
+
 class Hit_eater:
-    def __init__(self, reference, max_error, indel_cost, callback):
+    def __init__(self, reference, max_error, indel_cost, callback, region=None):
         self.reference = reference
         self.callback = callback
 	self.max_error = max_error
         self.indel_cost = indel_cost
+        self.region = region # Only report hits ending in this range
         
         self.hits = [ ] #(0=ref_pos,1=read,2=read_name,3=n_errors)
+        self.traceback_time = 0.0
 
     def register_hit(self, *hit):
         for existing_hit in self.hits:
@@ -285,6 +332,10 @@ class Hit_eater:
                 i += 1
 
     def handle_hit(self, ref_pos, read, read_name, n_errors):
+        if self.region is not None and \
+           not self.region[0] <= ref_pos < self.region[1]:
+            return
+    
         #TODO: handle ends of the reference more nicely
     
         ref_start = ref_pos - (len(read)-1) - n_errors//self.indel_cost
@@ -296,21 +347,31 @@ class Hit_eater:
         if pad:
             ref_scrap = numpy.concatenate(([4]*pad, ref_scrap))
         
+        start = time.time()
         ali_read, ali_scrap, scrap_start, ali_errors = \
             align(read[::-1], ref_scrap[::-1], n_errors, self.indel_cost)
+        self.traceback_time += time.time() - start
         ali_read = ali_read[::-1]
         ali_scrap = ali_scrap[::-1]
         ref_start = ref_pos+1 - scrap_start
         
         assert n_errors == ali_errors, '%d (expected) != %d (got) %s vs %s' % (n_errors, ali_errors, ref_scrap, read)
     
-        self.callback('%s %d %d..%d %s %s' % (read_name, n_errors, ref_start+1, ref_pos, ali_read, ali_scrap))
+        self.callback((read_name, n_errors, ref_start, ref_pos, ali_read, ali_scrap))
+
+def format_hit(hit):
+    """ A hit from Hit_eater as a line of "myr align" output. """
+    read_name, n_errors, ref_start, ref_pos, ali_read, ali_scrap = hit
+    return '%s %d %d..%d %s %s' % (read_name, n_errors, ref_start+1, ref_pos, ali_read, ali_scrap)
 
     
 
-def search_cpu(reference, reads, read_names, maxerror, indel_cost, callback):
+def search_cpu(reference, reads, read_names, maxerror, indel_cost, callback, region=None, timed=False):
+    """ If timed is true, time spent in each stage is counted,
+        which takes several clock readings per reference base. """
     # Reads *must* all be the same length
     readlen = len(reads[0])
+    scan_start, scan_end = scan_range(len(reference), readlen, maxerror, indel_cost, region)
 
     nucmatch = numpy.transpose(
         [ sequence_nucmatch(read) for read in reads ],
@@ -323,10 +384,17 @@ def search_cpu(reference, reads, read_names, maxerror, indel_cost, callback):
     match_in = collapse(match_in)
     match_out = match_in.copy()
     
-    hit_eater = Hit_eater(reference, maxerror, indel_cost, callback)
+    hit_eater = Hit_eater(reference, maxerror, indel_cost, callback, region)
     
-    for ref_pos, nuc in enumerate(reference):
+    clock = time.time
+    observe_time = 0.0
+    extract_time = 0.0
+    eater_time = 0.0
+    for ref_pos, nuc in enumerate(reference[scan_start:scan_end]):
+        ref_pos += scan_start
+        if timed: t0 = clock()
         observe(match_in,match_out, nucmatch[nuc], indel_cost)
+        if timed: t1 = clock()
     
         hits = match_out[maxerror,readlen-1]
         if numpy.any(hits):
@@ -351,15 +419,31 @@ def search_cpu(reference, reads, read_names, maxerror, indel_cost, callback):
                         #handle_hit(reference, ref_pos, reads[read_no], read_names[read_no], n_errors, indel_cost, callback)
                         hit_eater.register_hit(ref_pos, reads[read_no], read_names[read_no], n_errors)
 
+        if timed: t2 = clock()
         match_out, match_in = match_in, match_out
         hit_eater.advance(ref_pos)
+        
+        if timed:
+            observe_time += t1-t0
+            extract_time += t2-t1
+            eater_time += clock()-t2
     
+    t0 = clock()
     hit_eater.advance(None) #Flush
+    eater_time += clock()-t0
+    
+    count('bases_scanned', scan_end-scan_start)
+    if timed:
+        count('observe_time', observe_time)
+        count('hit_extraction_time', extract_time)
+        count('hit_eater_time', eater_time - hit_eater.traceback_time)
+    count('traceback_time', hit_eater.traceback_time)
 
 
-def search_spu(reference, reads, read_names, maxerror, indel_cost, callback):
+def search_spu(reference, reads, read_names, maxerror, indel_cost, callback, region=None, timed=False):
     # Reads *must* all be the same length
     readlen = len(reads[0])
+    scan_start, scan_end = scan_range(len(reference), readlen, maxerror, indel_cost, region)
     
     nucmatch = numpy.transpose(
         [ sequence_nucmatch(read) for read in reads ],
@@ -373,11 +457,12 @@ def search_spu(reference, reads, read_names, maxerror, indel_cost, callback):
     child = children.Child(['elfspe', spu_filename])
                 
     child.write(nucmatch.tostring())
-    child.write(reference.tostring())
+    child.write(reference[scan_start:scan_end].tostring())
     child.close_stdin()
     
-    hit_eater = Hit_eater(reference, maxerror, indel_cost, callback)
+    hit_eater = Hit_eater(reference, maxerror, indel_cost, callback, region)
     
+    start = time.time()
     while True:
         children.wait([child])
         
@@ -385,10 +470,15 @@ def search_spu(reference, reads, read_names, maxerror, indel_cost, callback):
         if not hit: break
         
         hit_ref_pos, hit_read_no, hit_n_error = struct.unpack('lll', hit)
+        hit_ref_pos += scan_start
         hit_eater.register_hit(hit_ref_pos, reads[hit_read_no], read_names[hit_read_no], hit_n_error)
         hit_eater.advance(hit_ref_pos-1)
 
     hit_eater.advance(None) #flush
+    
+    count('bases_scanned', scan_end-scan_start)
+    count('spu_time', time.time() - start - hit_eater.traceback_time)
+    count('traceback_time', hit_eater.traceback_time)
 
 
 # ========================================================================
@@ -410,16 +500,39 @@ def child(argv):
             search_func = search_cpu
         
         while True:
+            start = time.time()
+            unpickle_time = children.COUNTERS['unpickle_time']
             try:
                 message, value = children.receive()
             except EOFError:
                 break
+            count('idle_time', time.time() - start - 
+                               (children.COUNTERS['unpickle_time'] - unpickle_time))
             
             if message == 'align':
-                reads, read_names, maxerror, indel_cost = value
-                search_func(reference, reads, read_names, maxerror, indel_cost, 
-                            lambda hit: children.send(('hit',hit)) )
-                children.send(('done', len(reads)))
+                reads, read_names, maxerror, indel_cost, region, sort_hits, as_text, summarize, timed = value
+                if sort_hits or summarize:
+                    hits = [ ]
+                    search_func(reference, reads, read_names, maxerror, indel_cost, 
+                                hits.append, region, timed )
+                    if summarize:
+                        children.send(('summary', summary.summarize_batch(reads, read_names, hits)))
+                    if as_text:
+                        hits = [ format_hit(hit) for hit in hits ]
+                        if sort_hits:
+                            hits.sort(key=extsort.hit_key)
+                    elif sort_hits:
+                        hits.sort(key=lambda hit: extsort.hit_key(format_hit(hit)))
+                    for hit in hits:
+                        children.send(('hit',hit))
+                elif as_text:
+                    search_func(reference, reads, read_names, maxerror, indel_cost, 
+                                lambda hit: children.send(('hit',format_hit(hit))), region, timed )
+                else:
+                    search_func(reference, reads, read_names, maxerror, indel_cost, 
+                                lambda hit: children.send(('hit',hit)), region, timed )
+                count('reads', len(reads)//2)
+                children.send(('done', take_counters()))
             elif message == 'ref':
                 reference = value
         
@@ -427,10 +540,377 @@ def child(argv):
     except KeyboardInterrupt:
         return 1
 
+class Batch:
+    """ A batch of reads of the same length, to be aligned by one child. 
+        
+        ident is (reference number, batch number), and is the same from 
+        run to run given the same input. read_numbers, if given, are the 
+        positions in the input of each forward and reverse pair of reads. """
+    
+    def __init__(self, ident, reads, read_names, read_numbers=None):
+        self.ident = ident
+        self.reads = reads
+        self.read_names = read_names
+        self.read_numbers = read_numbers
+        self.hits = [ ]
+        self.attempts = 0
+        self.start_time = None
+        
+        self.memory = sum([ read_memory(read_names[i], reads[i]) for i in xrange(len(reads)) ])
+        self.hit_memory = 0
+        self.summary = None
+
+def batch_size(length, maxerror):
+    """ Number of reads of a given length to align in one batch, 
+        counting each strand separately. """
+    if CELL_PROCESSOR:
+        #Hmmm
+        chunk = 1800000 // (length*((maxerror+1)*2+5))
+        chunk -= chunk&127
+        return max(chunk, 128)
+    else:
+        return 8192
+
+class Worker_pool:
+    """ Farm out batches to child processes. 
+    
+        A batch whose child dies is retried on a fresh child. 
+        on_done(batch) is called with each completed batch. 
+        Hits are lines of "myr align" output, or if as_text is false 
+        tuples as passed to Hit_eater's callback. If sort_hits is true, 
+        each batch's hits are sorted with extsort.hit_key. If summarize 
+        is true, each batch's summary is the result of 
+        summary.summarize_batch, computed by the child. If timed is 
+        true, children also count the time spent in each stage of 
+        search_cpu.
+        
+        Counters reported by each child are accumulated in worker_stats,
+        and the parent's own in stats. """
+
+    def __init__(self, n_processes, maxerror, indel_cost, on_done, sort_hits=False, as_text=True, 
+                 summarize=False, timed=False):
+        self.maxerror = maxerror
+        self.indel_cost = indel_cost
+        self.sort_hits = sort_hits
+        self.as_text = as_text
+        self.summarize = summarize
+        self.timed = timed
+        self.on_done = on_done
+        self.worker_stats = [ ]
+        self.stats = { 'idle_time' : 0.0 }
+        self.waiting = [ self._new_child() for i in xrange(n_processes) ]
+        self.running = { } # child -> batch
+        self.reference = None
+        self.region = None
+    
+    def _new_child(self):
+        child = children.Self_child()
+        child.number = len(self.worker_stats)
+        self.worker_stats.append({ 'batches' : 0, 'busy_time' : 0.0 })
+        return child
+    
+    def set_reference(self, reference, region=None):
+        self.finish()
+        self.reference = reference
+        self.region = region
+        for child in self.waiting:
+            child.send(('ref', reference))
+    
+    def submit(self, batch):
+        while not self.waiting:
+            self.handle_events()
+        self._start(self.waiting.pop(), batch)
+    
+    def _start(self, child, batch):
+        self.running[child] = batch
+        batch.start_time = time.time()
+        try:
+            child.send(('align', (batch.reads, batch.read_names, self.maxerror, self.indel_cost, 
+                                  self.region, self.sort_hits, self.as_text, self.summarize, 
+                                  self.timed)))
+        except children.Write_to_dead_child:
+            self._retry(child)
+    
+    def _retry(self, child):
+        batch = self.running.pop(child)
+        try:
+            child.kill()
+        except OSError: #Already dead
+            pass
+        child.close()
+        
+        batch.attempts += 1
+        if batch.attempts >= MAX_ATTEMPTS:
+            raise Error('Batch %d of reference %d failed %d times, giving up' % 
+                        (batch.ident[1], batch.ident[0], batch.attempts))
+        util.show_message('Child process died, retrying batch %d of reference %d' % 
+                          (batch.ident[1], batch.ident[0]))
+        
+        batch.hits = [ ]
+        batch.hit_memory = 0
+        batch.summary = None
+        child = self._new_child()
+        child.send(('ref', self.reference))
+        self._start(child, batch)
+    
+    def handle_events(self):
+        start = time.time()
+        ready = children.wait(self.running.keys())
+        self.stats['idle_time'] += time.time() - start
+        
+        for child in ready:
+            if child.write_error is not None:
+                self._retry(child)
+                continue
+            
+            try:
+                message, value = child.receive()
+            except EOFError:
+                self._retry(child)
+                continue
+            
+            if message == 'done':
+                batch = self.running.pop(child)
+                self.waiting.append(child)
+                
+                stats = self.worker_stats[child.number]
+                stats['batches'] += 1
+                stats['busy_time'] += time.time() - batch.start_time
+                for key in value:
+                    stats[key] = stats.get(key, 0) + value[key]
+                
+                self.on_done(batch)
+            elif message == 'summary':
+                self.running[child].summary = value
+            else:
+                batch = self.running[child]
+                batch.hits.append(value)
+                if self.as_text:
+                    batch.hit_memory += len(value) + HIT_OVERHEAD
+                else:
+                    batch.hit_memory += 2*len(value[4]) + HIT_OVERHEAD
+    
+    def memory(self):
+        """ Estimated bytes held by running batches, their hits, 
+            and data not yet written to children. """
+        total = children.pending_bytes()
+        for batch in self.running.values():
+            total += batch.memory + batch.hit_memory
+        return total
+    
+    def finish(self):
+        """ Wait for all running batches to complete. """
+        while self.running:
+            self.handle_events()
+    
+    def close(self):
+        self.finish()
+        for child in self.waiting:
+            child.close()
+
+
+class Hit:
+    """ A hit found by align_reads. Members:
+    
+        name
+        forward
+        n_errors
+        start
+        end (start and end as in "myr align" output, 
+             parsed by output.parse_myrialign_line)
+        read_ali
+        ref_ali """
+    
+    def __init__(self, name, forward, n_errors, start, end, read_ali, ref_ali):
+        self.name = name
+        self.forward = forward
+        self.n_errors = n_errors
+        self.start = start
+        self.end = end
+        self.read_ali = read_ali
+        self.ref_ali = ref_ali
+
+def align_reads(reference, reads, maxerror, indel_cost, n_processes=None):
+    """ Align reads, (name, sequence) pairs, to a reference sequence, 
+        using a pool of child processes (PROCESSES of them by default). 
+        
+        Yields a Hit for each hit, as batches are completed. Unlike
+        "myr align", hits are never formatted as text. """
+    if n_processes is None:
+        n_processes = PROCESSES
+    
+    names = [ ]
+    done = [ ]
+    pool = Worker_pool(n_processes, maxerror, indel_cost, done.append, as_text=False)
+    try:
+        pool.set_reference(reference)
+        
+        # Each read is aligned in both directions, read names given 
+        # to the children are 2*(index into names) + (1 if reverse)
+        buckets = { } # length -> ( [ read_name ], [ seq ] )
+        batch_no = [0]
+        def submit(length):
+            read_names, seqs = buckets.pop(length)
+            pool.submit(Batch((0, batch_no[0]), seqs, read_names))
+            batch_no[0] += 1
+        
+        def completed():
+            while done:
+                batch = done.pop(0)
+                for read_name, n_errors, start, end, read_ali, ref_ali in batch.hits:
+                    read_name = int(read_name)
+                    yield Hit(names[read_name//2], not read_name&1, n_errors, 
+                              start, end, read_ali, ref_ali)
+        
+        for name, seq in reads:
+            length = len(seq)
+            if length not in buckets:
+                buckets[length] = ( [], [] )
+            buckets[length][0].extend([ '%d' % (2*len(names)), '%d' % (2*len(names)+1) ])
+            buckets[length][1].extend([ seq, sequence.reverse_complement(seq) ])
+            names.append(name)
+            
+            if len(buckets[length][0]) >= batch_size(length, maxerror):
+                submit(length)
+                for hit in completed():
+                    yield hit
+        
+        for length in sorted(buckets):
+            submit(length)
+        pool.finish()
+        for hit in completed():
+            yield hit
+    finally:
+        pool.close()
+
+
+class Journal:
+    """ Record of which parts of the output are complete, 
+        so that an interrupted run can be resumed. 
+        
+        Each line is a kind of unit, its identity, and the 
+        output file offset once it was written. """
+
+    def __init__(self, filename, identity, append):
+        if append:
+            self.file = open(filename, 'ab')
+        else:
+            self.file = open(filename, 'wb')
+            print >> self.file, 'args', ' '.join(identity)
+            self.file.flush()
+    
+    def record(self, kind, ident, offset):
+        print >> self.file, kind, ' '.join([ str(item) for item in ident ]), offset
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+def read_journal(filename, identity):
+    """ Returns { (kind,)+ident : offset } of completed units, 
+        and the offset in the output file up to which they are complete. """
+    if not os.path.exists(filename):
+        raise Error('No journal %s to resume from' % filename)
+
+    lines = open(filename, 'rb').readlines()
+    if not lines or lines[0].rstrip('\n') != 'args ' + ' '.join(identity):
+        raise Error('Can not resume, %s was written by a run with different arguments' % filename)
+
+    completed = { }
+    offset = 0
+    good_size = len(lines[0])
+    for line in lines[1:]:
+        if not line.endswith('\n'): break #Journal truncated
+        parts = line.split()
+        offset = int(parts[-1])
+        completed[ (parts[0],) + tuple([ int(item) for item in parts[1:-1] ]) ] = offset
+        good_size += len(line)
+    
+    # Lose any partly written line
+    f = open(filename, 'r+b')
+    f.truncate(good_size)
+    f.close()
+    
+    return completed, offset
+
+
+def parse_megabytes(text):
+    result = int(float(text) * (1<<20))
+    if result <= 0:
+        raise ValueError('Memory budget must be positive')
+    return result
+
+def timed(iterator, stats, key='parse_time'):
+    """ Pass through the items of an iterator, 
+        adding time taken to produce them to stats[key]. """
+    iterator = iter(iterator)
+    while True:
+        start = time.time()
+        try:
+            item = iterator.next()
+        finally:
+            stats[key] += time.time() - start
+        yield item
+
+def write_stats(filename, worker_stats, parent_stats, wall_time):
+    """ Write a JSON report of per-worker and aggregate counters. """
+    workers = [ ]
+    aggregate = { }
+    for number, stats in enumerate(worker_stats):
+        item = stats.copy()
+        item['worker'] = number
+        if item['busy_time']:
+            item['reads_per_second'] = item.get('reads',0) / item['busy_time']
+        workers.append(item)
+        
+        for key in stats:
+            aggregate[key] = aggregate.get(key,0) + stats[key]
+    
+    aggregate['workers'] = len(worker_stats)
+    if wall_time:
+        aggregate['reads_per_second'] = aggregate.get('reads',0) / wall_time
+    
+    parent = children.COUNTERS.copy()
+    parent.update(parent_stats)
+    
+    report = {
+        'wall_time' : wall_time,
+        'processes' : PROCESSES,
+        'cell_processor' : CELL_PROCESSOR,
+        'parent' : parent,
+        'workers' : workers,
+        'aggregate' : aggregate,
+    }
+    
+    f = open(filename, 'wb')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.write('\n')
+    f.close()
+
+class Options:
+    """ Options given to "myr align". """
+
 def main(argv):
-    if len(argv) < 4:
+    options = Options()
+    try:
+        options.output_filename, argv = util.get_option_value(argv, '-o', str, None)
+        options.max_memory, argv = util.get_option_value(argv, '--max-memory', parse_megabytes, None)
+        options.stats_filename, argv = util.get_option_value(argv, '--stats', str, None)
+        options.sorted, argv = util.get_option(argv, '--sorted')
+        options.resume, argv = util.get_option(argv, '--resume')
+        if options.resume and options.output_filename is None:
+            raise util.Bad_option('--resume requires -o')
+        options.shard, argv = util.get_option_value(argv, '--shard', shard.parse_shard, None)
+        options.shard_by, argv = util.get_option_value(argv, '--shard-by', shard.parse_shard_by, 'reads')
+        options.summary_filename, argv = util.get_option_value(argv, '--summary', str, None)
+        options.coverage_filename, argv = util.get_option_value(argv, '--coverage', str, None)
+        if options.resume and (options.summary_filename is not None or options.coverage_filename is not None):
+            raise util.Bad_option('--summary and --coverage can not be used with --resume')
+        if len(argv) < 4:
+            raise util.Bad_option('Expected max error, indel cost, a reference and at least one read file')
+    except util.Bad_option, error:
         print >> sys.stderr, ''
-        print >> sys.stderr, 'myr align <max error> <indel cost> <reference.fna> <reads.fna> [<reads.fna>...]'
+        print >> sys.stderr, 'myr align [options] <max error> <indel cost> <reference.fna> <reads.fna> [<reads.fna>...]'
         print >> sys.stderr, ''
         print >> sys.stderr, 'Align short reads to a reference genome.'
         print >> sys.stderr, ''
@@ -445,6 +925,32 @@ def main(argv):
         print >> sys.stderr, ''
         print >> sys.stderr, '    myr align 6 2 reference.fna reads.fna'
         print >> sys.stderr, ''
+        print >> sys.stderr, 'Options:'
+        print >> sys.stderr, ''
+        print >> sys.stderr, '    -o file           - Write output to a file rather than standard output.'
+        print >> sys.stderr, '                        If the name ends in .gz, it is gzip compressed'
+        print >> sys.stderr, '    --resume          - Continue an interrupted run, skipping work already'
+        print >> sys.stderr, '                        written to the -o file'
+        print >> sys.stderr, '    --max-memory n    - Try to keep reads and hits held in memory below'
+        print >> sys.stderr, '                        n megabytes'
+        print >> sys.stderr, '    --stats file      - Write performance counters to a file, in JSON format'
+        print >> sys.stderr, '    --sorted          - Sort hits within each reference by position. Hits'
+        print >> sys.stderr, '                        beyond the memory budget are spilled to temporary'
+        print >> sys.stderr, '                        files (in $TMPDIR)'
+        print >> sys.stderr, '    --shard i/N       - Only do shard i of N (counting from 0), for splitting'
+        print >> sys.stderr, '                        a run over several machines. Combine the outputs'
+        print >> sys.stderr, '                        with "myr merge".'
+        print >> sys.stderr, '    --shard-by xx     - Divide work between shards by "reads" (default)'
+        print >> sys.stderr, '                        or by "reference" segments'
+        print >> sys.stderr, '    --summary file    - Write an error profile and hit counts, as from'
+        print >> sys.stderr, '                        "myr assess", of the reads aligned. The best hits'
+        print >> sys.stderr, '                        of each read with hits are held in memory until'
+        print >> sys.stderr, '                        all references are done'
+        print >> sys.stderr, '    --coverage file   - Write coverage of each reference in bedGraph format,'
+        print >> sys.stderr, '                        a hit counting 1/n if its read has n hits to'
+        print >> sys.stderr, '                        that reference'
+        print >> sys.stderr, ''
+        print >> sys.stderr, error[0]
         return 1
 
     if CELL_PROCESSOR:
@@ -454,51 +960,143 @@ def main(argv):
     
     print >> sys.stderr, 'Using', PROCESSES, 'processes'
     
+    try:
+        return run(argv, options)
+    except Error, error:
+        print >> sys.stderr, error[0]
+        return 1
+
+def run(argv, options):
+    # What must be the same for a run to be resumed
+    identity = argv[:]
+    if options.shard is not None:
+        identity.extend(['--shard', '%d/%d' % options.shard, '--shard-by', options.shard_by])
+    if options.sorted:
+        identity.append('--sorted')
+    if options.max_memory is not None:
+        # The budget decides when buckets are flushed early,
+        # and so the batch numbers
+        identity.extend(['--max-memory', str(options.max_memory)])
+
     maxerror = int(argv[0])
     assert maxerror >= 0
     indel_cost = int(argv[1])
     assert indel_cost >= 1
     
-    waiting = [ children.Self_child() for i in xrange(PROCESSES) ]
-    running = [ ]
+    if options.output_filename is None:
+        out = hitfile.Writer(sys.stdout)
+        journal = None
+        completed = { }
+    else:
+        journal_filename = options.output_filename + '.journal'
+        if options.resume:
+            completed, offset = read_journal(journal_filename, identity)
+            f = open(options.output_filename, 'r+b')
+            f.truncate(offset)
+            f.seek(offset)
+            util.show_message('Resuming, %d batches already done' % len(completed))
+        else:
+            completed = { }
+            f = open(options.output_filename, 'wb')
+        out = hitfile.Writer(f, hitfile.is_compressed_name(options.output_filename))
+        journal = Journal(journal_filename, identity, options.resume)
+    
+    def commit(kind, *ident):
+        """ Note that output up to this point need not be redone """
+        if journal is not None:
+            out.mark(lambda offset: journal.record(kind, ident, offset))
     
     t1 = time.time()
     total_alignments = [0]
+    parent_stats = { 'parse_time' : 0.0, 'write_time' : 0.0 }
     
-    def handle_events():
-        for child in children.wait(running):
-            message, value = child.receive()
-            if message == 'done':
-                running.remove(child)
-                waiting.append(child)
-                
-                dt = time.time() - t1
-                total_alignments[0] += value//2 # Forwards + backwards == 1 alignment
-                util.show_status('%d alignments in %.2f seconds, %.4f per alignment' % (total_alignments[0], dt, dt/total_alignments[0]))
-            else:
-                print value
+    if options.sorted:
+        if options.max_memory is not None:
+            sort_memory = options.max_memory // 4
+        else:
+            sort_memory = SORT_MEMORY
+        sorter = extsort.Sorter(extsort.hit_key, sort_memory)
+        parent_stats['sort_time'] = 0.0
+    else:
+        sorter = None
     
-    print '#Max errors:', maxerror
-    print '#Indel cost:', indel_cost
+    summarize = options.summary_filename is not None or options.coverage_filename is not None
+    if summarize:
+        read_hits = summary.Read_hits()
+        parent_stats['summary_time'] = 0.0
+    if options.coverage_filename is not None:
+        import output
+        coverage_file = open(options.coverage_filename, 'wb')
+        print >> coverage_file, 'track type=bedGraph name="coverage"'
     
-    for ref_name, ref_seq in sequence.sequence_file_iterator(argv[2]):
-        print '#Reference:', ref_name
+    def on_done(batch):
+        start = time.time()
+        if summarize:
+            length = len(batch.reads[0])
+            for i, best in batch.summary[0]:
+                read_hits.add(batch.read_numbers[i], length, best)
+            if coverage is not None:
+                coverage.add(batch.summary[1])
+            parent_stats['summary_time'] += time.time() - start
+            start = time.time()
+        
+        if sorter is not None:
+            # Committed once the whole reference is written
+            sorter.add(batch.hits, batch.hit_memory)
+            parent_stats['sort_time'] += time.time() - start
+        else:
+            for hit in batch.hits:
+                out.write(hit + '\n')
+            commit('batch', *batch.ident)
+            parent_stats['write_time'] += time.time() - start
         
-        for child in waiting:
-            child.send(('ref', ref_seq))
+        dt = time.time() - t1
+        total_alignments[0] += len(batch.reads)//2 # Forwards + backwards == 1 alignment
+        util.show_status('%d alignments in %.2f seconds, %.4f per alignment' % (total_alignments[0], dt, dt/total_alignments[0]))
+    
+    pool = Worker_pool(PROCESSES, maxerror, indel_cost, on_done, options.sorted, summarize=summarize,
+                       timed=options.stats_filename is not None)
+    
+    if ('header',) not in completed:
+        print >> out, '#Max errors:', maxerror
+        print >> out, '#Indel cost:', indel_cost
+        if options.shard is not None:
+            print >> out, '#Shard: %d/%d %s' % (options.shard[0], options.shard[1], options.shard_by)
+        if options.sorted:
+            print >> out, '#Sorted: start'
+        commit('header')
+    
+    for ref_no, (ref_name, ref_seq) in enumerate(timed(sequence.sequence_file_iterator(argv[2]), parent_stats)):
+        if options.shard is not None and options.shard_by == 'reference':
+            region = shard.segment(len(ref_seq), options.shard)
+        else:
+            region = None
+        
+        if ('reference', ref_no) not in completed:
+            print >> out, '#Reference:', ref_name
+            if region is not None:
+                print >> out, '#Segment: %d..%d' % (region[0]+1, region[1])
+            commit('reference', ref_no)
+        
+        if region is not None and region[0] == region[1]:
+            continue
+        
+        if ('hits', ref_no) in completed:
+            continue
+        
+        pool.set_reference(ref_seq, region)
+        if options.coverage_filename is not None:
+            coverage = summary.Coverage(len(ref_seq))
+        else:
+            coverage = None
         
         # Collect reads of the same length,
         # and do them in batches
-        buckets = { } # length -> [ [name], [seq] ]
+        buckets = { } # length -> [ [name], [seq], [read number] ]
+        bucket_memory = { } # length -> estimated bytes
+        batch_no = [0]
         def do_bucket(length, only_if_full):
-            if CELL_PROCESSOR:
-                #Hmmm
-                chunk = 1800000 // (length*((maxerror+1)*2+5))
-                chunk -= chunk&127
-                chunk = max(chunk, 128)
-            else:
-                chunk = 8192
-            
+            chunk = batch_size(length, maxerror)
             if only_if_full and len(buckets[length][0]) < chunk:
                 return
             
@@ -506,41 +1104,103 @@ def main(argv):
             del buckets[length][0][:chunk]
             read_seqs = buckets[length][1][:chunk]
             del buckets[length][1][:chunk]
+            read_numbers = buckets[length][2][:chunk//2]
+            del buckets[length][2][:chunk//2]
             
             if not buckets[length][0]:
                 del buckets[length]
-        
-            while not waiting: 
-                handle_events()
+                del bucket_memory[length]
+            else:
+                bucket_memory[length] -= sum([ read_memory(read_names[i], read_seqs[i]) 
+                                               for i in xrange(len(read_seqs)) ])
+            
+            ident = (ref_no, batch_no[0])
+            batch_no[0] += 1
+            if ('batch',)+ident in completed:
+                return
         
             #print >> sys.stderr, 'Starting batch alignment of', len(read_seqs), '%d-mers'%length
+            
+            pool.submit(Batch(ident, read_seqs, read_names, read_numbers))
         
-            child = waiting.pop()
-            child.send(('align', (read_seqs, read_names, maxerror, indel_cost)))
-            running.append(child)
+        n_reads = 0
+        max_length = 0
+        for nth, (read_name, read_seq) in enumerate(timed(sequence.sequence_files_iterator(argv[3:]), parent_stats)):
+            if options.shard is not None and options.shard_by == 'reads' and nth % options.shard[1] != options.shard[0]:
+                continue
         
-        for read_name, read_seq in sequence.sequence_files_iterator(argv[3:]):
             length = len(read_seq)
+            n_reads += 1
+            max_length = max(max_length, length)
             if length not in buckets:
-                buckets[length] = ( [], [] )
+                buckets[length] = ( [], [], [] )
+                bucket_memory[length] = 0
             buckets[length][0].append(read_name + ' fwd')
             buckets[length][1].append(read_seq)
             buckets[length][0].append(read_name + ' rev')
             buckets[length][1].append(sequence.reverse_complement(read_seq))
+            buckets[length][2].append(nth)
+            bucket_memory[length] += 2 * read_memory(read_name + ' fwd', read_seq)
             
             do_bucket(length, True)
+            
+            if options.max_memory is not None:
+                # Flush the largest bucket early if buckets are taking more 
+                # than their share. This only depends on the input, so 
+                # batches stay the same from run to run.
+                while bucket_memory and sum(bucket_memory.values()) > options.max_memory//2:
+                    largest = max([ (bucket_memory[item], item) for item in bucket_memory ])[1]
+                    do_bucket(largest, False)
+                
+                # Stop parsing until work in progress is below budget
+                while pool.running and \
+                      sum(bucket_memory.values()) + pool.memory() > options.max_memory:
+                    pool.handle_events()
         
         while buckets:
-            for length in list(buckets):
+            for length in sorted(buckets):
                 do_bucket(length, False)
         
-        while running: 
-            handle_events()
+        pool.finish()
+        
+        if summarize:
+            # The same for every reference
+            read_hits.n_reads = n_reads
+            read_hits.read_length = max_length
+        
+        if sorter is not None:
+            start = time.time()
+            for hit in sorter.sorted():
+                out.write(hit + '\n')
+            commit('hits', ref_no)
+            parent_stats['write_time'] += time.time() - start
+        
+        if coverage is not None:
+            start = time.time()
+            output.write_bedgraph_values(coverage_file, coverage.depths(), ref_name)
+            parent_stats['summary_time'] += time.time() - start
     
-    for child in waiting:
-        child.close()
+    pool.close()
+    
+    if options.coverage_filename is not None:
+        coverage_file.close()
+    if options.summary_filename is not None:
+        f = open(options.summary_filename, 'wb')
+        read_hits.summary(maxerror).write_report(f, 'Aligned')
+        f.close()
+    
+    if journal is not None:
+        out.close()
+        journal.close()
+    else:
+        out.flush()
+    
+    if options.stats_filename is not None:
+        parent_stats.update(pool.stats)
+        if sorter is not None:
+            parent_stats['sort_spills'] = sorter.n_spills
+        write_stats(options.stats_filename, pool.worker_stats, parent_stats, time.time()-t1)
 
     util.show_status('')
     
     return 0
-
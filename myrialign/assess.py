@@ -1,22 +1,43 @@
 
-import random, os, sys
+import random, os, sys, numpy, cPickle
 
-import cache, sequence, align
+import cache, sequence, align, summary
+
+READ_INDEX_VERSION = 1
+
+def read_file_index(filename):
+    """ Byte offsets of the records in a read file, 
+        from sequence.record_offsets, cached. """
+    filesig = cache.file_signature(filename)
+    
+    def callback(working_dir):
+        print >> sys.stderr, 'Indexing', filesig[0]
+        numpy.save(os.path.join(working_dir, 'offsets.npy'), sequence.record_offsets(filesig[0]))
+    
+    directory = cache.get(('assess','read_file_index',READ_INDEX_VERSION,filesig), callback)
+    return numpy.load(os.path.join(directory, 'offsets.npy'))
 
 def sample(read_files, n_samples):
     read_filesigs = [ cache.file_signature(filename) for filename in read_files ]
     read_files = [ item[0] for item in read_filesigs ]
 
     def callback(working_dir):    
+        indexes = [ read_file_index(filename) for filename in read_files ]
+        
         print >> sys.stderr, 'Sampling'    
-	samples = [ ]
-	n = 0
-	for item in sequence.sequence_files_iterator(read_files):
-            n += 1
-            if len(samples) < n_samples:
-		samples.append(item)
-	    elif random.random()*n_samples < n:
-		samples[random.randrange(n_samples)] = item
+        total = sum([ len(index) for index in indexes ])
+        chosen = numpy.array(random.sample(xrange(total), min(n_samples, total)), 'int64')
+        chosen.sort()
+        
+        samples = [ ]
+        first = 0
+        for filename, index in zip(read_files, indexes):
+            f = open(filename, 'rb')
+            ends = numpy.concatenate((index[1:], [ os.path.getsize(filename) ]))
+            for i in chosen[(chosen >= first) & (chosen < first+len(index))] - first:
+                f.seek(index[i])
+                samples.append(sequence.parse_record(f.read(ends[i]-index[i])))
+            first += len(index)
 
 	outfile = open(os.path.join(working_dir,'sample.fna'),'wb')
 	for item in samples:
@@ -26,27 +47,29 @@ def sample(read_files, n_samples):
     result_dir = cache.get(('assess','sample',n_samples,read_filesigs), callback)
     return os.path.join(result_dir, 'sample.fna')
 
-def invoke_align(reference_filename, read_filename, max_errors):
+ALIGN_SAMPLE_VERSION = 1
+
+def align_sample(reference_filename, read_filename, max_errors):
+    """ Hits of the reads in a file to a reference, cached, as a list of
+        (name, n_errors, forward, read_ali, ref_ali). """
     reference_filesig = cache.file_signature(reference_filename)
     reference_filename = reference_filesig[0]
     read_filesig = cache.file_signature(read_filename)
     read_filename = read_filesig[0]
 
     def callback(working_dir):
-	print >> sys.stderr, 'Aligning'
-	#Hmm
-	old_stdout = sys.stdout
-	sys.stdout = open(os.path.join(working_dir,'hits.myr'), 'wb')
-
-	try:
-	    assert align.main([str(max_errors),'1',reference_filename,read_filename]) == 0
-	finally:
-	    sys.stdout.close()
-	    sys.stdout = old_stdout
-
-    return os.path.join(
-        cache.get(('assess','invoke_align1',reference_filesig,read_filesig,max_errors),callback), 
-        'hits.myr')
+        print >> sys.stderr, 'Aligning'
+        hits = [ ]
+        for ref_name, ref_seq in sequence.sequence_file_iterator(reference_filename):
+            for hit in align.align_reads(ref_seq, sequence.sequence_file_iterator(read_filename), max_errors, 1):
+                hits.append((hit.name, hit.n_errors, hit.forward, hit.read_ali, hit.ref_ali))
+        
+        f = open(os.path.join(working_dir,'hits.pickle'), 'wb')
+        cPickle.dump(hits, f, 2)
+        f.close()
+
+    directory = cache.get(('assess','align_sample',ALIGN_SAMPLE_VERSION,reference_filesig,read_filesig,max_errors),callback)
+    return cPickle.load(open(os.path.join(directory,'hits.pickle'), 'rb'))
 
 def main(argv):
     if len(argv) < 2:
@@ -60,64 +83,18 @@ def main(argv):
     
     sample_file = sample(argv[3:], sample_size)    
 
-    hit_file = invoke_align(argv[2], sample_file, max_errors)
+    sample_hits = align_sample(argv[2], sample_file, max_errors)
 
     hits = { }
     seqs = { }
-    max_length = 0
     for item in sequence.sequence_file_iterator(sample_file):
         seqs[item[0]] = item[1]
         hits[item[0]] = [ ]
-	max_length = max(len(item[1]),max_length)
-
-    for line in open(hit_file, 'rb'):
-        line = line.strip()
-	if line.startswith('#'): continue
 
-	name, direction, n_errors, span, read_ali, ref_ali = line.rstrip().split()
-        hits[name].append((int(n_errors), direction=='fwd', read_ali, ref_ali))
+    for name, n_errors, forward, read_ali, ref_ali in sample_hits:
+        hits[name].append((n_errors, forward, read_ali, ref_ali))
     
-    n_ambiguous = 0
-    n_unhit = 0
-    error_count = [ 0 ] * (max_errors+1)
-    error_pos_count = [ 0 ] * max_length
-    indel_pos_count = [ 0 ] * max_length
+    result = summary.Summary(max_errors)
     for name in hits:
-        hits[name].sort()
-        if not hits[name]:
-	    n_unhit += 1
-	    continue
-	
-	if len(hits[name]) > 1 and \
-	   hits[name][0][0]+2 > hits[name][1][0]:
-	    n_ambiguous += 1
-	    continue
-
-	error_count[hits[name][0][0]] += 1
-
-	forward, read_ali, ref_ali = hits[name][0][1:]
-	if not forward:
-	    read_ali = read_ali[::-1]
-	    ref_ali = ref_ali[::-1]
-	    # Don't worry about complementing...
-	read_pos = 0
-	for i in xrange(len(read_ali)):
-	    if read_ali[i] == '-' or ref_ali[i] == '-':
-		indel_pos_count[read_pos] += 1
-	    elif read_ali[i] != ref_ali[i]:
-		error_pos_count[read_pos] += 1
-
-	    if read_ali[i] != '-':
-		read_pos += 1
-
-    print 'Error profile'
-    for i in xrange(max_length):
-        print 'pos=%5d snps=%5d indels=%5d' % (i+1,error_pos_count[i],indel_pos_count[i])
-    print
-    
-    print 'Sampled', len(hits), 'reads'
-    print n_ambiguous, 'had no clear best hit'
-    print n_unhit, 'hit nothing'
-    for i in xrange(max_errors+1 -2):
-        print '%3d errors: %d' % (i,error_count[i])
-
+        result.add_read(len(seqs[name]), hits[name])
+    result.write_report(sys.stdout)
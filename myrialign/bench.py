@@ -0,0 +1,293 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Time the alignment engines on simulated data, so that throughput
+    can be compared between versions.
+
+"""
+
+import sys, time, platform, sets
+import numpy
+from numpy import random
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import align, shred, util, output, sequence
+
+def random_reference(size, repeat_fraction=0.0, repeat_length=300):
+    """ A random sequence, with about repeat_fraction of it made of
+        copies of other parts of itself. """
+    seq = random.randint(4, size=size).astype('uint8')
+
+    repeat_length = min(repeat_length, size//2)
+    if repeat_length > 0:
+        for i in xrange(int(size * repeat_fraction) // repeat_length):
+            source = random.randint(size-repeat_length+1)
+            dest = random.randint(size-repeat_length+1)
+            seq[dest:dest+repeat_length] = seq[source:source+repeat_length]
+
+    return seq
+
+def engines():
+    result = [ ('cpu', align.search_cpu) ]
+    if align.CELL_PROCESSOR:
+        result.append(('spu', align.search_spu))
+    return result
+
+def time_engine(search_func, reference, reads, read_names, maxerror, indel_cost, batch_size, repeats):
+    """ Best time of several runs of search_func over all reads,
+        and the number of hits found. As for align.Batch, reads come 
+        in pairs, each read then its reverse complement. """
+    best = None
+    for i in xrange(repeats):
+        hits = [ ]
+        start = time.time()
+        for j in xrange(0, len(reads), batch_size):
+            search_func(reference, reads[j:j+batch_size], read_names[j:j+batch_size],
+                        maxerror, indel_cost, hits.append)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(hits)
+
+class Old_union:
+    """ output.Union as it was before dense ids, for comparison. """
+
+    def __init__(self):
+        self.parent = { }
+    
+    def create(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+    
+    def root(self, item):
+        if self.parent[item] == item:
+            return item
+        self.parent[item] = self.root(self.parent[item])
+        return self.parent[item]
+        
+    def merge_if_created(self, a,b):
+        if a in self.parent and b in self.parent:
+            self.parent[self.root(a)] = self.root(b)
+    
+    def sets(self):
+        results = { }
+        for item in self.parent:
+            root = self.root(item)
+            if root not in results:
+                results[root] = sets.Set()
+            results[root].add(item)
+        return list(results.values())
+
+class Old_manymany:
+    """ output.Manymany as it was before dense ids, for comparison. """
+
+    def __init__(self):
+        self.forward = { }
+        self.back = { }
+    
+    def create(self, item):
+        if item not in self.forward: 
+            self.forward[item] = sets.Set()
+        if item not in self.back:
+            self.back[item] = sets.Set()
+    
+    def link(self, a, b):
+        self.forward[a].add(b)
+        self.back[b].add(a)
+        
+    def unlink(self, a, b):
+        self.forward[a].remove(b)
+        self.back[b].remove(a)
+
+def time_graph(union_class, manymany_class, locations, repeats):
+    """ Best times to build a union_class and a manymany_class over
+        locations, much as the browser does when laying out a view, 
+        and the number of sets found. """
+    n_items = len(locations)
+    union_best = None
+    manymany_best = None
+    for i in xrange(repeats):
+        start = time.time()
+        union = union_class()
+        for location in locations:
+            union.create(location)
+        for j in xrange(n_items-1):
+            if j % 100 != 99:
+                union.merge_if_created(locations[j], locations[j+1])
+        n_sets = len(union.sets())
+        elapsed = time.time() - start
+        if union_best is None or elapsed < union_best:
+            union_best = elapsed
+        
+        start = time.time()
+        manymany = manymany_class()
+        for location in locations:
+            manymany.create(location)
+        for j in xrange(n_items-1):
+            manymany.link(locations[j], locations[j+1])
+            manymany.link(locations[j], locations[(j*7919) % n_items])
+        for j in xrange(0, n_items-1, 2):
+            manymany.unlink(locations[j], locations[j+1])
+        elapsed = time.time() - start
+        if manymany_best is None or elapsed < manymany_best:
+            manymany_best = elapsed
+    
+    return union_best, manymany_best, n_sets
+
+def time_graph_structures(n_items, repeats):
+    """ Best times for output.Union and output.Manymany over n_items 
+        locations, and for the classes they replaced. """
+    locations = list(output.make_locations(0, True, numpy.arange(n_items)))
+    union_seconds, manymany_seconds, n_sets = time_graph(
+        output.Union, output.Manymany, locations, repeats)
+    old_union_seconds, old_manymany_seconds, old_n_sets = time_graph(
+        Old_union, Old_manymany, locations, repeats)
+    assert n_sets == old_n_sets
+    
+    return {
+        'items' : n_items,
+        'sets' : n_sets,
+        'union_seconds' : union_seconds,
+        'manymany_seconds' : manymany_seconds,
+        'old_union_seconds' : old_union_seconds,
+        'old_manymany_seconds' : old_manymany_seconds,
+    }
+
+def parse_list(conversion_function):
+    return lambda text: [ conversion_function(item) for item in text.split(',') ]
+
+def main(argv):
+    try:
+        size, argv = util.get_option_value(argv, '--size', int, 10000)
+        n_reads, argv = util.get_option_value(argv, '--reads', int, 1024)
+        error_rate, argv = util.get_option_value(argv, '--error-rate', float, 0.015)
+        repeat_fraction, argv = util.get_option_value(argv, '--repeats', float, 0.1)
+        maxerrors, argv = util.get_option_value(argv, '--maxerror', parse_list(int), [2,4])
+        indel_costs, argv = util.get_option_value(argv, '--indel-cost', parse_list(int), [1,2])
+        read_lengths, argv = util.get_option_value(argv, '--read-length', parse_list(int), [33])
+        batch_sizes, argv = util.get_option_value(argv, '--batch-size', parse_list(int), [1024])
+        repeats, argv = util.get_option_value(argv, '--repeat', int, 1)
+        seed, argv = util.get_option_value(argv, '--seed', int, 1)
+        graph_size, argv = util.get_option_value(argv, '--graph-size', int, 100000)
+        output_filename, argv = util.get_option_value(argv, '-o', str, None)
+        if argv:
+            raise util.Bad_option('Unexpected arguments: ' + ' '.join(argv))
+    except util.Bad_option, error:
+        print >> sys.stderr, ''
+        print >> sys.stderr, 'myr bench [options]'
+        print >> sys.stderr, ''
+        print >> sys.stderr, 'Time the alignment engines on simulated reads, over a grid of'
+        print >> sys.stderr, 'parameters. Results are written in JSON format.'
+        print >> sys.stderr, ''
+        print >> sys.stderr, 'Options (lists are comma separated):'
+        print >> sys.stderr, ''
+        print >> sys.stderr, '    --size n          - Reference size, default 10000'
+        print >> sys.stderr, '    --reads n         - Number of reads, default 1024'
+        print >> sys.stderr, '    --error-rate x    - Mean substitution rate of reads, default 0.015'
+        print >> sys.stderr, '    --repeats x       - Fraction of reference that is repeated, default 0.1'
+        print >> sys.stderr, '    --maxerror list    - default 2,4'
+        print >> sys.stderr, '    --indel-cost list  - default 1,2'
+        print >> sys.stderr, '    --read-length list - default 33'
+        print >> sys.stderr, '    --batch-size list  - Reads per batch, counting each strand'
+        print >> sys.stderr, '                         separately, default 1024'
+        print >> sys.stderr, '    --repeat n        - Take the best of n timings, default 1'
+        print >> sys.stderr, '    --seed n          - Random seed, default 1'
+        print >> sys.stderr, '    --graph-size n    - Items in the browser graph structure'
+        print >> sys.stderr, '                        benchmark, which also times the classes they'
+        print >> sys.stderr, '                        replaced, default 100000, 0 to skip'
+        print >> sys.stderr, '    -o file           - Output file, default standard output'
+        print >> sys.stderr, ''
+        print >> sys.stderr, error[0]
+        return 1
+
+    random.seed(seed)
+    reference = random_reference(size, repeat_fraction)
+
+    results = [ ]
+    for read_length in read_lengths:
+        error_p = shred.error_profile(read_length, error_rate)
+        read_names = [ ]
+        reads = [ ]
+        for name, read in shred.shred(reference, n_reads, read_length, error_p):
+            # Both strands are searched, as by "myr align"
+            read_names.append(name + ' fwd')
+            reads.append(read)
+            read_names.append(name + ' rev')
+            reads.append(sequence.reverse_complement(read))
+
+        for engine_name, search_func in engines():
+            for maxerror in maxerrors:
+                for indel_cost in indel_costs:
+                    for batch_size in batch_sizes:
+                        n_batches = (len(reads)+batch_size-1) // batch_size
+                        util.show_status('%s maxerror=%d indel_cost=%d read_length=%d batch_size=%d' %
+                                         (engine_name, maxerror, indel_cost, read_length, batch_size))
+                        seconds, n_hits = time_engine(
+                            search_func, reference, reads, read_names,
+                            maxerror, indel_cost, batch_size, repeats)
+                        results.append({
+                            'engine' : engine_name,
+                            'maxerror' : maxerror,
+                            'indel_cost' : indel_cost,
+                            'read_length' : read_length,
+                            'batch_size' : batch_size,
+                            'seconds' : seconds,
+                            'reads_per_second' : n_reads / seconds,
+                            'bases_per_second' : float(size) * n_batches / seconds,
+                            'hits' : n_hits,
+                        })
+    
+    graph = None
+    if graph_size > 0:
+        util.show_status('Browser graph structures, %d items' % graph_size)
+        graph = time_graph_structures(graph_size, repeats)
+    util.show_status('')
+
+    report = {
+        'reference_size' : size,
+        'reads' : n_reads,
+        'error_rate' : error_rate,
+        'repeat_fraction' : repeat_fraction,
+        'seed' : seed,
+        'repeat' : repeats,
+        'python' : platform.python_version(),
+        'numpy' : numpy.__version__,
+        'machine' : platform.machine(),
+        'processor' : platform.processor(),
+        'results' : results,
+        'graph' : graph,
+    }
+
+    if output_filename is None:
+        out = sys.stdout
+    else:
+        out = open(output_filename, 'wb')
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+    if output_filename is not None:
+        out.close()
+
+    return 0
+
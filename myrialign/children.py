@@ -25,10 +25,25 @@
 
 """
 
-import sys, os, subprocess, fcntl, select, struct, cPickle
+import sys, os, subprocess, fcntl, select, struct, cPickle, time
 
 WRITERS = { }
 
+# Bytes and time spent on communication, for performance reports
+COUNTERS = {
+    'bytes_sent' : 0,
+    'bytes_received' : 0,
+    'pickle_time' : 0.0,
+    'unpickle_time' : 0.0,
+}
+
+def take_counters():
+    """ Return communication counters, and reset them. """
+    result = COUNTERS.copy()
+    for key in COUNTERS:
+        COUNTERS[key] = type(COUNTERS[key])(0)
+    return result
+
 class Error(Exception): pass
 
 class Write_to_dead_child(Error): pass
@@ -46,13 +61,14 @@ class Child:
         self.stdout = self.subprocess.stdout
         self.closed = False
         self.return_code = None
+        self.write_error = None
 
     def read(self, amount):
         return read(amount, self.stdout)
         
     def write(self, data):
         self._check_status()    
-        write(data, self.stdin)
+        write(data, self.stdin, self._on_write_error)
 
     def close_stdin(self):
         close(self.stdin)
@@ -60,7 +76,12 @@ class Child:
 
     def send(self, item):
         self._check_status()
-        send(item, self.stdin)
+        send(item, self.stdin, self._on_write_error)
+    
+    def _on_write_error(self, exception):
+        # Most likely the child has died, leave it to the owner to notice
+        self.write_error = exception
+        abort_write(self.stdin)
     
     def receive(self):
         return receive(self.stdout)
@@ -181,6 +202,16 @@ def abort_write(file=sys.stdout):
         del WRITERS[file]
 
 
+def pending_bytes():
+    """ Bytes queued but not yet written. """
+    total = 0
+    for queue in WRITERS.values():
+        for item in queue:
+            if item is not None:
+                total += len(item[1]) - item[0]
+    return total
+
+
 def flush(file):
     while file in WRITERS: 
         wait()
@@ -192,7 +223,10 @@ def flush_all():
 
 
 def send(object, file=sys.stdout, on_error=default_write_error):
+    start = time.time()
     pickled = cPickle.dumps(object, 2) # 2 == binary format
+    COUNTERS['pickle_time'] += time.time() - start
+    COUNTERS['bytes_sent'] += 8 + len(pickled)
     write(struct.pack('<q', len(pickled)), file, on_error)
     write(pickled, file, on_error)
 
@@ -205,7 +239,11 @@ def receive(file=sys.stdin):
     data = read(length, file)
     if len(data) < length: 
         raise EOFError()
-    return cPickle.loads(data)
+    COUNTERS['bytes_received'] += 8 + length
+    start = time.time()
+    result = cPickle.loads(data)
+    COUNTERS['unpickle_time'] += time.time() - start
+    return result
 
 
 
@@ -0,0 +1,129 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    External merge sort of hit lines, for "myr align --sorted".
+
+    Sorted runs are held in memory up to a limit, then merged and
+    spilled to a temporary file. Temporary files are merged in groups
+    of FAN_IN, so that the number of open files stays small.
+
+"""
+
+import heapq, tempfile
+
+FAN_IN = 16
+
+def hit_key(line):
+    """ Sort hit lines by reference start position. The line itself
+        breaks ties, so the order does not depend on batch order. """
+    span = line.split(None, 4)[3]
+    return int(span[:span.index('..')]), line
+
+def merge(iterators, key):
+    """ Merge iterators that are each sorted by key. """
+    heap = [ ]
+    for i, iterator in enumerate(iterators):
+        iterator = iter(iterator)
+        for item in iterator:
+            heap.append((key(item), i, item, iterator))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, i, item, iterator = heap[0]
+        yield item
+        for item in iterator:
+            heapq.heapreplace(heap, (key(item), i, item, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+def read_run(f):
+    f.seek(0)
+    for line in f:
+        yield line[:-1]
+
+class Sorter:
+    """ Accumulates sorted runs of lines (without newlines),
+        spilling them to temporary files beyond max_memory bytes. """
+
+    def __init__(self, key, max_memory, directory=None, fan_in=FAN_IN):
+        self.key = key
+        self.max_memory = max_memory
+        self.directory = directory
+        self.fan_in = fan_in
+
+        self.runs = [ ]
+        self.memory = 0
+        self.levels = [ ] # levels[i] = [ files each merged from fan_in**i spills ]
+        self.n_spills = 0
+
+    def add(self, run, memory):
+        """ Add a run, already sorted by key, taking an estimated
+            memory bytes. """
+        self.runs.append(run)
+        self.memory += memory
+        if self.memory > self.max_memory:
+            self.spill()
+
+    def spill(self):
+        if not self.runs: return
+        f = self._write(merge(self.runs, self.key))
+        self.runs = [ ]
+        self.memory = 0
+        self.n_spills += 1
+        self._add_file(f, 0)
+
+    def _add_file(self, f, level):
+        while len(self.levels) <= level:
+            self.levels.append([ ])
+        self.levels[level].append(f)
+
+        if len(self.levels[level]) >= self.fan_in:
+            files = self.levels[level]
+            self.levels[level] = [ ]
+            merged = self._write(merge([ read_run(item) for item in files ], self.key))
+            for item in files:
+                item.close()
+            self._add_file(merged, level+1)
+
+    def _write(self, lines):
+        f = tempfile.TemporaryFile(dir=self.directory)
+        for line in lines:
+            f.write(line + '\n')
+        return f
+
+    def sorted(self):
+        """ Yield all lines added so far in order, then
+            start afresh. """
+        files = [ ]
+        for level in self.levels:
+            files.extend(level)
+
+        iterators = [ read_run(f) for f in files ] + self.runs
+        for line in merge(iterators, self.key):
+            yield line
+
+        for f in files:
+            f.close()
+        self.levels = [ ]
+        self.runs = [ ]
+        self.memory = 0
@@ -0,0 +1,180 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Writing and reading alignment files, optionally gzip compressed.
+
+    Output is written in large blocks. Compressed output is a series of
+    independent gzip members, one per block (as in BGZF, but with larger
+    blocks), compressed by a helper thread while the main thread gets on
+    with other work. Any gzip reader can read the result, and a file
+    can be truncated at any block boundary.
+
+"""
+
+import sys, zlib, struct, gzip, threading, Queue
+
+BLOCK_SIZE = 1 << 20
+
+# Blocks waiting to be compressed, beyond this the writer waits
+MAX_QUEUED = 4
+
+COMPRESS_LEVEL = 6
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# Magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = GZIP_MAGIC + '\x08\x00' + '\x00\x00\x00\x00' + '\x00\xff'
+
+def gzip_member(data, level=COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (GZIP_HEADER +
+            compressor.compress(data) + compressor.flush() +
+            struct.pack('<LL', zlib.crc32(data) & 0xffffffffL, len(data) & 0xffffffffL))
+
+def is_compressed_name(filename):
+    return filename.endswith('.gz')
+
+
+class Writer:
+    """ Buffered, optionally compressed, writing to a file object.
+
+        Use mark(callback) to learn the file offset up to which
+        everything written so far is safely in the file. """
+
+    def __init__(self, f, compress=False, level=COMPRESS_LEVEL):
+        self.file = f
+        self.compress = compress
+        self.level = level
+        self.buffer = [ ]
+        self.size = 0
+
+        if compress:
+            self.error = None
+            self.queue = Queue.Queue(MAX_QUEUED)
+            self.thread = threading.Thread(target=self._compressor)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= BLOCK_SIZE:
+            self._end_block()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def mark(self, callback):
+        """ End the current block, and call callback(offset) once it
+            has been written and flushed. With compression, the callback
+            is made from the helper thread. """
+        self._end_block()
+        if self.compress:
+            self._put(('mark', callback))
+        else:
+            self.file.flush()
+            callback(self.file.tell())
+
+    def flush(self):
+        self._end_block()
+        if self.compress:
+            self.queue.join()
+            self._check_error()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.compress:
+            self._put(None)
+            self.thread.join()
+        self.file.close()
+
+    def _end_block(self):
+        if not self.buffer: return
+        data = ''.join(self.buffer)
+        self.buffer = [ ]
+        self.size = 0
+
+        if self.compress:
+            self._put(('block', data))
+        else:
+            self.file.write(data)
+
+    def _put(self, item):
+        self._check_error()
+        self.queue.put(item)
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _compressor(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+
+                # After an error, just drain the queue
+                if self.error is not None:
+                    continue
+
+                try:
+                    kind, value = item
+                    if kind == 'block':
+                        self.file.write(gzip_member(value, self.level))
+                    else:
+                        self.file.flush()
+                        value(self.file.tell())
+                except Exception, error:
+                    self.error = error
+            finally:
+                self.queue.task_done()
+
+
+def is_compressed_file(filename):
+    return open(filename, 'rb').read(2) == GZIP_MAGIC
+
+def open_hit_file(filename):
+    """ Open an alignment file for reading,
+        decompressing it if it is gzipped. """
+    f = open(filename, 'rb')
+    magic = f.read(2)
+    f.seek(0)
+    if magic == GZIP_MAGIC:
+        f = gzip.GzipFile(filename, 'rb', fileobj=f)
+    return f
+
+def read_line(f):
+    """ Read a line from a file from open_hit_file. A compressed file that
+        ends part way through a block is treated as ending there. """
+    try:
+        return f.readline()
+    except (EOFError, IOError, zlib.error):
+        return ''
+
+def iter_lines(f):
+    while True:
+        line = read_line(f)
+        if not line:
+            return
+        yield line
@@ -20,6 +20,8 @@
 
 import sys
 
+import util, profiling
+
 USAGE = """\
 
 Usage: myr [command] ...
@@ -29,6 +31,8 @@ Commands:
 
     align    - align reads to a reference
     
+    merge    - combine the outputs of a sharded alignment run
+
     browse   - interactive sequence and alignment browser
 
 
@@ -41,9 +45,14 @@ Commands:
 
     assess   - estimate read accuracy
 
+    bench    - time the alignment engines on simulated data
+
 
 Enter just "myr [command]" for help on that command.
 
+Any command can be given the option "--profile <directory>" to save
+profiles of each process involved and print a combined report.
+
 """
 
 def show_help():
@@ -56,13 +65,34 @@ def main(argv):
     
     command = argv[1]
     argv = argv[2:]
-    
+
+    try:
+        profile_directory, argv = util.get_option_value(argv, '--profile', str, None)
+    except util.Bad_option, error:
+        print >> sys.stderr, error[0]
+        return 1
+    if profile_directory is None:
+        profile_directory = profiling.inherited_directory()
+
+    if profile_directory is None:
+        return run_command(command, argv)
+    else:
+        return profiling.profile(command, run_command, argv, profile_directory)
+
+def run_command(command, argv):
     if command == 'align':
         import align
         return align.main(argv)
     elif command == 'child':
         import align
         return align.child(argv)
+    elif command == 'merge':
+        import shard
+        return shard.merge(argv)
+    
+    elif command == 'parse-child':
+        import output
+        return output.parse_child(argv)
     
     elif command == 'textdump':
         import output
@@ -81,6 +111,10 @@ def main(argv):
     elif command == 'assess':
         import assess
         return assess.main(argv)
+
+    elif command == 'bench':
+        import bench
+        return bench.main(argv)
 	
     else:    
         return show_help()
@@ -24,12 +24,12 @@
 
 """
 
-import sys, numpy, os.path, sets, heapq
+import sys, numpy, os.path, heapq, sha, struct, cStringIO, itertools
 
-import sequence, sort
+import sequence, sort, hitfile, cache, children
+from util import Bad_option, get_option, get_option_value, show_status
 
 class Error(Exception): pass
-class Bad_option(Error): pass
 class Not_found(Error): pass
 class Out_of_bounds(Error): pass
 
@@ -43,41 +43,6 @@ class Hit:
 	read_ali
 	ref_ali """
 
-def get_option(argv, option):
-    argv = argv[:]
-    has_option = False
-    while True:
-        try:
-	    location = argv.index(option)
-	except ValueError: #Not found
-	    break
-        has_option = True
-	del argv[location]
-
-    return has_option, argv
-
-def get_option_value(argv, option, conversion_function, default):
-    argv = argv[:]
-    value = default
-    while True:
-        try:
-	    location = argv.index(option)
-	except ValueError: #Not found
-	    break
-	    
-	if location == len(argv)-1 :
-	    raise Bad_option('Option %s requires a paramter' % option)
-	
-	try:
-	    value = conversion_function(argv[location+1])
-	except Exception:
-	    raise Bad_option('Option for %s not in expected format' % option)
-	
-	del argv[location:location+2]
-
-    return value, argv
-
-
 def show_default_options():
      print >> sys.stderr, '    -u    - Only count reads that have a unique hit'
      print >> sys.stderr, ''
@@ -107,17 +72,102 @@ def clip_alignment(read_ali, ref_ali, clip_start, clip_end):
     return read_ali, ref_ali, n_start, n_end
 
 
+EMPTY_ROWS = numpy.zeros(0, 'int')
+
+def expand_ranges(starts, ends):
+    """ Concatenation of ranges starts[i]:ends[i], and for each 
+        element which range it came from. """
+    counts = ends - starts
+    total = numpy.sum(counts)
+    which = numpy.repeat(numpy.arange(len(counts)), counts)
+    offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts)-counts, counts)
+    return numpy.repeat(starts, counts) + offsets, which
+
+GAP = ord('-')
+
+def column_positions(starts, lengths, ref_gap):
+    """ Reference position of each column of concatenated alignments, 
+        counting a column where the reference has a gap as being before 
+        the next reference base. Also returns which alignment each column 
+        is from, and each alignment's first column. """
+    which = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    offsets = numpy.cumsum(lengths) - lengths
+    gaps = numpy.concatenate(([0], numpy.cumsum(ref_gap)))
+    columns = numpy.arange(len(ref_gap)) - offsets[which]
+    positions = numpy.asarray(starts, 'int64')[which] + columns - (gaps[:-1] - gaps[offsets][which])
+    return positions, which, offsets
+
+def edit_scripts(starts, read_alis, ref_alis, reference_chars):
+    """ Alignments as edit scripts against the reference, given as an
+        array of characters. A column is left out of the script if read and 
+        reference agree with the reference base at its position. 
+        
+        Returns alignment lengths, edit counts, and for each edit its column 
+        and its reference and read characters. """
+    read_ali = numpy.fromstring(''.join(read_alis), 'uint8')
+    ref_ali = numpy.fromstring(''.join(ref_alis), 'uint8')
+    lengths = numpy.array([ len(item) for item in read_alis ], 'int64')
+    assert len(read_ali) == len(ref_ali), 'Alignment strings differ in length'
+    
+    ref_gap = ref_ali == GAP
+    positions, which, offsets = column_positions(starts, lengths, ref_gap)
+    
+    in_bounds = numpy.flatnonzero((positions >= 0) & (positions < len(reference_chars)))
+    matched = numpy.zeros(len(ref_ali), 'bool')
+    matched[in_bounds] = reference_chars[positions[in_bounds]] == ref_ali[in_bounds]
+    matched &= (read_ali == ref_ali) & ~ref_gap
+    
+    edits = numpy.flatnonzero(~matched)
+    counts = numpy.bincount(which[edits], minlength=len(lengths))
+    return lengths, counts, (edits - offsets[which[edits]]), ref_ali[edits], read_ali[edits]
+
+def apply_edit_scripts(starts, lengths, counts, edit_columns, edit_refs, edit_reads, reference_chars):
+    """ Inverse of edit_scripts. Returns the alignment columns concatenated, 
+        as arrays of read and reference characters. """
+    lengths = numpy.asarray(lengths, 'int64')
+    offsets = numpy.cumsum(lengths) - lengths
+    edits = numpy.repeat(offsets, counts) + edit_columns
+    
+    ref_gap = numpy.zeros(numpy.sum(lengths), 'bool')
+    ref_gap[edits] = edit_refs == GAP
+    positions = column_positions(starts, lengths, ref_gap)[0]
+    
+    if len(reference_chars):
+        ref_ali = reference_chars[numpy.clip(positions, 0, len(reference_chars)-1)]
+    else:
+        ref_ali = numpy.zeros(len(positions), 'uint8')
+    read_ali = ref_ali.copy()
+    ref_ali[edits] = edit_refs
+    read_ali[edits] = edit_reads
+    return read_ali, ref_ali
+
+def split_columns(ali, lengths):
+    """ Strings of concatenated alignment columns. """
+    text = ali.tostring()
+    ends = numpy.cumsum(lengths)
+    return [ text[end-length:end] for end, length in zip(ends, lengths) ]
+
+
 class Table:
+    """ Columns of equal length, named in MEMBERS.
+    
+        Sorted indexes on columns are built on demand. Rows added with
+        resize, new_id or append are merged into existing indexes when
+        they are next used. If existing rows are changed, call 
+        you_are_dirty(). """
+
     def __init__(self):
 	self.store_size = 0
 	self.length = 0
-	self.indicies = { }
+	self.indicies = { } # name -> (order, sorted values)
+	self.hash_indicies = { } # name -> { value : rows } or None if not yet built
         for name, dtype in self.MEMBERS:
 	    setattr(self, name, numpy.empty(self.store_size, dtype))
 	
     def resize(self, length):
+        if length < self.length:
+            self.you_are_dirty()
 	self.length = length
-	self.indicies = { }
 	if length > self.store_size:
 	    old_size = self.store_size
 	    self.store_size = length*5//4
@@ -131,67 +181,279 @@ class Table:
 	self.resize(result+1)
 	return result
 
+    def append(self, columns):
+        """ Append rows given as { column name : sequence of values }.
+            Returns the id of the first new row. """
+        start = self.length
+        n = len(columns[self.MEMBERS[0][0]])
+        self.resize(start+n)
+        for name, dtype in self.MEMBERS:
+            self.__dict__[name][start:start+n] = columns[name]
+        return start
+
+    def keep_rows(self, rows):
+        """ Keep only the given rows, in the given order. """
+        for name, dtype in self.MEMBERS:
+            setattr(self, name, self.__dict__[name][rows])
+        self.length = self.store_size = len(rows)
+        self.you_are_dirty()
+
     def you_are_dirty(self):
         if self.indicies:
 	    self.indicies = { }
+        for name in self.hash_indicies:
+            self.hash_indicies[name] = None
+
+    def _sorted(self, name):
+        """ Row order sorting the column, and the column in that order. 
+            Equal values are in row order. """
+        column = self.__dict__[name][:self.length]
+        if name in self.indicies:
+            order, values = self.indicies[name]
+            if len(order) == self.length:
+                return order, values
+            
+            # Merge in new rows
+            new_order = numpy.argsort(column[len(order):], kind='mergesort') + len(order)
+            new_values = column[new_order]
+            positions = numpy.searchsorted(values, new_values, side='right')
+            order = numpy.insert(order, positions, new_order)
+            values = numpy.insert(values, positions, new_values)
+        else:
+            order = numpy.argsort(column, kind='mergesort')
+            values = column[order]
+        
+        self.indicies[name] = (order, values)
+        return order, values
 
     def index(self, name):
-        if name not in self.indicies:
-	    self.indicies[name] = numpy.argsort(self.__dict__[name][:self.length])
-	return self.indicies[name]
-
-    def _find(self, name, value):
-        column = self.__dict__[name]
-        order = self.index(name)
-	
-	lo = 0
-	hi = len(order)
-	while lo < hi:
-            mid = (lo+hi)//2
-            if column[order[mid]] < value: lo = mid+1
-            else: hi = mid
-
-        return column, order, lo
+        return self._sorted(name)[0]
+
+    def _keys(self, name, keys):
+        """ keys as an array of the same type as the column """
+        dtype = self.__dict__[name].dtype
+        if dtype == numpy.dtype('object'):
+            result = numpy.empty(len(keys), dtype)
+            result[:] = keys
+            return result
+        return numpy.asarray(keys, dtype)
+
+    def find_ranges(self, name, keys):
+        """ For an array of keys, returns order, starts and ends such that 
+            the rows with column equal to keys[i] are order[starts[i]:ends[i]] """
+        order, values = self._sorted(name)
+        keys = self._keys(name, keys)
+        starts = numpy.searchsorted(values, keys, side='left')
+        ends = numpy.searchsorted(values, keys, side='right')
+        return order, starts, ends
 
     def find(self, name, value):
-        column, order, i = self._find(name, value)
-	if column[order[i]] != value:
+        order, starts, ends = self.find_ranges(name, [value])
+	if starts[0] == ends[0]:
 	    raise Not_found(self,name,value)
-	return order[i]
+	return order[starts[0]]
     
     def find_all(self, name, value):
-        column, order, i = self._find(name, value)
-	j = i
-	while j < len(order) and column[order[j]] == value: 
-	    j += 1
-	return order[i:j]
+        if name in self.hash_indicies:
+            return self._hashed(name).get(value, EMPTY_ROWS)
+        order, starts, ends = self.find_ranges(name, [value])
+	return order[starts[0]:ends[0]]
+
+    def find_all_of(self, name, keys):
+        """ Rows with column equal to any of an array of keys. 
+            Returns rows, and which key each row matched. """
+        order, starts, ends = self.find_ranges(name, keys)
+        positions, which = expand_ranges(starts, ends)
+        return order[positions], which
+
+    def use_hash_index(self, name):
+        """ Use a dictionary for find_all on this column. This is faster 
+            for many single lookups. """
+        if name not in self.hash_indicies:
+            self.hash_indicies[name] = None
+
+    def _hashed(self, name):
+        index = self.hash_indicies[name]
+        if index is None:
+            index = { }
+            indexed = 0
+        else:
+            index, indexed = index
+        
+        if indexed < self.length:
+            column = self.__dict__[name]
+            new_order = numpy.argsort(column[indexed:self.length], kind='mergesort') + indexed
+            new_values = column[new_order]
+            ends = list(numpy.flatnonzero(new_values[1:] != new_values[:-1]) + 1)
+            ends.append(len(new_order))
+            start = 0
+            for end in ends:
+                value = new_values[start:start+1].tolist()[0]
+                if value in index:
+                    index[value] = numpy.concatenate((index[value], new_order[start:end]))
+                else:
+                    index[value] = new_order[start:end]
+                start = end
+            self.hash_indicies[name] = (index, self.length)
+        
+        return index
 
     def iter_groups(self, name):
-        column = self.__dict__[name]
-        order = self.index(name)
+        order, values = self._sorted(name)
+        if not len(order): return
+        ends = list(numpy.flatnonzero(values[1:] != values[:-1]) + 1)
+        ends.append(len(order))
 	start = 0
-	while start < len(order):
-	    end = start + 1
-	    while end < len(order) and column[order[start]] == column[order[end]]:
-	        end += 1
+	for end in ends:
 	    yield order[start:end]
 	    start = end
 
 class Hits(Table):
+    """ Read names are stored as integer ids, see names and name_id. 
+    
+        Alignments are stored as edit scripts against the reference 
+        (see edit_scripts), rows edit_start:edit_end of edit_column, 
+        edit_ref and edit_read. Use append_hits to add hits and 
+        alignments or alignment_columns to get them back. """
+    
     MEMBERS = (
-        ('name', 'object'),
+        ('name', 'int32'),
 	('forward', 'bool'),
-	('read_ali', 'object'),
-	('ref_ali', 'object'),
 	('start', 'int32'),
 	('end', 'int32'),
-    )   
-
+	('ali_length', 'int32'),
+	('edit_start', 'int64'),
+	('edit_end', 'int64'),
+    )
+    
+    def __init__(self, reference=None):
+        Table.__init__(self)
+        self.names = [ ]
+        self.name_ids = { }
+        
+        if reference is None:
+            self.reference_chars = numpy.zeros(0, 'uint8')
+        else:
+            self.reference_chars = sequence.STR_SEQ[reference]
+        self.reference_text = self.reference_chars.tostring()
+        self.n_edits = 0
+        self.edit_column = numpy.empty(0, 'int32')
+        self.edit_ref = numpy.empty(0, 'uint8')
+        self.edit_read = numpy.empty(0, 'uint8')
+    
+    def append_hits(self, names, forwards, starts, ends, read_alis, ref_alis):
+        """ Append hits, as chunks from iter_hit_chunks. """
+        lengths, counts, columns, refs, reads = edit_scripts(starts, read_alis, ref_alis, self.reference_chars)
+        
+        n = self.n_edits + len(columns)
+        if n > len(self.edit_column):
+            size = max(n, len(self.edit_column)*5//4)
+            for name in ('edit_column', 'edit_ref', 'edit_read'):
+                column = numpy.empty(size, self.__dict__[name].dtype)
+                column[:self.n_edits] = self.__dict__[name][:self.n_edits]
+                setattr(self, name, column)
+        self.edit_column[self.n_edits:n] = columns
+        self.edit_ref[self.n_edits:n] = refs
+        self.edit_read[self.n_edits:n] = reads
+        
+        edit_ends = self.n_edits + numpy.cumsum(counts)
+        self.n_edits = n
+        
+        name_id = self.name_id
+        return self.append({
+            'name' : numpy.array([ name_id(name) for name in names ], 'int32'),
+            'forward' : forwards,
+            'start' : starts,
+            'end' : ends,
+            'ali_length' : lengths,
+            'edit_start' : edit_ends - counts,
+            'edit_end' : edit_ends,
+        })
+    
+    def alignment_columns(self, rows):
+        """ Alignment lengths of some rows, and their alignment columns 
+            concatenated as arrays of read and reference characters. """
+        rows = numpy.asarray(rows, 'int64')
+        edits, which = expand_ranges(self.edit_start[rows], self.edit_end[rows])
+        lengths = self.ali_length[rows]
+        read_ali, ref_ali = apply_edit_scripts(
+            self.start[rows], lengths, self.edit_end[rows] - self.edit_start[rows],
+            self.edit_column[edits], self.edit_ref[edits], self.edit_read[edits],
+            self.reference_chars)
+        return lengths, read_ali, ref_ali
+    
+    def alignments(self, rows):
+        """ Lists of read and reference alignment strings of some rows. """
+        lengths, read_ali, ref_ali = self.alignment_columns(rows)
+        return split_columns(read_ali, lengths), split_columns(ref_ali, lengths)
+    
+    def alignment(self, i):
+        """ Read and reference alignment strings of row i. 
+            Quicker than alignments for a single row. """
+        text = self.reference_text
+        read_ali = [ ]
+        ref_ali = [ ]
+        position = int(self.start[i])
+        column = 0
+        for j in xrange(self.edit_start[i], self.edit_end[i]):
+            edit_column = int(self.edit_column[j])
+            matched = text[position:position+edit_column-column]
+            read_ali.append(matched)
+            ref_ali.append(matched)
+            position += edit_column-column
+            
+            ref_char = chr(self.edit_ref[j])
+            read_ali.append(chr(self.edit_read[j]))
+            ref_ali.append(ref_char)
+            if ref_char != '-':
+                position += 1
+            column = edit_column+1
+        
+        matched = text[position:position+int(self.ali_length[i])-column]
+        read_ali.append(matched)
+        ref_ali.append(matched)
+        return ''.join(read_ali), ''.join(ref_ali)
+    
+    def name_id(self, name):
+        """ Integer id of a read name, allocating a new one if need be. """
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            result = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            return result
+    
+    def sort_names(self):
+        """ Renumber name ids to be in the same order as the names themselves, 
+            so that grouping by name id visits reads in name order. """
+        order = numpy.argsort(numpy.array(self.names, 'object'))
+        new_ids = numpy.empty(len(order), 'int32')
+        new_ids[order] = numpy.arange(len(order))
+        self.name[:self.length] = new_ids[self.name[:self.length]]
+        self.names = [ self.names[i] for i in order ]
+        self.name_ids = dict(zip(self.names, xrange(len(self.names))))
+        self.you_are_dirty()   
+
+
+def parse_myrialign_line(line):
+    """ name, forward, start, end, read_ali, ref_ali from a hit line """
+    name, direction, n_errors, span, read_ali, ref_ali = line.rstrip().split()
+    start, end = span.split('..')
+    return name, direction == 'fwd', int(start)-1, int(end), read_ali, ref_ali
+
+def show_loading(items):
+    """ Pass items through, showing progress. """
+    nth = 0
+    for item in items:
+	nth += 1
+	if nth % 1000 == 0:
+            sys.stderr.write('Loading hits: %d            \r' % nth)
+	    sys.stderr.flush()
+	yield item
 
-def iter_hit_file_myrialign(filename):
+def parse_myrialign_lines(lines):
     ref_name = None
-    nth = 0
-    for line in open(filename, 'rb'):
+    for line in lines:
         if not line.endswith('\n'): break #Alignment file truncated or still being written
     
         if line.startswith('#'):
@@ -199,27 +461,16 @@ def iter_hit_file_myrialign(filename):
 	        ref_name = line.split()[1]
 	    continue
 	
-	name, direction, n_errors, span, read_ali, ref_ali = line.rstrip().split()
-	start, end = span.split('..')
-	start = int(start)-1
-	end = int(end)
-	forward = (direction == 'fwd')
-	
-	nth += 1
-	if nth % 1000 == 0:
-            sys.stderr.write('Loading hits: %d            \r' % nth)
-	    sys.stderr.flush()
-	
-	yield ref_name, name, forward, start, end, read_ali, ref_ali
+	yield (ref_name,) + parse_myrialign_line(line)
 
-def iter_hit_file_maf(filename):
+def iter_hit_file_myrialign(filename):
+    return show_loading(parse_myrialign_lines(
+        hitfile.iter_lines(hitfile.open_hit_file(filename)) ))
+
+def parse_maf_lines(lines):
     # BLAT only, for now
     seqs = [ ]
-    f = open(filename,'rb')
-    nth = 0
-    while True:
-        line = f.readline()
-	
+    for line in lines:
         if not line.endswith('\n'): break #Alignment file truncated or still being written
     
 	if line.startswith('s'):
@@ -238,19 +489,14 @@ def iter_hit_file_maf(filename):
 	    start = int(ref_start)
 	    end = start + int(ref_size) - 1
 	    
-	    nth += 1
-	    if nth % 1000 == 0:
-        	sys.stderr.write('Loading hits: %d            \r' % nth)
-		sys.stderr.flush()
-
 	    yield ref_name, read_name, read_strand=='+', start, end, ref_text.upper(), read_text.upper()
-	    	
-	if not line: 
-	    break
 
-def iter_hit_file_eland(filename):        
-    nth = 0
-    for line in open(filename, 'rb'):
+def iter_hit_file_maf(filename):
+    return show_loading(parse_maf_lines(
+        hitfile.iter_lines(hitfile.open_hit_file(filename)) ))
+
+def parse_eland_lines(lines):
+    for line in lines:
         if not line.endswith('\n'): break #Alignment file truncated or still being written
 	
 	parts = line.rstrip().split('\t')
@@ -266,101 +512,603 @@ def iter_hit_file_eland(filename):
 	end = start+len(read_seq)
 	
 	ref_seq = read_seq
-	for item in substitutions:
-	    base = item[-1]
-	    position = int(item[:-1])-1
-	    ref_seq = ref_seq[:position] + base + ref_seq[position+1:]
+	if substitutions:
+	    ref_seq = list(ref_seq)
+	    for item in substitutions:
+	        ref_seq[int(item[:-1])-1] = item[-1]
+	    ref_seq = ''.join(ref_seq)
 
         if not forward:
             read_seq = sequence.reverse_complement_string(read_seq)
 	    ref_seq = sequence.reverse_complement_string(ref_seq)
 
-	nth += 1
-	if nth % 1000 == 0:
-            sys.stderr.write('Loading hits: %d            \r' % nth)
-	    sys.stderr.flush()
-	
 	yield ref_filename, read_name, forward, start, end, ref_seq.upper(), read_seq.upper()
 
+def iter_hit_file_eland(filename):        
+    return show_loading(parse_eland_lines(
+        hitfile.iter_lines(hitfile.open_hit_file(filename)) ))
 
-def iter_hit_file(filename):
-    first_line = open(filename,'rb').readline()
+
+def hit_file_format(filename):
+    first_line = hitfile.read_line(hitfile.open_hit_file(filename))
     if first_line.startswith('##maf'):
-        return iter_hit_file_maf(filename)
+        return 'maf'
     if first_line.startswith('>'):
+        return 'eland'
+    return 'myrialign'
+
+def iter_hit_file(filename):
+    kind = hit_file_format(filename)
+    if kind == 'maf':
+        return iter_hit_file_maf(filename)
+    if kind == 'eland':
         return iter_hit_file_eland(filename)
     return iter_hit_file_myrialign(filename)
 
 
-def read_files(argv):
+HIT_INDEX_VERSION = 2
+
+def stable_hash(name):
+    """ A 64-bit hash of a string, the same from run to run """
+    return struct.unpack('<q', sha.new(name).digest()[:8])[0]
+
+def hit_file_index(filename):
+    """ Index of a "myr align" output file, built once and then cached.
+    
+        Returns a dict of arrays, each in order of reference then hit start:
+        reference - position in the list references
+        start, end - as given by iter_hit_file
+        max_end - running maximum of end, within each reference
+        offset - of the hit's line in the (decompressed) file
+        name_hash - stable_hash of the read name 
+        
+        and references, a list of reference names. """
+    filesig = cache.file_signature(filename)
+    
+    def callback(working_dir):
+        references = [ ]
+        reference_ids = [ ]
+        starts = [ ]
+        ends = [ ]
+        offsets = [ ]
+        name_hashes = [ ]
+        
+        reference = -1
+        offset = 0
+        for line in hitfile.iter_lines(hitfile.open_hit_file(filesig[0])):
+            if not line.endswith('\n'): break #Alignment file truncated or still being written
+            
+            if line.startswith('#'):
+                if line.startswith('#Reference:'):
+                    ref_name = line.split()[1]
+                    if ref_name not in references:
+                        references.append(ref_name)
+                    reference = references.index(ref_name)
+            else:
+                name, direction, n_errors, span, rest = line.split(None, 4)
+                start, end = span.split('..')
+                reference_ids.append(reference)
+                starts.append(int(start)-1)
+                ends.append(int(end))
+                offsets.append(offset)
+                name_hashes.append(stable_hash(name))
+                
+                if len(offsets) % 10000 == 0:
+                    show_status('Indexing hits: %d' % len(offsets))
+            offset += len(line)
+        show_status('')
+        
+        reference_ids = numpy.array(reference_ids, 'int32')
+        starts = numpy.array(starts, 'int64')
+        order = numpy.lexsort((starts, reference_ids))
+        reference_ids = reference_ids[order]
+        ends = numpy.array(ends, 'int64')[order]
+        max_ends = ends.copy()
+        for i in xrange(-1, len(references)):
+            first, last = numpy.searchsorted(reference_ids, [i, i+1])
+            max_ends[first:last] = numpy.maximum.accumulate(ends[first:last])
+        
+        columns = {
+            'reference' : reference_ids,
+            'start' : starts[order],
+            'end' : ends,
+            'max_end' : max_ends,
+            'offset' : numpy.array(offsets, 'int64')[order],
+            'name_hash' : numpy.array(name_hashes, 'int64')[order],
+        }
+        for name in columns:
+            numpy.save(os.path.join(working_dir, name + '.npy'), columns[name])
+        f = open(os.path.join(working_dir, 'references.txt'), 'wb')
+        for name in references:
+            print >> f, name
+        f.close()
+    
+    directory = cache.get(('hit_file_index', HIT_INDEX_VERSION, filesig), callback)
+    
+    result = { }
+    for name in ('reference', 'start', 'end', 'max_end', 'offset', 'name_hash'):
+        result[name] = numpy.load(os.path.join(directory, name + '.npy'))
+    result['references'] = open(os.path.join(directory, 'references.txt'), 'rb').read().split()
+    return result
+
+def reference_bounds(index, reference):
+    """ Part of a hit file index for the named reference, 
+        or each reference if None, as a list of (first, last). """
+    if reference is None:
+        ids = range(-1, len(index['references']))
+    elif reference in index['references']:
+        ids = [ index['references'].index(reference) ]
+    else:
+        ids = [ ]
+    return [ tuple(numpy.searchsorted(index['reference'], [i, i+1])) for i in ids ]
+
+def parse_region(text):
+    """ Parse "start..end", counting from 1 and inclusive, 
+        into (start, end) counting from 0 and exclusive """
+    start, end = text.split('..')
+    start = int(start)-1
+    end = int(end)
+    if not 0 <= start < end:
+        raise ValueError('Bad region %s' % text)
+    return start, end
+
+def region_selection(index, region, reference=None):
+    """ Positions in a hit file index of hits overlapping region (start, end)
+        on the named reference, or any reference if None.
+        A little slack is allowed at the start. """
+    result = [ EMPTY_ROWS ]
+    for first, last in reference_bounds(index, reference):
+        # Hits from lo onwards might end in the region, 
+        # hits before hi start before its end
+        lo = first + numpy.searchsorted(index['max_end'][first:last], region[0]-1, side='left')
+        hi = first + numpy.searchsorted(index['start'][first:last], region[1], side='left')
+        result.append(lo + numpy.flatnonzero(index['end'][lo:hi] >= region[0]-1))
+    return numpy.concatenate(result)
+
+def start_selection(index, start, end, reference):
+    """ Positions in a hit file index of hits on the named reference 
+        starting from start up to but not including end. """
+    result = [ EMPTY_ROWS ]
+    for first, last in reference_bounds(index, reference):
+        lo, hi = first + numpy.searchsorted(index['start'][first:last], [start, end])
+        result.append(numpy.arange(lo, hi))
+    return numpy.concatenate(result)
+
+def iter_hit_file_selection(filename, index, selection):
+    """ Hits at the given positions in a hit file index, 
+        as from iter_hit_file, in file order. """
+    order = numpy.argsort(index['offset'][selection])
+    offsets = index['offset'][selection][order].tolist()
+    references = index['reference'][selection][order].tolist()
+    
+    f = hitfile.open_hit_file(filename)
+    for offset, reference in zip(offsets, references):
+        f.seek(offset)
+        if reference < 0:
+            ref_name = None
+        else:
+            ref_name = index['references'][reference]
+        yield (ref_name,) + parse_myrialign_line(f.readline())
+
+def iter_hit_file_region(filename, region, reference=None):
+    """ As iter_hit_file, but only hits overlapping region (start, end), 
+        on the named reference or any reference if None, in file order. 
+        A myrialign file is indexed so that only those hits need be read, 
+        other formats are read in full. """
+    if hit_file_format(filename) != 'myrialign':
+        for item in iter_hit_file(filename):
+            if item[3] < region[1] and item[4] >= region[0]-1 and \
+               (reference is None or item[0] == reference):
+                yield item
+        return
+    
+    index = hit_file_index(filename)
+    for item in iter_hit_file_selection(filename, index, region_selection(index, region, reference)):
+        yield item
+
+
+# Hits are loaded in chunks of this many
+LOAD_CHUNK = 65536
+
+def parse_files_argv(argv):
+    """ Options and files for commands that use read_files. Returns
+        reference name, reference, alignment filenames, clip_start, clip_end. """
     clip_start, argv = get_option_value(argv, '-s', int, 0)
     clip_end, argv = get_option_value(argv, '-e', int, 0)
 
     if len(argv) < 2:
         raise Bad_option('Expected at least two filenames, a reference genome and and alignment file')
 
-    reference = sequence.sequence_file_iterator(argv[0]).next()[1] 
-
-    #read_hits = { }
+    reference_name, reference = sequence.sequence_file_iterator(argv[0]).next()
     
-    hits = Hits()
-
-    #nth = 0
-    for filename in argv[1:]:
-	#for line in open(filename,'rb'):
-        #    if not line.endswith('\n'): continue
-	#    if line.startswith('#'): continue
-	
-	for ref_name, name, forward, start, end, read_ali, ref_ali \
-	        in iter_hit_file(filename):
-
-	    #hit = Hit()
-	    #hit.name, hit.direction, hit.n_errors, span, hit.read_ali, hit.ref_ali = line.rstrip().split()
-	    i = hits.length
-	    hits.resize(i+1)
-	    #hits.name[i], direction, n_errors, span, hits.read_ali[i], hits.ref_ali[i] = line.rstrip().split()
-	    #start, end = span.split('..')
-	    #hits.start[i] = int(start)-1
-	    #hits.end[i] = int(end)
-	    #hits.n_errors[i] = int(n_errors)	    
-	    #hits.forward[i] = (direction == 'fwd')
-	    
-	    hits.name[i] = name
-	    hits.forward[i] = forward
-	    hits.start[i] = start
-	    hits.end[i] = end
-	    hits.read_ali[i] = read_ali
-	    hits.ref_ali[i] = ref_ali
-
-            if clip_start or clip_end:
-	        if hits.forward[i]:
-		    hits.read_ali[i], hits.ref_ali[i], clipped_start, clipped_end = clip_alignment(hits.read_ali[i], hits.ref_ali[i], clip_start, clip_end)
-	        else:
-		    hits.read_ali[i], hits.ref_ali[i], clipped_start, clipped_end = clip_alignment(hits.read_ali[i], hits.ref_ali[i], clip_end, clip_start)
-	        hits.start[i] += clipped_start
-	        hits.end[i] -= clipped_end
-
-	    #if hits.name[i] not in read_hits: 
-        	#read_hits[hit.name] = [ ]
-	    #read_hits[hit.name].append(hit) 
+    return reference_name, reference, argv[1:], clip_start, clip_end
+
+def make_hit_chunk(items, clip_start=0, clip_end=0):
+    """ Columns (names, forwards, starts, ends, read_alis, ref_alis) 
+        from a list of hits as from iter_hit_file, with clipping applied. """
+    ref_names, names, forwards, starts, ends, read_alis, ref_alis = zip(*items)
+    read_alis = list(read_alis)
+    ref_alis = list(ref_alis)
+    starts = numpy.array(starts, 'int32')
+    ends = numpy.array(ends, 'int32')
+    
+    if clip_start or clip_end:
+        for i in xrange(len(items)):
+            if forwards[i]:
+                read_alis[i], ref_alis[i], clipped_start, clipped_end = clip_alignment(read_alis[i], ref_alis[i], clip_start, clip_end)
+            else:
+                read_alis[i], ref_alis[i], clipped_start, clipped_end = clip_alignment(read_alis[i], ref_alis[i], clip_end, clip_start)
+            starts[i] += clipped_start
+            ends[i] -= clipped_end
+    
+    return names, numpy.array(forwards, 'bool'), starts, ends, read_alis, ref_alis
+
+def iter_item_chunks(items, clip_start=0, clip_end=0):
+    """ Hits as from iter_hit_file, in chunks as from make_hit_chunk. """
+    chunk = [ ]
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= LOAD_CHUNK:
+            yield make_hit_chunk(chunk, clip_start, clip_end)
+            chunk = [ ]
+    if chunk:
+        yield make_hit_chunk(chunk, clip_start, clip_end)
+
+
+# Uncompressed alignment files bigger than this are split into byte 
+# ranges of about this size, and parsed by child processes
+PARSE_RANGE_SIZE = 16 << 20
+
+# Number of child processes to parse with, or None for one per CPU
+PARSE_PROCESSES = None
+
+# Ranges parsed ahead of the one being used, per child process
+PARSE_AHEAD = 2
+
+LINE_PARSERS = {
+    'myrialign' : parse_myrialign_lines,
+    'maf' : parse_maf_lines,
+    'eland' : parse_eland_lines,
+}
+
+def hit_file_ranges(filename, kind, range_size):
+    """ Split an uncompressed alignment file into (start, end) byte ranges 
+        of about range_size, each starting at the start of a line, 
+        or for MAF files of an alignment block. """
+    size = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    bounds = [ 0 ]
+    for offset in xrange(range_size, size, range_size):
+        if offset <= bounds[-1]: continue
+        
+        f.seek(offset-1)
+        f.readline()
+        if kind == 'maf':
+            while True:
+                position = f.tell()
+                line = f.readline()
+                if not line or line.startswith('a'): break
+        else:
+            position = f.tell()
+        
+        if position < size:
+            bounds.append(position)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+def parse_range(filename, kind, start, end):
+    """ Hits, as from iter_hit_file, in a range from hit_file_ranges. """
+    f = open(filename, 'rb')
+    f.seek(start)
+    return LINE_PARSERS[kind](cStringIO.StringIO(f.read(end-start)))
+
+def parse_child(argv):
+    """ Child process for iter_hit_file_chunks. """
+    try:
+        while True:
+            try:
+                message, value = children.receive()
+            except EOFError:
+                break
+            
+            filename, kind, start, end, clip_start, clip_end = value
+            for chunk in iter_item_chunks(parse_range(filename, kind, start, end), clip_start, clip_end):
+                children.send(('chunk', chunk))
+            children.send(('done', None))
+        
+        return 0
+    except KeyboardInterrupt:
+        return 1
+
+def iter_hit_file_chunks(filename, clip_start=0, clip_end=0):
+    """ Hits from an alignment file in chunks, as from make_hit_chunk. 
+        Large uncompressed files are parsed in parallel. """
+    kind = hit_file_format(filename)
+    processes = PARSE_PROCESSES
+    if processes is None:
+        import align
+        processes = align.PROCESSES
+    
+    ranges = [ ]
+    if processes > 1 and not hitfile.is_compressed_file(filename):
+        ranges = hit_file_ranges(filename, kind, PARSE_RANGE_SIZE)
+    if len(ranges) < 2:
+        for chunk in iter_item_chunks(iter_hit_file(filename), clip_start, clip_end):
+            yield chunk
+        return
+    
+    workers = [ children.Self_child([sys.executable, sys.argv[0], 'parse-child'])
+                for i in xrange(min(processes, len(ranges))) ]
+    ranges.reverse()
+    in_flight = [ ] # [ [ child, received chunks, done ] ], in file order
+    idle = workers[:]
+    def start_ranges():
+        while idle and ranges and len(in_flight) < PARSE_AHEAD*len(workers):
+            child = idle.pop()
+            start, end = ranges.pop()
+            child.send(('parse', (filename, kind, start, end, clip_start, clip_end)))
+            in_flight.append([ child, [ ], False ])
+    
+    try:
+        start_ranges()
+        n_ranges = 0
+        while in_flight:
+            busy = dict([ (item[0], item) for item in in_flight if not item[2] ])
+            for child in children.wait(busy.keys()):
+                try:
+                    message, value = child.receive()
+                except EOFError:
+                    raise Error('Child process died while parsing %s' % filename)
+                
+                item = busy[child]
+                if message == 'chunk':
+                    item[1].append(value)
+                else:
+                    item[2] = True
+                    idle.append(child)
+            
+            while in_flight and (in_flight[0][1] or in_flight[0][2]):
+                item = in_flight[0]
+                while item[1]:
+                    yield item[1].pop(0)
+                if item[2]:
+                    del in_flight[0]
+            start_ranges()
+    finally:
+        for child in workers:
+            child.close()
+
+def iter_hit_chunks(filenames, clip_start=0, clip_end=0, region=None):
+    """ Hits from alignment files, with clipping applied, in chunks of
+        (names, forwards, starts, ends, read_alis, ref_alis). 
+        If region (start, end) is given, only hits overlapping it. """
+    for filename in filenames:
+        if region is None:
+            chunks = iter_hit_file_chunks(filename, clip_start, clip_end)
+        else:
+            chunks = iter_item_chunks(iter_hit_file_region(filename, region), clip_start, clip_end)
+        for chunk in chunks:
+            yield chunk
+
+def load_hits(filenames, clip_start=0, clip_end=0, region=None, reference=None):
+    """ Load hits into a Hits table, storing alignments as edit scripts
+        against reference if it is given. """
+    hits = Hits(reference)
+    for chunk in iter_hit_chunks(filenames, clip_start, clip_end, region):
+        hits.append_hits(*chunk)
+
+    hits.sort_names()
+    
+    return hits
 
-	    #nth += 1
-	    #if nth % 10000 == 0:
-        	#sys.stderr.write('Loading hits: %d            \r' % nth)
-		#sys.stderr.flush()
+def read_files(argv):
+    reference_name, reference, filenames, clip_start, clip_end = parse_files_argv(argv)
+    return reference, load_hits(filenames, clip_start, clip_end, reference=reference)
+
+
+def name_hashes(names, hash_function=hash):
+    return numpy.array([ hash_function(name) for name in names ], 'int64')
+
+def count_values(values, counts):
+    """ Sum counts for each distinct value. 
+        Returns sorted distinct values and their total counts. """
+    unique, inverse = numpy.unique(values, return_inverse=True)
+    return unique, numpy.bincount(inverse, counts).astype('int64')
+
+def iter_name_hash_chunks(filenames, hash_function=hash):
+    """ Yield arrays of the hashes of the read names of hits in some 
+        alignment files. With stable_hash, the hashes of "myr align" 
+        output are taken from hit_file_index. """
+    for filename in filenames:
+        if hash_function is stable_hash and hit_file_format(filename) == 'myrialign':
+            yield hit_file_index(filename)['name_hash']
+        else:
+            for chunk in iter_hit_file_chunks(filename):
+                yield name_hashes(chunk[0], hash_function)
 
-    hits.you_are_dirty()
+def count_names(filenames, hash_function=hash):
+    """ Number of hits for each read name in some alignment files. 
+    
+        Rather than the names themselves, this returns sorted 64-bit hashes 
+        of the names (from hash_function) and corresponding counts, which 
+        take 16 bytes per read. Reads whose names have the same hash will 
+        be counted together, but this is unlikely. """
+    hashes = numpy.zeros(0, 'int64')
+    counts = numpy.zeros(0, 'int64')
+    pending = [ ] # [ (hashes, counts) ] not yet merged in
+    pending_size = 0
+    for chunk_hashes in iter_name_hash_chunks(filenames, hash_function):
+        pending.append(count_values(chunk_hashes, numpy.ones(len(chunk_hashes), 'int64')))
+        pending_size += len(pending[-1][0])
+        
+        # Merging only once pending has grown as big as the table
+        # keeps the total work proportional to n log n
+        if pending_size >= len(hashes):
+            hashes, counts = count_values(
+                numpy.concatenate([hashes] + [ item[0] for item in pending ]),
+                numpy.concatenate([counts] + [ item[1] for item in pending ]) )
+            pending = [ ]
+            pending_size = 0
+    
+    if pending:
+        hashes, counts = count_values(
+            numpy.concatenate([hashes] + [ item[0] for item in pending ]),
+            numpy.concatenate([counts] + [ item[1] for item in pending ]) )
     
-    return reference, hits
+    return hashes, counts
 
 
+# Hits processed at a time by artplot
+ARTPLOT_CHUNK = 65536
 
+# Column of artplot's base_counts for each character, or -1
+BASE_CODES = numpy.empty(256, 'int64')
+BASE_CODES[:] = -1
+for i, base in enumerate('ATCGN'):
+    BASE_CODES[ord(base)] = i
+del i, base
+
+class Artplot_tracks:
+    """ Weighted coverage, insertion, deletion, substitution and base counts
+        along a reference, accumulated from chunks of hits.
+        
+        Additions are made in the same order as simply looping over each
+        column of each hit would, so that results are identical to the
+        last bit. The first chunk added to a track uses numpy.bincount,
+        later ones numpy.add.at. """
+
+    def __init__(self, size):
+        self.size = size
+        self.coverage = numpy.zeros(size, 'float64')
+        self.insertions = numpy.zeros(size, 'float64')
+        self.deletions = numpy.zeros(size, 'float64')
+        self.substitutions = numpy.zeros(size, 'float64')
+        self.base_counts = numpy.zeros((size,5), 'float64')
+        
+        self.tracks = [ self.coverage, self.insertions, self.deletions, 
+                        self.substitutions, self.base_counts.reshape(size*5) ]
+        self.fresh = [ True ] * len(self.tracks)
+        self.n_hits = 0
+
+    def _accumulate(self, track_no, index, weights):
+        if not len(index): return
+        track = self.tracks[track_no]
+        if self.fresh[track_no]:
+            track[:] = numpy.bincount(index, weights, minlength=len(track))
+            self.fresh[track_no] = False
+        else:
+            numpy.add.at(track, index, weights)
+
+    def add(self, starts, read_alis, ref_alis, weights):
+        """ Add hits given as arrays of starts and weights, 
+            and lists of alignment strings. """
+        self.add_columns(starts, 
+                         numpy.array([ len(item) for item in read_alis ], 'int64'),
+                         numpy.fromstring(''.join(read_alis), 'uint8'),
+                         numpy.fromstring(''.join(ref_alis), 'uint8'),
+                         weights)
+    
+    def add_columns(self, starts, lengths, read_ali, ref_ali, weights):
+        """ Add hits given as arrays of starts, alignment lengths 
+            and weights, and concatenated alignment columns 
+            as from Hits.alignment_columns. """
+        size = self.size
+        
+        column_hit = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        weights = numpy.asarray(weights, 'float64')[column_hit]
+        
+        # Reference position of each column
+        read_gap = (read_ali == GAP)
+        ref_gap = (ref_ali == GAP)
+        advance = read_gap | ~ref_gap
+        advanced = numpy.concatenate(([0], numpy.cumsum(advance)))
+        hit_advanced = advanced[numpy.cumsum(lengths)-lengths]
+        pos = numpy.asarray(starts, 'int64')[column_hit] + advanced[:-1] - hit_advanced[column_hit]
+        
+        in_bounds = (pos >= 0) & (pos < size)
+        deleted = read_gap & in_bounds
+        inserted = ~read_gap & ref_gap & in_bounds
+        aligned = ~read_gap & ~ref_gap & in_bounds
+        covered = deleted | aligned
+        substituted = aligned & (read_ali != ref_ali)
+        
+        bases = BASE_CODES[read_ali[aligned]]
+        if numpy.any(bases < 0):
+            raise KeyError(chr(read_ali[aligned][numpy.flatnonzero(bases < 0)[0]]))
+        
+        self._accumulate(0, pos[covered], weights[covered])
+        self._accumulate(1, pos[inserted], weights[inserted])
+        self._accumulate(2, pos[deleted], weights[deleted])
+        self._accumulate(3, pos[substituted], weights[substituted])
+        self._accumulate(4, pos[aligned]*5 + bases, weights[aligned])
+        
+        self.n_hits += len(lengths)
+        sys.stderr.write('Processing: %d          \r' % self.n_hits)
+        sys.stderr.flush()
+
+TRACK_FORMATS = {
+    'text' : '.txt',
+    'bedgraph' : '.bedgraph',
+    'npy' : '.npy',
+}
+
+def parse_track_format(text):
+    if text not in TRACK_FORMATS:
+        raise ValueError('Unknown output format "%s"' % text)
+    return text
+
+# Track values formatted at a time
+TRACK_WRITE_CHUNK = 1 << 20
+
+def write_text_track(f, array):
+    # Tracks tend to contain many repeats of the same values, 
+    # so format each distinct value once. Values are compared bitwise
+    # to keep -0.0 distinct from 0.0. 
+    # repr of a float is the same as str of a numpy float64.
+    array = numpy.asarray(array, 'float64')
+    for start in xrange(0, len(array), TRACK_WRITE_CHUNK):
+        block = array[start:start+TRACK_WRITE_CHUNK]
+        bits, first, inverse = numpy.unique(block.view('int64'), return_index=True, return_inverse=True)
+        strings = numpy.array(map(repr, block[first].tolist()), 'object')
+        f.write('\n'.join(strings[inverse].tolist()))
+        f.write('\n')
+
+def write_bedgraph_track(f, array, reference_name, track_name):
+    print >> f, 'track type=bedGraph name="%s"' % track_name
+    write_bedgraph_values(f, array, reference_name)
+
+def write_bedgraph_values(f, array, reference_name):
+    """ Lines of a bedGraph track, for runs of equal values. """
+    if not len(array): return
+    starts = numpy.concatenate(([0], numpy.flatnonzero(array[1:] != array[:-1]) + 1))
+    ends = numpy.concatenate((starts[1:], [len(array)]))
+    for block in xrange(0, len(starts), TRACK_WRITE_CHUNK):
+        block_starts = starts[block:block+TRACK_WRITE_CHUNK]
+        f.write(''.join([ '%s\t%d\t%d\t%r\n' % (reference_name, start, end, value)
+                          for start, end, value in zip(block_starts.tolist(), 
+                                                       ends[block:block+TRACK_WRITE_CHUNK].tolist(), 
+                                                       array[block_starts].tolist()) ]))
+
+def write_track(prefix, array, format, reference_name):
+    """ Write prefix + extension in one of TRACK_FORMATS """
+    filename = prefix + TRACK_FORMATS[format]
+    print 'Writing', filename
+    f = open(filename, 'wb')
+    if format == 'text':
+        write_text_track(f, array)
+    elif format == 'bedgraph':
+        write_bedgraph_track(f, array, reference_name, os.path.basename(prefix))
+    else:
+        numpy.save(f, array)
+    f.close()
 
 def artplot(argv):
     try:
         only_single, argv = get_option(argv, '-u')
 	prefix, argv = get_option_value(argv, '-p', lambda x:x, 'artplot')
-        reference, hits = read_files(argv)
+	stream, argv = get_option(argv, '--stream')
+	track_format, argv = get_option_value(argv, '-f', parse_track_format, 'text')
+        reference_name, reference, filenames, clip_start, clip_end = parse_files_argv(argv)
     except Bad_option, error:
         print >> sys.stderr, ''
 	print >> sys.stderr, 'myr artplot [options] <reference genome> <alignments> [<alignments>...]'
@@ -371,72 +1119,71 @@ def artplot(argv):
 	print >> sys.stderr, 'Options:'
 	print >> sys.stderr, ''
         print >> sys.stderr, '    -p xx - Prefix for output files, default "artplot"'
+        print >> sys.stderr, '    -f xx - Output format:'
+        print >> sys.stderr, '              text     - one number per line, for Artemis (default)'
+        print >> sys.stderr, '              bedgraph - runs of equal values, as a bedGraph track'
+        print >> sys.stderr, '              npy      - numpy array file, for numpy.load'
+        print >> sys.stderr, '    --stream'
+        print >> sys.stderr, '          - Read the alignment files twice rather than holding'
+        print >> sys.stderr, '            all hits in memory. Results may differ from normal'
+        print >> sys.stderr, '            in the last few digits, as hits are added in a '
+        print >> sys.stderr, '            different order.'
 	show_default_options()
 	print >> sys.stderr, ''
 	print >> sys.stderr, error[0]
 	return 1
 
     size = len(reference)
-
-    coverage = numpy.zeros(size, 'float64')
-    insertions = numpy.zeros(size, 'float64')
-    deletions = numpy.zeros(size, 'float64')
-    substitutions = numpy.zeros(size, 'float64')
-    base_counts = numpy.zeros((size,5), 'float64')
-    base_map = {'A':0,'T':1,'C':2,'G':3,'N':4}
+    tracks = Artplot_tracks(size)
     
-    nth = 0
-    for group in hits.iter_groups('name'):
-	if only_single and len(group) > 1: continue
-
-	weight = 1.0 / len(group)
-
-	for i in group:    
-	    pos = hits.start[i]
-	    read_ali = hits.read_ali[i]
-	    ref_ali = hits.ref_ali[i]
-	    for j in xrange(len(read_ali)):
-		a = read_ali[j]
-		b = ref_ali[j]
-
-                in_bounds = (0 <= pos < size)
-        	if a == '-':
-		    if in_bounds:
-		        deletions[pos] += weight
-		        coverage[pos] += weight
-		    pos += 1
-		elif b == '-':
-		    if in_bounds:
-		        insertions[pos] += weight
-		else:
-		    if in_bounds:
-		        if a != b:
-	                    substitutions[pos] += weight
-
-	                coverage[pos] += weight
-		        base_counts[pos, base_map[a]] += weight
-		    pos += 1
+    if stream:
+        name_table, name_counts = count_names(filenames)
+        for names, forwards, starts, ends, read_alis, ref_alis in \
+                iter_hit_chunks(filenames, clip_start, clip_end):
+            counts = name_counts[numpy.searchsorted(name_table, name_hashes(names))]
+            if only_single:
+                keep = numpy.flatnonzero(counts == 1)
+                starts = starts[keep]
+                read_alis = [ read_alis[i] for i in keep ]
+                ref_alis = [ ref_alis[i] for i in keep ]
+                counts = counts[keep]
+            tracks.add(starts, read_alis, ref_alis, 1.0 / counts)
+    else:
+        hits = load_hits(filenames, clip_start, clip_end, reference=reference)
+        
+        # Hits in the order they are to be added, and their weights
+        order = hits.index('name')
+        group_sizes = numpy.diff(numpy.concatenate((
+            [0], numpy.flatnonzero(hits.name[order][1:] != hits.name[order][:-1]) + 1, [len(order)] )))
+        hit_group_sizes = numpy.repeat(group_sizes, group_sizes)
+        if only_single:
+            order = order[hit_group_sizes == 1]
+            hit_group_sizes = hit_group_sizes[hit_group_sizes == 1]
+        hit_weights = 1.0 / hit_group_sizes
+        
+        for chunk_start in xrange(0, len(order), ARTPLOT_CHUNK):
+            chunk = order[chunk_start:chunk_start+ARTPLOT_CHUNK]
+            lengths, read_ali, ref_ali = hits.alignment_columns(chunk)
+            tracks.add_columns(hits.start[chunk], lengths, read_ali, ref_ali,
+                               hit_weights[chunk_start:chunk_start+ARTPLOT_CHUNK])
 
-	    nth += 1
-	    if nth % 10000 == 0:
-        	sys.stderr.write('Processing: %d          \r' % nth)
-		sys.stderr.flush()
+    sys.stderr.write(' %d hits\n' % tracks.n_hits)
 
-    sys.stderr.write(' %d hits\n' % nth)
+    coverage = tracks.coverage
+    insertions = tracks.insertions
+    deletions = tracks.deletions
+    substitutions = tracks.substitutions
+    base_counts = tracks.base_counts
 
     def save(filename, array):
-	print 'Writing', filename
-	f = open(filename, 'wb')
-	for i in array:
-            print >> f, i
-	f.close()
+        write_track(filename, array, track_format, reference_name)
 
     normalizer = numpy.maximum(1.0, coverage)
 
-    save(prefix+'-coverage.txt', coverage)
-    save(prefix+'-insertions.txt', insertions / normalizer)
-    save(prefix+'-deletions.txt', deletions / normalizer)
-    save(prefix+'-substitutions.txt', substitutions / normalizer)
+    save(prefix+'-coverage', coverage)
+    save(prefix+'-insertions', insertions / normalizer)
+    save(prefix+'-deletions', deletions / normalizer)
+    save(prefix+'-substitutions', substitutions / normalizer)
     
     base_counts = base_counts[:,:4]
     base_total = numpy.sum(base_counts, 1)
@@ -447,13 +1194,16 @@ def artplot(argv):
     entropy = numpy.zeros(size, 'float64')
     good = base_total > 0
     entropy[good] = numpy.sum(base_counts[good,:] * surprise[good,:], 1) / base_total[good]
-    save(prefix+'-confusion.txt', entropy)
+    save(prefix+'-confusion', entropy)
 
 
 def textdump(argv):
     try:
         only_single, argv = get_option(argv, '-u')
-        reference, hits = read_files(argv)
+        region, argv = get_option_value(argv, '--region', parse_region, None)
+        reference_name, reference, filenames, clip_start, clip_end = parse_files_argv(argv)
+        if region is not None and region[0] >= len(reference):
+            raise Bad_option('Region starts beyond the end of the reference (%d bases)' % len(reference))
     except Bad_option, error:
         print >> sys.stderr, ''
 	print >> sys.stderr, 'myr textdump [options] <reference genome> <alignments> [<alignments>...]'
@@ -463,16 +1213,39 @@ def textdump(argv):
 	print >> sys.stderr, ''
 	print >> sys.stderr, 'Options:'
 	print >> sys.stderr, ''
+	print >> sys.stderr, '    --region start..end'
+	print >> sys.stderr, '          - Only show this part of the reference (counting from 1).'
+	print >> sys.stderr, '            "myr align" output files are indexed on first use,'
+	print >> sys.stderr, '            so that only hits in the region need to be read.'
+	print >> sys.stderr, '            Hits may be placed in different columns than when'
+	print >> sys.stderr, '            showing the whole reference.'
 	show_default_options()
 	print >> sys.stderr, ''
 	print >> sys.stderr, error[0]
 	return 1
 
     size = len(reference)
+    
+    if region is None:
+        region = (0, size)
+        hits = load_hits(filenames, clip_start, clip_end, reference=reference)
+        name_hit_counts = numpy.bincount(hits.name[:hits.length], minlength=len(hits.names))
+    else:
+        region = (region[0], min(region[1], size))
+        hits = load_hits(filenames, clip_start, clip_end, region, reference)
+        if only_single:
+            name_table, name_counts = count_names(filenames, stable_hash)
+            name_hit_counts = name_counts[numpy.searchsorted(
+                name_table, name_hashes(hits.names, stable_hash))]
+
+    # Hits starting before the region may still be showing in it
+    scan_start = region[0]
+    if hits.length:
+        scan_start = min(scan_start, max(0, numpy.min(hits.start[:hits.length])))
 
     todo = { }
     for group in hits.iter_groups('name'):
-        if only_single and len(group) > 1: continue	
+        if only_single and name_hit_counts[hits.name[group[0]]] > 1: continue	
 	
 	for i in group:
 	    if hits.start[i] not in todo: 
@@ -491,14 +1264,16 @@ def textdump(argv):
     pad = ' '*5
 
     total_with_a_hit = 0    
-    for pos, ref_nuc in enumerate(sequence.string_from_sequence(reference)):    
+    for pos, ref_nuc in enumerate(sequence.string_from_sequence(reference[scan_start:region[1]])):    
+        pos += scan_start
         while lanes and lanes[-1] is None:
 	    del lanes[-1]
     
         if pos in todo:
 	    for i in todo[pos]:
 	        lane_no = find_lane()
-		lanes[lane_no] = [hits.ref_ali[i]+pad,hits.read_ali[i]+pad]
+		read_ali, ref_ali = hits.alignment(i)
+		lanes[lane_no] = [ref_ali+pad,read_ali+pad]
 
         to_show = [ ref_nuc ]
 	
@@ -528,6 +1303,9 @@ def textdump(argv):
 	for item in counts:
 	    if not consensus or counts[item] > counts[consensus]: #TODO: what if equal?
 	        consensus = item
+	
+	if pos < region[0]:
+	    continue
 		
         interesting = False
 	confusing = False
@@ -566,7 +1344,7 @@ def textdump(argv):
 		    print ' '*9,
 		print row[0], ((confusing and ' ?') or (interesting and '! ') or '  '), ''.join(row[1:])
 
-    print >> sys.stderr, 'Proportion of reference with at least one hit: %.2f%%' % ( 100.0*float(total_with_a_hit)/len(reference) )
+    print >> sys.stderr, 'Proportion of reference with at least one hit: %.2f%%' % ( 100.0*float(total_with_a_hit)/(region[1]-region[0]) )
 
 
 
@@ -597,70 +1375,170 @@ Tables:
 
 
 
-class Manymany:
+class Dense_ids:
+    """ Compact integer ids for hashable items, so that per-item data 
+        can be kept in lists indexed by id. """
+    
+    def __init__(self):
+        self.ids = { }
+        self.items = [ ]
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __contains__(self, item):
+        return item in self.ids
+    
+    def id(self, item):
+        """ Id of item, allocating a new one if need be. """
+        result = self.ids.get(item)
+        if result is None:
+            result = self.ids[item] = len(self.items)
+            self.items.append(item)
+        return result
+
+
+class Manymany(Dense_ids):
+    """ Many to many links between items. Links are kept as sets of ids in 
+        lists indexed by id, None where the item's side has not been created. 
+        Sets are only made once there is something to put in them. """
+
     def __init__(self):
-        self.forward = { }
-        self.back = { }
+        Dense_ids.__init__(self)
+        self.forward = [ ]
+        self.back = [ ]
+    
+    def id(self, item):
+        result = Dense_ids.id(self, item)
+        if result == len(self.forward):
+            self.forward.append(None)
+            self.back.append(None)
+        return result
     
     def create_forward(self, item):
-        if item not in self.forward: 
-            self.forward[item] = sets.Set()
+        i = self.id(item)
+        if self.forward[i] is None: 
+            self.forward[i] = ()
     
     def create_back(self, item):
-        if item not in self.back:
-            self.back[item] = sets.Set()
+        i = self.id(item)
+        if self.back[i] is None:
+            self.back[i] = ()
     
     def create(self, item):
-        self.create_forward(item)
-        self.create_back(item)
+        i = self.id(item)
+        if self.forward[i] is None: 
+            self.forward[i] = ()
+        if self.back[i] is None:
+            self.back[i] = ()
 
     def destroy_forward(self, item):
-        assert not self.forward[item]
-        del self.forward[item]
+        i = self.ids[item]
+        assert not self.forward[i]
+        self.forward[i] = None
 
     def destroy_back(self, item):
-        assert not self.back[item]
-        del self.back[item]
+        i = self.ids[item]
+        assert not self.back[i]
+        self.back[i] = None
           
     def destroy(self, item):
         self.destroy_forward(item)
         self.destroy_back(item)
     
     def link(self, a, b):
-        self.forward[a].add(b)
-        self.back[b].add(a)
+        a = self.ids[a]
+        b = self.ids[b]
+        forward = self.forward[a]
+        if not forward:
+            assert forward is not None, 'Linking from an item not created'
+            forward = self.forward[a] = set()
+        back = self.back[b]
+        if not back:
+            assert back is not None, 'Linking to an item not created'
+            back = self.back[b] = set()
+        forward.add(b)
+        back.add(a)
         
     def unlink(self, a, b):
+        a = self.ids[a]
+        b = self.ids[b]
         self.forward[a].remove(b)
         self.back[b].remove(a)
+    
+    def successors(self, item):
+        items = self.items
+        return [ items[i] for i in self.forward[self.ids[item]] ]
+    
+    def predecessors(self, item):
+        items = self.items
+        return [ items[i] for i in self.back[self.ids[item]] ]
         
 
-class Union:
+class Union(Dense_ids):
+    """ Union-find over items, using union by rank and path compression
+        on lists indexed by id. """
+    
     def __init__(self):
-        self.parent = { }
+        Dense_ids.__init__(self)
+        self.parent = [ ]
+        self.rank = [ ]
     
     def create(self, item):
-        if item not in self.parent:
-	    self.parent[item] = item
+        i = self.ids.get(item)
+        if i is None:
+            i = self.ids[item] = len(self.items)
+            self.items.append(item)
+            self.parent.append(i)
+            self.rank.append(0)
+        return i
+    
+    def root_id(self, i):
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
     
     def root(self, item):
-        if self.parent[item] == item:
-	    return item
-	self.parent[item] = self.root(self.parent[item])
-	return self.parent[item]
+        return self.items[self.root_id(self.ids[item])]
+    
+    def merge_ids(self, a, b):
+        parent = self.parent
+        if parent[a] != a: 
+            a = self.root_id(a)
+        if parent[b] != b: 
+            b = self.root_id(b)
+        if a == b: 
+            return
+        rank = self.rank
+        if rank[a] > rank[b]:
+            a, b = b, a
+        parent[a] = b
+        if rank[a] == rank[b]:
+            rank[b] += 1
 	
     def merge_if_created(self, a,b):
-        if a in self.parent and b in self.parent:
-            self.parent[self.root(a)] = self.root(b)
+        ids = self.ids
+        a = ids.get(a)
+        b = ids.get(b)
+        if a is not None and b is not None:
+            self.merge_ids(a, b)
     
     def sets(self):
+        """ Lists of items in each set, ordered by their first created item. """
         results = { }
-        for item in self.parent:
-	    root = self.root(item)
-	    if root not in results:
-	        results[root] = sets.Set()
-	    results[root].add(item)
-	return list(results.values())
+        ordered = [ ]
+        items = self.items
+        for i in xrange(len(items)):
+            root = self.root_id(i)
+            if root not in results:
+                results[root] = [ ]
+                ordered.append(results[root])
+            results[root].append(items[i])
+        return ordered
 
 
 FORWARD_MASK = numpy.uint64( (1<<31) )
@@ -672,6 +1550,12 @@ SEQUENCE_SHIFT = numpy.uint64(32)
 def make_location(seq_id, is_forward, position):
     return (numpy.uint64(seq_id) << SEQUENCE_SHIFT) + (is_forward and FORWARD_MASK or ZERO_UINT64) + numpy.uint64(position)
 
+def make_locations(seq_ids, forwards, positions):
+    """ make_location, for arrays """
+    return ( (numpy.asarray(seq_ids).astype('uint64') << SEQUENCE_SHIFT) + 
+             numpy.where(forwards, FORWARD_MASK, ZERO_UINT64) + 
+             numpy.asarray(positions).astype('uint64') )
+
 def location_parts(location):
     return location>>SEQUENCE_SHIFT, bool(location&FORWARD_MASK), location&POSITION_MASK
 
@@ -697,21 +1581,198 @@ class Alignments(Table):
         ('type', 'object'),
     )
 
-class Base_links(Table):
+class Alignment_blocks(Table):
+    """ Gap-free stretches of alignments. Location location1 moved by k
+        is aligned to location2 moved by k, for 0 <= k < size, moving 
+        along each strand as location_next does. 
+        
+        low1 and low2 are the lowest location on each side, so each side
+        covers the locations low to low+size-1. """
+    
     MEMBERS = (
         ('location1', 'uint64'),
-	('location2', 'uint64'),
-	('alignment', 'uint32'),
+        ('location2', 'uint64'),
+        ('low1', 'uint64'),
+        ('low2', 'uint64'),
+        ('size', 'uint64'),
+        ('alignment', 'uint32'),
     )
+    
+    def __init__(self):
+        Table.__init__(self)
+        self.interval_indicies = { } # name -> (order, running maximum of low+size)
+    
+    def _intervals(self, name):
+        """ Blocks sorted by low value, and the running maximum 
+            of their high values. """
+        order, lows = self._sorted(name)
+        if name not in self.interval_indicies or \
+                self.interval_indicies[name][0] is not order:
+            highs = lows + self.size[order]
+            self.interval_indicies[name] = (order, numpy.maximum.accumulate(highs))
+        return order, lows, self.interval_indicies[name][1]
+    
+    def find_overlapping(self, name, values):
+        """ Blocks where column name (low1 or low2) is at most values[i] 
+            and low+size is more than it. Returns rows, and which value 
+            each row matched, ordered by value then by row. """
+        order, lows, max_highs = self._intervals(name)
+        values = numpy.asarray(values, 'uint64')
+        
+        # Blocks before starts[i] end too soon, those from ends[i] on start too late
+        starts = numpy.searchsorted(max_highs, values, side='right')
+        ends = numpy.maximum(starts, numpy.searchsorted(lows, values, side='right'))
+        positions, which = expand_ranges(starts, ends)
+        rows = order[positions]
+        keep = lows[positions] + self.size[rows] > values[which]
+        rows = rows[keep]
+        which = which[keep]
+        resort = numpy.lexsort((rows, which))
+        return rows[resort], which[resort]
+    
+    def linked(self, values):
+        """ Locations aligned to each of an array of locations. Returns 
+            linked locations and which value each links from, ordered by 
+            value, then those found from location1, then by row. """
+        values = numpy.asarray(values, 'uint64')
+        results = [ ]
+        for side, (here, there) in enumerate([ ('location1','location2'), ('location2','location1') ]):
+            rows, which = self.find_overlapping(here.replace('location','low'), values)
+            here = self.__dict__[here][rows]
+            there = self.__dict__[there][rows]
+            offset = numpy.where(here & FORWARD_MASK, values[which]-here, here-values[which])
+            results.append((
+                which, 
+                numpy.zeros(len(rows),'int') + side, 
+                rows, 
+                numpy.where(there & FORWARD_MASK, there+offset, there-offset)
+            ))
+        
+        which, sides, rows, locations = [ numpy.concatenate(item) for item in zip(*results) ]
+        order = numpy.lexsort((rows, sides, which))
+        return locations[order], which[order]
+
+
+
+VELVET_GRAPH_VERSION = 1
+
+def velvet_graph(directory):
+    """ Nodes and arcs of a Velvet assembly, from LastGraph and stats.txt
+        in directory, parsed once and then cached.
+        
+        Returns a dict of:
+        tail_size - hash length - 1
+        node_id - Velvet's node numbers
+        coverage - of each node, summed over read categories
+        sequence - node sequences, concatenated, with bases where the
+                   node and its twin disagree set to N
+        node_start - where each node's sequence starts, and a final end
+        arc_from, arc_to - node numbers, negative for the twin node """
+    filesigs = (cache.file_signature(os.path.join(directory,'LastGraph')),
+                cache.file_signature(os.path.join(directory,'stats.txt')))
+    
+    def callback(working_dir):
+        coverage = { }
+        f = open(filesigs[1][0], 'rb')
+        f.readline()
+        for line in f:
+            parts = line.split()
+            if not parts: continue
+            coverage[int(parts[0])] = float(parts[4])+float(parts[5])+float(parts[7])
+        
+        lines = open(filesigs[0][0], 'rb').read().split('\n')
+        tail_size = int(lines[0].split()[2]) - 1
+        
+        node_lines = [ i for i, line in enumerate(lines) if line.startswith('NODE') ]
+        node_ids = numpy.array([ int(lines[i].split()[1]) for i in node_lines ], 'int64')
+        
+        # Ends of k-mers of each node and its twin, short ones padded with N
+        fwds = [ lines[i+1].strip() for i in node_lines ]
+        fwds = [ 'N'*(tail_size-len(item)) + item for item in fwds ]
+        revs = [ lines[i+2].strip() for i in node_lines ]
+        revs = [ 'N'*(tail_size-len(item)) + item for item in revs ]
+        lengths = numpy.array([ len(item) for item in fwds ], 'int64')
+        assert numpy.all(lengths == [ len(item) for item in revs ]), 'Node and twin differ in length'
+        starts = numpy.cumsum(lengths) - lengths
+        fwd = sequence.sequence_from_string(''.join(fwds))
+        rev = sequence.sequence_from_string(''.join(revs))
+        
+        # Reverse complement each twin in place
+        rev = sequence.COMPLEMENT[rev[
+            numpy.repeat(2*starts+lengths-1, lengths) - numpy.arange(len(rev)) ]]
+        
+        # Node is the twin's first tail_size bases, then the bases the 
+        # node and its twin agree on, then the node's last tail_size bases
+        out_lengths = lengths + tail_size
+        out_starts = numpy.cumsum(out_lengths) - out_lengths
+        offsets = numpy.arange(numpy.sum(out_lengths)) - numpy.repeat(out_starts, out_lengths)
+        node_starts = numpy.repeat(starts, out_lengths)
+        node_lengths = numpy.repeat(lengths, out_lengths)
+        from_rev = rev[node_starts + numpy.minimum(offsets, node_lengths-1)]
+        from_fwd = fwd[node_starts + numpy.maximum(offsets-tail_size, 0)]
+        seq = numpy.where(offsets < tail_size, from_rev,
+              numpy.where(offsets >= node_lengths, from_fwd,
+              numpy.where(from_rev == from_fwd, from_rev, 4))).astype('uint8')
+        
+        arcs = [ line.split() for line in lines if line.startswith('ARC') ]
+        
+        columns = {
+            'tail_size' : numpy.array([ tail_size ]),
+            'node_id' : node_ids,
+            'coverage' : numpy.array([ coverage[item] for item in node_ids.tolist() ], 'float64'),
+            'sequence' : seq,
+            'node_start' : numpy.concatenate(([0], numpy.cumsum(out_lengths))),
+            'arc_from' : numpy.array([ int(item[1]) for item in arcs ], 'int64'),
+            'arc_to' : numpy.array([ int(item[2]) for item in arcs ], 'int64'),
+        }
+        for name in columns:
+            numpy.save(os.path.join(working_dir, name + '.npy'), columns[name])
+    
+    directory = cache.get(('velvet_graph', VELVET_GRAPH_VERSION, filesigs), callback)
+    
+    result = { }
+    for name in ('node_id', 'coverage', 'sequence', 'node_start', 'arc_from', 'arc_to'):
+        result[name] = numpy.load(os.path.join(directory, name + '.npy'))
+    result['tail_size'] = int(numpy.load(os.path.join(directory, 'tail_size.npy'))[0])
+    return result
+
+
+# Locations whose links Browser.show looks up at a time
+LINK_WINDOW = 64
 
+# Browser.linked_locations forgets everything beyond this many locations
+LINK_CACHE_SIZE = 1 << 20
 
+# Extra distance laid out around the cursor by Browser.show
+LAYOUT_MARGIN = 20
+
+# "myr align" output is loaded by the browser in bins of this many
+# bases of reference, as the cursor comes near
+BROWSE_BIN_SIZE = 4096
+
+# Bins further than this from the cursor are unloaded
+BROWSE_KEEP_DISTANCE = 4 * BROWSE_BIN_SIZE
+
+class Layout: 
+    """ See Browser.lay_out """
+    pass
 
 class Browser:
     def __init__(self):
         self.sequences = Sequences()
 	self.name_to_sequence = { }
 	self.alignments = Alignments()
-	self.base_links = Base_links()
+	self.blocks = Alignment_blocks()
+	
+	self.links = { }
+	self.links_size = 0
+	self.layout = None
+	self.screen_lines = None
+	
+	self.lazy_files = [ ] # [ (filename, index, longest hit) ]
+	self.bins = { } # (file number, reference name, bin) -> (first alignment, end alignment, read sequence ids)
+	self.read_users = { } # read sequence id -> number of loaded bins using it
+	self.free_sequences = [ ] # sequence ids of unloaded reads, for reuse
 	
     def open_screen(self):
 	import curses
@@ -752,11 +1813,13 @@ class Browser:
 	return pos < len(self.sequences.sequence[seq])
 	
     def add_sequence(self, name, sequence, comment=''):
-        i = self.sequences.new_id()
+        if self.free_sequences:
+            i = self.free_sequences.pop()
+        else:
+            i = self.sequences.new_id()
 	self.sequences.name[i] = name
 	self.sequences.sequence[i] = sequence
 	self.sequences.comment[i] = comment
-	self.sequences.you_are_dirty()
 	self.name_to_sequence[name] = i
 	return i
 
@@ -785,60 +1848,262 @@ class Browser:
 	self.alignments.type[ali] = type
 	
         assert len(ali1) == len(ali2)
-
-	i = 0
-	if len(ali1):
-	    while True:
-		if ali1[i] != '-' and ali2[i] != '-':
-	            link = self.base_links.new_id()
-		    assert self.valid_location(location1), 'Bad alignment %d <%s>-%s' % (i,name1,name2)
-		    assert self.valid_location(location2), 'Bad alignment %d %s-<%s>' % (i,name1,name2)
-		    self.base_links.location1[link] = location1
-		    self.base_links.location2[link] = location2
-		    self.base_links.alignment[link] = ali
-
-		if i == len(ali1)-1:
-	            break
-
-		if ali1[i] != '-':
-	            location1 = location_next(location1)
-		if ali2[i] != '-':
-	            location2 = location_next(location2)
-
-		i += 1
+        
+        # Runs of columns where neither side has a gap become blocks
+        real1 = numpy.fromstring(ali1, 'uint8') != GAP
+        real2 = numpy.fromstring(ali2, 'uint8') != GAP
+        both = real1 & real2
+        before = numpy.concatenate(([False], both[:-1]))
+        after = numpy.concatenate((both[1:], [False]))
+        block_starts = numpy.flatnonzero(both & ~before)
+        sizes = (numpy.flatnonzero(both & ~after) + 1 - block_starts).astype('uint64')
+        
+        columns = { 
+            'size' : sizes, 
+            'alignment' : numpy.zeros(len(sizes),'uint32') + ali,
+        }
+        for i, location, real, seq, name in [ (1, location1, real1, seq1, '<%s>-%s' % (name1,name2)),
+                                              (2, location2, real2, seq2, '%s-<%s>' % (name1,name2)) ]:
+            # Bases of this side before each block start
+            offsets = (numpy.cumsum(real) - real)[block_starts].astype('uint64')
+            if location & FORWARD_MASK:
+                firsts = location + offsets
+                lows = firsts
+            else:
+                firsts = location - offsets
+                lows = firsts - (sizes - ONE_UINT64)
+            
+            length = len(self.sequences.sequence[seq])
+            bad = ((lows & POSITION_MASK) >= length) | (((lows + sizes - ONE_UINT64) & POSITION_MASK) >= length)
+            assert not numpy.any(bad), 'Bad alignment %d %s' % (block_starts[numpy.argmax(bad)], name)
+            
+            columns['location%d' % i] = firsts
+            columns['low%d' % i] = lows
+        
+        self.blocks.append(columns)
 	
-	self.alignments.you_are_dirty()
-	self.base_links.you_are_dirty()
 	return ali
 
+    def links_near(self, location):
+        """ Locations aligned to location and to its neighbours on the same
+            strand, as { location : [ linked locations ] }. Links to the 
+            reverse complement of a location apply to it, flipped. """
+        seq, forward, pos = location_parts(location)
+        start = max(0, int(pos)-LINK_WINDOW//2)
+        end = min(len(self.sequences.sequence[seq]), start+LINK_WINDOW)
+        locations = make_location(seq, forward, numpy.arange(start, end).astype('uint64'))
+        n = len(locations)
+        
+        linked, which = self.blocks.linked(numpy.concatenate((locations, locations^FORWARD_MASK)))
+        flipped = linked ^ FORWARD_MASK
+        bounds = numpy.searchsorted(which, numpy.arange(2*n+1))
+        result = { }
+        for i in xrange(n):
+            result[locations[i]] = list(linked[bounds[i]:bounds[i+1]]) + list(flipped[bounds[n+i]:bounds[n+i+1]])
+        return result
+
     def load_sequences(self, filename):
         for name, seq in sequence.sequence_file_iterator(filename):
 	    self.add_sequence(name, seq)
 
-    def load_myr_hits(self, filename):
-	for ref_name, name, forward, start, end, read_ali, ref_ali \
-	        in iter_hit_file(filename):
+    def add_gapless_alignments(self, type, locations1, locations2, size):
+        """ Add many alignments of size bases without gaps, 
+            from arrays of their first locations. """
+        n = len(locations1)
+        first = self.alignments.append({ 'type' : [ type ]*n })
+        sizes = numpy.zeros(n, 'uint64') + numpy.uint64(size)
+        columns = { 
+            'location1' : locations1,
+            'location2' : locations2,
+            'size' : sizes,
+            'alignment' : numpy.arange(first, first+n).astype('uint32'),
+        }
+        for i, locations in [ (1, locations1), (2, locations2) ]:
+            columns['low%d' % i] = numpy.where(locations & FORWARD_MASK, 
+                                               locations, locations - (sizes - ONE_UINT64))
+        self.blocks.append(columns)
+
+    def add_myr_hits(self, ref_name, chunk):
+        """ Add hits on one reference, given as a chunk from iter_item_chunks, 
+            and the reads' sequences if they are not already loaded. 
+            Returns the reads' sequence ids, and whether each was added. """
+        try:
+            ref_seq = self.name_to_sequence[ref_name]
+        except KeyError:
+            raise Error('Sequence "%s" referenced by an alignment has not been loaded' % ref_name)
+        
+        hits = Hits(self.sequences.sequence[ref_seq])
+        hits.append_hits(*chunk)
+        n = hits.length
+        lengths, read_ali, ref_ali = hits.alignment_columns(numpy.arange(n))
+        forwards = hits.forward[:n]
+        read_real = read_ali != GAP
+        ref_real = ref_ali != GAP
+        which = numpy.repeat(numpy.arange(n), lengths)
+        offsets = numpy.cumsum(lengths) - lengths
+        
+        read_lengths = numpy.bincount(which[read_real], minlength=n)
+        read_ends = numpy.cumsum(read_lengths)
+        read_text = read_ali[read_real].tostring()
+        seq_ids = numpy.empty(n, 'int64')
+        added = numpy.zeros(n, 'bool')
+        for i in xrange(n):
+            name = hits.names[hits.name[i]]
+            seq_id = self.name_to_sequence.get(name)
+            if seq_id is None:
+                seq = sequence.sequence_from_string(read_text[read_ends[i]-read_lengths[i]:read_ends[i]])
+                if not forwards[i]:
+                    seq = sequence.reverse_complement(seq)
+                seq_id = self.add_sequence(name, seq)
+                added[i] = True
+            seq_ids[i] = seq_id
+        
+        first = self.alignments.append({ 'type' : [ 'myr align' ]*n })
+        
+        # Runs of columns within a hit where neither side has a gap become blocks
+        both = read_real & ref_real
+        hit_firsts = numpy.zeros(len(both), 'bool')
+        hit_firsts[offsets[lengths > 0]] = True
+        hit_lasts = numpy.zeros(len(both), 'bool')
+        hit_lasts[(offsets+lengths-1)[lengths > 0]] = True
+        before = numpy.concatenate(([False], both[:-1])) & ~hit_firsts
+        after = numpy.concatenate((both[1:], [False])) & ~hit_lasts
+        block_starts = numpy.flatnonzero(both & ~before)
+        sizes = (numpy.flatnonzero(both & ~after) + 1 - block_starts).astype('uint64')
+        block_hits = which[block_starts]
+        
+        columns = {
+            'size' : sizes,
+            'alignment' : (first + block_hits).astype('uint32'),
+        }
+        sides = [ 
+            (1, ref_real, make_locations(ref_seq, True, hits.start[:n]), 
+             len(self.sequences.sequence[ref_seq])),
+            (2, read_real, make_locations(seq_ids, forwards, numpy.where(forwards, 0, read_lengths-1)),
+             read_lengths[block_hits]),
+        ]
+        for i, real, locations, length in sides:
+            # Bases of this side of the hit before each block start
+            counted = numpy.concatenate(([0], numpy.cumsum(real)))
+            before_block = (counted[block_starts] - counted[offsets][block_hits]).astype('uint64')
+            locations = locations[block_hits]
+            forward = (locations & FORWARD_MASK) != ZERO_UINT64
+            firsts = numpy.where(forward, locations + before_block, locations - before_block)
+            lows = numpy.where(forward, firsts, firsts - (sizes - ONE_UINT64))
+            
+            bad = ((lows & POSITION_MASK) >= length) | (((lows + sizes - ONE_UINT64) & POSITION_MASK) >= length)
+            assert not numpy.any(bad), 'Bad alignment of %s' % hits.names[hits.name[block_hits[numpy.argmax(bad)]]]
+            
+            columns['location%d' % i] = firsts
+            columns['low%d' % i] = lows
+        
+        self.blocks.append(columns)
+        
+        return seq_ids, added
+    
+    def add_myr_hit_items(self, items):
+        """ Add hits as from iter_hit_file, see add_myr_hits. """
+        seq_ids = [ ]
+        added = [ ]
+        for ref_name, group in itertools.groupby(items, lambda item: item[0]):
+            for chunk in iter_item_chunks(group):
+                chunk_seq_ids, chunk_added = self.add_myr_hits(ref_name, chunk)
+                seq_ids.extend(chunk_seq_ids.tolist())
+                added.extend(chunk_added.tolist())
+        return seq_ids, added
 
-	    if name not in self.name_to_sequence:
-	        seq = sequence.sequence_from_string(read_ali.replace('-',''))
-		if not forward:
-		    seq = sequence.reverse_complement(seq)
-		self.add_sequence(name, seq)		
+    def load_myr_hits(self, filename):
+        self.add_myr_hit_items(iter_hit_file(filename))
+
+    def open_myr_hits(self, filename):
+        """ Use a "myr align" output file, loading hits from it 
+            as the cursor comes near them and forgetting them, with their
+            reads, as it moves away (see load_near). """
+        index = hit_file_index(filename)
+        longest = 0
+        if len(index['start']):
+            longest = int(numpy.max(index['end'] - index['start']))
+        self.lazy_files.append((filename, index, longest))
+
+    def load_near(self, location):
+        """ If location is on a reference in files opened with open_myr_hits,
+            load the bins of hits near it and unload those far from it. """
+        seq, forward, pos = location_parts(location)
+        ref_name = self.sequences.name[seq]
+        pos = int(pos)
+        wanted = [ ]
+        for file_no, (filename, index, longest) in enumerate(self.lazy_files):
+            if ref_name not in index['references']: continue
+            first_bin = max(0, pos - BROWSE_BIN_SIZE//2 - longest) // BROWSE_BIN_SIZE
+            last_bin = (pos + BROWSE_BIN_SIZE//2) // BROWSE_BIN_SIZE
+            for bin in xrange(first_bin, last_bin+1):
+                wanted.append((file_no, ref_name, bin))
+        if not wanted: 
+            return
+        
+        unwanted = [ ]
+        for key in self.bins:
+            file_no, bin_ref_name, bin = key
+            distance = max(0, bin*BROWSE_BIN_SIZE - pos, pos - (bin+1)*BROWSE_BIN_SIZE)
+            if bin_ref_name != ref_name or distance > BROWSE_KEEP_DISTANCE:
+                unwanted.append(key)
+        wanted = [ key for key in wanted if key not in self.bins ]
+        if not wanted and not unwanted:
+            return
+        
+        for key in unwanted:
+            self.unload_bin(key)
+        for key in wanted:
+            self.load_bin(key)
+        
+        self.links = { }
+        self.layout = None
 
-	    seq = self.sequences.sequence[self.name_to_sequence[name]]
-	    
-	    self.add_alignment('myr align',
-	        ref_name, True, start, ref_ali,
-		name, forward, 0, read_ali)
-		
-	    #if forward:
-	    #    read_start = 0
-	    #else:
-	    #    read_start = len(seq)-1
-	    
-	    #self.add_alignment('myr align',
-	    #    ref_name, True, start, ref_ali,
-	#	name, forward, read_start, read_ali)
+    def load_bin(self, key):
+        file_no, ref_name, bin = key
+        filename, index, longest = self.lazy_files[file_no]
+        selection = start_selection(index, bin*BROWSE_BIN_SIZE, (bin+1)*BROWSE_BIN_SIZE, ref_name)
+        
+        first_alignment = self.alignments.length
+        reads = [ ]
+        seq_ids, added = self.add_myr_hit_items(iter_hit_file_selection(filename, index, selection))
+        for seq_id, was_added in zip(seq_ids, added):
+            if was_added or seq_id in self.read_users:
+                self.read_users[seq_id] = self.read_users.get(seq_id,0) + 1
+                reads.append(seq_id)
+        
+        self.bins[key] = (first_alignment, self.alignments.length, reads)
+
+    def unload_bin(self, key):
+        """ Forget the alignments of a bin, and any read sequences 
+            no longer used by a loaded bin. 
+            
+            Later alignments are renumbered to fill the gap, and the 
+            ids of forgotten reads are reused by add_sequence. """
+        first_alignment, end_alignment, reads = self.bins.pop(key)
+        n = end_alignment - first_alignment
+        
+        alignment = self.blocks.alignment[:self.blocks.length]
+        self.blocks.keep_rows(numpy.flatnonzero(
+            (alignment < first_alignment) | (alignment >= end_alignment) ))
+        alignment = self.blocks.alignment
+        alignment[alignment >= end_alignment] -= n
+        
+        self.alignments.keep_rows(numpy.concatenate((
+            numpy.arange(first_alignment), 
+            numpy.arange(end_alignment, self.alignments.length) )))
+        for other_key, (first, end, other_reads) in self.bins.items():
+            if first >= end_alignment:
+                self.bins[other_key] = (first-n, end-n, other_reads)
+        
+        for seq_id in reads:
+            self.read_users[seq_id] -= 1
+            if not self.read_users[seq_id]:
+                del self.read_users[seq_id]
+                del self.name_to_sequence[self.sequences.name[seq_id]]
+                self.sequences.name[seq_id] = None
+                self.sequences.sequence[seq_id] = None
+                self.free_sequences.append(seq_id)
 
     def load_maf(self, filename):
 	seqs = [ ]
@@ -868,106 +2133,51 @@ class Browser:
 		break
 
     def load_velvet_graph(self, filename):
-        comments = { }
-        f = open(os.path.join(filename,'stats.txt'), 'rb')
-	f.readline()
-	for line in f:
-	    ID, lgth, n_out, n_in, long_cov, short1_cov, short1_Ocov, short2_cov, short2_Ocov = line.strip().split()
-	    comments['NODE_'+ID] = 'cov=%.1f' % (float(long_cov)+float(short1_cov)+float(short2_cov))
-	
-        f = open(os.path.join(filename,'LastGraph'), 'rb')
-        line = f.readline()
-	hash_size = int( line.split()[2] )	
-	tail_size = hash_size - 1
-	
-	while True:
-	    line = f.readline()
-	    if not line: break
-	    parts = line.strip().split()
-	    
-	    if parts[0] == 'NODE':
-	        node_name = 'NODE_' + parts[1]
-		fwd = sequence.sequence_from_string(f.readline().strip())
-		rev = sequence.sequence_from_string(f.readline().strip())
-		assert len(fwd) == len(rev)
-		if len(fwd) < tail_size:
-		    pad = [4]*(tail_size-len(fwd))
-		    fwd = numpy.concatenate((pad,fwd))
-		    rev = numpy.concatenate((pad,rev))
-		rev_rc = sequence.reverse_complement(rev)
-
-		#if not numpy.alltrue(numpy.equal(fwd[:-tail_size], rev_rc[tail_size:])):
-		#    print node_name
-                #    print fwd[:-tail_size]
-		#    print rev_rc[tail_size:]
-                #    print numpy.equal(fwd[:-tail_size],rev_rc[tail_size:]).astype('int')
-		#seq = numpy.concatenate((rev_rc,fwd[-tail_size:]))
-		
-		#self.add_sequence(node_name, seq)
-		#print node_name
-		
-		#TODO: IUPAC codes where different
-                inner_fwd = fwd[:-tail_size]
-		inner_rev = rev_rc[tail_size:]		
-		self.add_sequence(
-		  node_name, 
-		  numpy.concatenate((
-		    rev_rc[:tail_size],
-		    numpy.where(numpy.equal(inner_fwd, inner_rev),
-		                inner_fwd,
-				4),
-		    fwd[-tail_size:]
-		  )),
-		  comments[node_name])
-		
-		#self.add_sequence(node_name+'_fwd', fwd)
-		#self.add_sequence(node_name+'_rev', rev)
-		#self.add_alignment('velvet_contig_pair',
-		#    node_name+'_fwd', True,  0,
-		#    sequence.string_from_sequence(fwd[:-tail_size]),
-		#    node_name+'_rev', False, len(rev_rc)-tail_size-1,
-		#    sequence.string_from_sequence(rev_rc[tail_size:]) )
-	
-	    if parts[0] == 'ARC':
-	        node_from = int(parts[1])
-		name_from = 'NODE_%d' % abs(node_from)
-		fwd_from = node_from >= 0
-
-	        node_to = int(parts[2])
-		name_to = 'NODE_%d' % abs(node_to)
-		fwd_to = node_to >= 0
-		
-		len_from = len(self.sequences.sequence[ self.name_to_sequence[name_from] ])
-		
-		self.add_alignment('velvet_arc',
-		     name_from, fwd_from, len_from-tail_size, 'X'*tail_size,
-		     name_to, fwd_to, 0, 'X'*tail_size)
-	    
-	        #node_from = int(parts[1])		
-		#if node_from < 0:
-		#    node_from = 'NODE_%s_rev' % -node_from
-		#else:
-		#    node_from = 'NODE_%s_fwd' % node_from
-                #node_from_id = self.name_to_sequence[node_from]		
-		
-		#node_to = -int(parts[2])
-		#if node_to < 0:
-		#    node_to = 'NODE_%s_rev' % -node_to
-		#else:
-		#    node_to = 'NODE_%s_fwd' % node_to
-                #node_to_id = self.name_to_sequence[node_to]
-		
-		#len_from = len(self.sequences.sequence[node_from_id])
-		#len_to = len(self.sequences.sequence[node_to_id])
-		#self.add_alignment('velvet_arc',
-		#    node_from, True,  len_from-tail_size, 'X'*tail_size,
-		#    node_to,   False, len_to-1, 'X'*tail_size)
-		
-		
-		
-
-    def show(self, cursor, distance_cutoff):
+        graph = velvet_graph(filename)
+        tail_size = graph['tail_size']
+        node_start = graph['node_start']
+        
+        n_nodes = len(graph['node_id'])
+        first = self.sequences.length
+        names = [ 'NODE_%d' % item for item in graph['node_id'].tolist() ]
+        seqs = numpy.empty(n_nodes, 'object')
+        for i in xrange(n_nodes):
+            seqs[i] = graph['sequence'][node_start[i]:node_start[i+1]]
+        self.sequences.append({
+            'name' : names,
+            'sequence' : seqs,
+            'comment' : [ 'cov=%.1f' % item for item in graph['coverage'].tolist() ],
+        })
+        self.name_to_sequence.update(zip(names, xrange(first, first+n_nodes)))
+        
+        # Arcs overlap the last tail_size bases of one node and the first of the next
+        order = numpy.argsort(graph['node_id'])
+        lengths = node_start[1:] - node_start[:-1]
+        def arc_ends(nodes):
+            nodes_order = order[numpy.searchsorted(graph['node_id'][order], numpy.abs(nodes))]
+            return nodes_order, nodes >= 0, lengths[nodes_order]
+        node_from, fwd_from, len_from = arc_ends(graph['arc_from'])
+        node_to, fwd_to, len_to = arc_ends(graph['arc_to'])
+        self.add_gapless_alignments('velvet_arc',
+            make_locations(first+node_from, fwd_from, numpy.where(fwd_from, len_from-tail_size, tail_size-1)),
+            make_locations(first+node_to, fwd_to, numpy.where(fwd_to, 0, len_to-1)),
+            tail_size)
+
+    def linked_locations(self, location):
+        """ Locations aligned to location, cached between calls to show. """
+        if self.links_size != self.blocks.length or len(self.links) > LINK_CACHE_SIZE:
+            self.links = { }
+            self.links_size = self.blocks.length
+        if location not in self.links:
+            self.links.update(self.links_near(location))
+        return self.links[location]
+
+    def lay_out(self, cursor, distance_cutoff):
+        """ Arrange everything within distance_cutoff of cursor into rows 
+            (one per contig) and columns (one per set of aligned locations). """
 	positions = { }
+	distances = { }
+	neighbours = { } # location -> [ (location, distance, position) ] relative to it
 	todo = [ ]
 	heapq.heappush(todo, (0, 0, cursor))
 	def add_todo(location, distance, position):
@@ -990,6 +2200,8 @@ class Browser:
 	    distance, position, location = heapq.heappop(todo)
 	    if location in positions: continue
 	    positions[location] = position
+	    distances[location] = distance
+	    neighbours[location] = [ ]
 	    
 	    #dag.get_keyset(location)
 	    if location not in dag: dag[location] = [ ]
@@ -1003,6 +2215,7 @@ class Browser:
 	    try:
 	        linked_location = self.location_move(location,1)
 	        contigua.merge_if_created(location, linked_location)
+	        neighbours[location].append((linked_location, 1, 1))
 	        add_todo(linked_location, distance+1, position+1)
 		dag_link(location, linked_location)
 	    except Out_of_bounds: pass
@@ -1010,26 +2223,21 @@ class Browser:
 	    try:
 	        linked_location = self.location_move(location,-1)
 	        contigua.merge_if_created(location, linked_location)
+	        neighbours[location].append((linked_location, 1, -1))
 	        add_todo(linked_location, distance+1, position-1)
 		dag_link(linked_location, location)
 	    except Out_of_bounds: pass
 	    
 	    def merge(linked_location):
+	        neighbours[location].append((linked_location, 0, 0))
 	        try:
 		    add_todo(linked_location, distance, position)
 		    dag_link(location, linked_location)
 		    dag_link(linked_location, location)
 		except Out_of_bounds: pass
 	    
-	    for i in self.base_links.find_all('location1',location):
-	        merge(self.base_links.location2[i])
-	    for i in self.base_links.find_all('location2',location):
-	        merge(self.base_links.location1[i])
-
-	    for i in self.base_links.find_all('location1',location^FORWARD_MASK):
-	        merge(self.base_links.location2[i]^FORWARD_MASK)
-	    for i in self.base_links.find_all('location2',location^FORWARD_MASK):
-	        merge(self.base_links.location1[i]^FORWARD_MASK)
+	    for linked_location in self.linked_locations(location):
+	        merge(linked_location)
 
 
 	
@@ -1049,93 +2257,149 @@ class Browser:
 	    
 	contigs.sort(lambda a,b: cmp(a.sort_key, b.sort_key))
 		
-	#print contigua
-	
-	#for contig in contigua:
-	#    item = iter(contig).next()
-	#    seq = location_sequence( item )
-	#    forward = (item & FORWARD_MASK) != 0
-	#    print self.sequences.name[seq], forward
-	
 	#order = dag.sort(positions)
 	def priority(component):
 	    return float(sum([ positions[item] for item in component ])) / len(component)
 	order = sort.compact_robust_topological_sort(dag, priority)
 	
 	table = [ ]
-	column_width = [ ]
+	
+	contig_of = { }
+	for y, contig in enumerate(contigs):
+	    for location in contig.locations:
+	        contig_of[location] = y
 	
 	for x, locations in enumerate(order):
-	    column = [ ]
+	    column = [ [ ] for contig in contigs ]
 	    table.append(column)
-	    for y, contig in enumerate(contigs):
-	        relevant = [ location for location in locations
-		             if location in contig.locations ]
+	    for location in locations:
+	        column[contig_of[location]].append(location)
+	    for y, relevant in enumerate(column):
 		relevant.sort()
 		if relevant and not (relevant[0]&FORWARD_MASK):
-		    relevant = relevant[::-1]
-		if self.cursor in relevant:
-		    cursor_y = y
-		    cursor_x = numpy.sum(column_width) + relevant.index(self.cursor)
-		    cursor_column = column
-	        column.append( relevant )
-		#sequence.string_from_sequence( [ self.location_get(location)
-		#                          for location in relevant ] ) )
-	    
-	    column_width.append(max([ len(item) for item in column ]))
-
+		    relevant.reverse()
+        
+        layout = Layout()
+        layout.distances = distances
+        layout.neighbours = neighbours
+        layout.table = table
+        layout.blocks_size = self.blocks.length
+        layout.letters = { }
+        for location in positions:
+            layout.letters[location] = sequence.string_from_sequence([ self.location_get(location) ])
+        
+        layout.sort_keys = [ contig.sort_key for contig in contigs ]
+        layout.infos = [ ]
+        for contig in contigs:
+	    info = contig.name
+	    if self.sequences.comment[contig.seq]:
+	        info += ' ' + self.sequences.comment[contig.seq]
+	    if contig.forward:
+	        info += ' >>> '
+	    else:
+	        info += ' <<< '
+            layout.infos.append(info)
+        
+        return layout
+
+    def near(self, layout, cursor, distance_cutoff):
+        """ The locations of a layout within distance_cutoff of cursor, 
+            searched for as lay_out searches, as { location : order found }. """
+        result = { }
+        todo = [ (0, 0, cursor) ]
+        while todo:
+            distance, position, location = heapq.heappop(todo)
+            if location in result: continue
+            result[location] = len(result)
+            for linked_location, step, offset in layout.neighbours[location]:
+                if distance+step <= distance_cutoff and linked_location not in result:
+                    heapq.heappush(todo, (distance+step, position+offset, linked_location))
+        return result
 
-        self.screen.clear()
+    def show(self, cursor, distance_cutoff):
+        """ Show everything within distance_cutoff of cursor. 
+        
+            The layout is made LAYOUT_MARGIN wider than needed, and reused
+            while the cursor stays within LAYOUT_MARGIN of where it was made.
+            Only screen lines that have changed are redrawn. """
+        self.load_near(cursor)
+        
+        layout = self.layout
+        if layout is None or \
+           layout.blocks_size != self.blocks.length or \
+           layout.distances.get(cursor, LAYOUT_MARGIN+1) > LAYOUT_MARGIN:
+            layout = self.layout = self.lay_out(cursor, distance_cutoff+LAYOUT_MARGIN)
+        
+        # Draw only what lay_out(cursor, distance_cutoff) would have laid out.
+        # A row of the layout is split where it leaves distance_cutoff, 
+        # and rows are ordered by contig then by when they were found.
+        near = self.near(layout, cursor, distance_cutoff)
+        rows = [ ] # [ (sort key, order found, layout row, locations) ]
+        for y in xrange(len(layout.infos)):
+            locations = [ location 
+                          for column in layout.table 
+                          for location in column[y] 
+                          if location in near ]
+            locations.sort()
+            start = 0
+            for i in xrange(1, len(locations)+1):
+                if i == len(locations) or locations[i] != locations[i-1]+ONE_UINT64:
+                    run = locations[start:i]
+                    rows.append((layout.sort_keys[y], min([ near[location] for location in run ]), y, set(run)))
+                    start = i
+        rows.sort()
+        
+        strings = [ [ ] for row in rows ]
+        scr_x = 0
+        for column in layout.table:
+            column = [ [ location for location in column[y] if location in run ] 
+                       for key, found, y, run in rows ]
+            width = max([ len(relevant) for relevant in column ] + [ 0 ])
+            if not width: continue
+            for y, relevant in enumerate(column):
+                if cursor in relevant:
+                    cursor_column = column
+                    cursor_y = y
+                    cursor_x = scr_x + relevant.index(cursor)
+                strings[y].append(''.join([ layout.letters[location] for location in relevant ]).ljust(width))
+            scr_x += width
 	
 	maxy, maxx = self.screen.getmaxyx()
 	offset_y = int( maxy//2-cursor_y )
 	offset_x = int( maxx//2-cursor_x )
+	lines = [ [' ']*maxx for y in xrange(maxy) ]
 	def addstr(y,x,string):
 	    if y < 0 or y >= maxy: return
-	    while string and x < 0:
-	        string = string[1:]
-		x += 1
+	    if x < 0:
+	        string = string[-x:]
+		x = 0
 	    if x+len(string) > maxx:
 	        string = string[:max(0,maxx-x)]
 	    if not string: return
-	    #try:
-	    self.screen.addstr(y,x,string)
-	    #except:
-	    #    raise repr((y,x,string,maxy,maxx))
+	    lines[y][x:x+len(string)] = string
 	
-        for y in xrange(len(contigs)):
-	
-	    #item = iter(contigua[y]).next()
-	    #seq = location_sequence( item )
-	    #forward = (item & FORWARD_MASK) != 0
-	    #sys.stdout.write('% 20s %d  ' % (self.sequences.name[seq],forward))
-	    
-	    scr_x = 0
-            for x in xrange(len(order)):
-	        item = table[x][y]
-		#item += ' '*(column_width[x]-len(item))
-	        #sys.stdout.write(item)
-		
-		string = sequence.string_from_sequence( [ self.location_get(location)
-		                                          for location in item ] )
-		
-		addstr(y+offset_y,scr_x+offset_x,string)
-		
-		scr_x += column_width[x]
-		
-	    #sys.stdout.write('\n')
-	    
-	    info = contigs[y].name
-	    if self.sequences.comment[contigs[y].seq]:
-	        info += ' ' + self.sequences.comment[contigs[y].seq]
-	    if contigs[y].forward:
-	        info += ' >>> '
-	    else:
-	        info += ' <<< '
+        for y in xrange(max(0,-offset_y), min(len(rows),maxy-offset_y)):
+            info = layout.infos[rows[y][2]]
+            addstr(y+offset_y,offset_x,''.join(strings[y]))
 	    addstr(y+offset_y,max(0,-len(info)-1+offset_x),info)
 	    
 	cursor_seq, cursor_fwd, cursor_pos = location_parts(cursor)
 	addstr(1,1, '%s @ %d' % (self.sequences.name[cursor_seq], cursor_pos))
+	
+	lines = [ ''.join(line) for line in lines ]
+	if self.screen_lines is None or len(self.screen_lines) != maxy or \
+	   (maxy and len(self.screen_lines[0]) != maxx):
+	    self.screen.clear()
+	    self.screen_lines = [ ' '*maxx ] * maxy
+	
+	for y in xrange(maxy):
+	    if lines[y] != self.screen_lines[y]:
+	        # Writing to the bottom right corner is an error in curses
+	        if y == maxy-1:
+	            self.screen.addstr(y,0,lines[y][:-1])
+	        else:
+	            self.screen.addstr(y,0,lines[y])
+	self.screen_lines = lines
 	    
 	self.screen.move(cursor_y+offset_y,cursor_x+offset_x)
 	self.screen.refresh()
@@ -1234,7 +2498,10 @@ def browse(argv):
 	elif mode == '-seqs':
 	    browser.load_sequences(item)
 	elif mode == '-aligns':
-	    browser.load_myr_hits(item)
+	    if hit_file_format(item) == 'myrialign':
+	        browser.open_myr_hits(item)
+	    else:
+	        browser.load_myr_hits(item)
 	elif mode == '-velvet':
 	    browser.load_velvet_graph(item)
 	elif mode == '-maf':
@@ -0,0 +1,85 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Profiling of a whole run, child processes included.
+
+    The profile directory and an identifier for the run are passed to
+    child processes in the environment. Each process writes its own
+    profile to <directory>/<run>-<command>-<pid>.prof, and the process
+    that started the run merges them into a report when it finishes.
+
+"""
+
+import sys, os, glob, pstats
+
+try:
+    from cProfile import Profile
+except ImportError:
+    from profile import Profile
+
+ENV_DIRECTORY = 'MYR_PROFILE'
+ENV_RUN = 'MYR_PROFILE_RUN'
+
+REPORT_LINES = 30
+
+def inherited_directory():
+    """ Profile directory set by a parent process, or None. """
+    return os.environ.get(ENV_DIRECTORY)
+
+def profile(command, function, argv, directory):
+    """ Run function(command, argv) under the profiler. """
+    directory = os.path.abspath(directory)
+    run = os.environ.get(ENV_RUN)
+    is_parent = run is None
+    if is_parent:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        run = str(os.getpid())
+        os.environ[ENV_DIRECTORY] = directory
+        os.environ[ENV_RUN] = run
+
+    profiler = Profile()
+    try:
+        result = profiler.runcall(function, command, argv)
+    finally:
+        profiler.dump_stats(os.path.join(directory, '%s-%s-%d.prof' % (run, command, os.getpid())))
+
+    if is_parent:
+        report(directory, run)
+    return result
+
+def report(directory, run, out=sys.stderr, n_lines=REPORT_LINES):
+    """ Merge the profiles of all processes in a run, and print the
+        functions that took the most time. """
+    filenames = glob.glob(os.path.join(directory, '%s-*.prof' % run))
+    filenames.sort()
+    if not filenames:
+        return
+
+    stats = pstats.Stats(filenames[0], stream=out)
+    for filename in filenames[1:]:
+        stats.add(filename)
+
+    print >> out, ''
+    print >> out, 'Profile of %d processes, from %s' % (len(filenames), directory)
+    stats.strip_dirs()
+    stats.sort_stats('time', 'cumulative')
+    stats.print_stats(n_lines)
@@ -121,3 +121,37 @@ def sequence_files_iterator(filenames):
     for filename in filenames:
         for result in sequence_file_iterator(filename):
             yield result
+
+
+INDEX_BLOCK_SIZE = 16 << 20
+
+def record_offsets(filename):
+    """ Byte offsets of the records of a FASTA or ELAND file, 
+        that is of each line starting with '>'. """
+    f = open(filename, 'rb')
+    result = [ numpy.zeros(0, 'int64') ]
+    offset = 0
+    previous = '\n'
+    while True:
+        block = f.read(INDEX_BLOCK_SIZE)
+        if not block: break
+        
+        data = numpy.fromstring(previous + block, 'uint8')
+        starts = numpy.flatnonzero((data[:-1] == ord('\n')) & (data[1:] == ord('>')))
+        result.append(starts.astype('int64') + offset)
+        offset += len(block)
+        previous = block[-1]
+    return numpy.concatenate(result)
+
+def parse_record(text):
+    """ (name, sequence) from the text of a record found by record_offsets. """
+    lines = text.splitlines()
+    seq = ''.join([ line.strip() for line in lines[1:] ])
+    if seq:
+        return lines[0][1:].strip().split()[0], sequence_from_string(seq)
+    
+    # ELAND
+    parts = lines[0].split()
+    if len(parts) < 2:
+        raise Parse_error()
+    return parts[0][1:], sequence_from_string(parts[1])
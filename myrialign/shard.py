@@ -0,0 +1,277 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Splitting a "myr align" run into shards that can be run on separate
+    machines, and merging the shard outputs back together.
+
+    A shard i/N either takes every N-th read starting from read i, or
+    the i-th of N equal segments of each reference sequence.
+
+"""
+
+import sys
+
+import util, extsort, hitfile
+
+class Error(Exception): pass
+
+SHARD_BY = ('reads', 'reference')
+
+def parse_shard(text):
+    """ Parse "i/N" into (i, N) """
+    i, n = text.split('/')
+    i = int(i)
+    n = int(n)
+    if not 0 <= i < n:
+        raise ValueError('Bad shard %s' % text)
+    return i, n
+
+def parse_shard_by(text):
+    if text not in SHARD_BY:
+        raise ValueError('Bad shard mode %s' % text)
+    return text
+
+def segment(length, shard):
+    """ The part (start, end) of a reference of the given length
+        belonging to a shard. """
+    i, n = shard
+    return length*i//n, length*(i+1)//n
+
+
+def dominates(hit1, hit2):
+    """ As align.dominates, for hits from the same read given as
+        (name, direction, n_errors, end) """
+    return abs(hit2[3]-hit1[3]) <= (hit2[2]-hit1[2])
+
+
+class Shard_file:
+    """ Reads a shard output file one reference at a time. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = hitfile.open_hit_file(filename)
+        self.line = None
+        self.advance()
+
+        self.headers = { }
+        while self.line is not None and self.line.startswith('#') and \
+              not self.line.startswith('#Reference:'):
+            if ':' in self.line:
+                key, value = self.line[1:].split(':',1)
+                self.headers[key] = value.strip()
+            self.advance()
+
+        self.shard = None
+        self.shard_by = None
+        if 'Shard' in self.headers:
+            shard, self.shard_by = self.headers['Shard'].split()
+            self.shard = parse_shard(shard)
+
+    def advance(self):
+        try:
+            line = self.file.readline()
+        except (EOFError, IOError):
+            # Compressed file ends part way through a block
+            raise Error('%s is truncated, or is still being written' % self.filename)
+        if not line:
+            self.line = None
+        elif not line.endswith('\n'):
+            raise Error('%s is truncated, or is still being written' % self.filename)
+        else:
+            self.line = line
+
+    def next_reference(self):
+        """ Returns reference name and segment (or None),
+            ready to iterate over hit lines. """
+        if self.line is None:
+            raise Error('%s ended before all references were seen' % self.filename)
+        assert self.line.startswith('#Reference:')
+        name = self.line.split()[1]
+        self.advance()
+
+        segment = None
+        while self.line is not None and self.line.startswith('#') and \
+              not self.line.startswith('#Reference:'):
+            if self.line.startswith('#Segment:'):
+                start, end = self.line.split()[1].split('..')
+                segment = (int(start)-1, int(end))
+            self.advance()
+
+        return name, segment
+
+    def mark(self):
+        """ Position that can later be returned to with restore """
+        return self.file.tell(), self.line
+
+    def restore(self, mark):
+        self.file.seek(mark[0])
+        self.line = mark[1]
+
+    def hit_lines(self):
+        while self.line is not None and not self.line.startswith('#Reference:'):
+            if not self.line.startswith('#'):
+                yield self.line
+            self.advance()
+
+    def at_end(self):
+        return self.line is None
+
+
+def edge_hit(line, segment, max_error):
+    """ (name, direction, n_errors, end) if a hit line ends near the edge 
+        of a segment, otherwise None """
+    if segment is None:
+        return None
+    parts = line.split()
+    end = int(parts[3].split('..')[1])
+    if end-segment[0] <= max_error or segment[1]-end <= max_error:
+        return (parts[0], parts[1], int(parts[2]), end)
+    return None
+
+def resolve_edge_hits(edge_hits):
+    """ Remove dominated hits from [ (hit, line) ].
+        Returns the lines kept, in order, and the number dropped. """
+    n_dropped = 0
+    kept = { } # (name, direction) -> [ (hit, line) ]
+    for hit, line in edge_hits:
+        same_read = kept.setdefault(hit[:2], [ ])
+        for other in same_read:
+            if dominates(other[0], hit):
+                n_dropped += 1
+                break
+        else:
+            i = 0
+            while i < len(same_read):
+                if dominates(hit, same_read[i][0]):
+                    n_dropped += 1
+                    del same_read[i]
+                else:
+                    i += 1
+            same_read.append((hit, line))
+
+    lines = [ line for hit, line in edge_hits if (hit, line) in kept[hit[:2]] ]
+    return lines, n_dropped
+
+def merge_files(filenames, out_file):
+    files = [ Shard_file(filename) for filename in filenames ]
+
+    for key in ('Max errors', 'Indel cost', 'Sorted'):
+        values = [ item.headers.get(key) for item in files ]
+        if len(set(values)) != 1:
+            raise Error('Shards disagree on "%s": %s' % (key, ', '.join(map(str,values))))
+    max_error = int(files[0].headers['Max errors'])
+
+    sharding = set([ (item.shard_by, item.shard and item.shard[1]) for item in files ])
+    if len(sharding) != 1:
+        raise Error('Shards were not all produced with the same --shard/--shard-by options')
+    shard_by, n_shards = iter(sharding).next()
+
+    if n_shards is not None:
+        seen = [ item.shard[0] for item in files ]
+        if len(set(seen)) != len(seen):
+            raise Error('The same shard was given more than once')
+        if len(seen) != n_shards:
+            missing = sorted(set(range(n_shards)) - set(seen))
+            util.show_message('Warning: shards %s missing' % ', '.join(map(str,missing)))
+
+    print >> out_file, '#Max errors:', files[0].headers['Max errors']
+    print >> out_file, '#Indel cost:', files[0].headers['Indel cost']
+    is_sorted = 'Sorted' in files[0].headers
+    if is_sorted:
+        print >> out_file, '#Sorted:', files[0].headers['Sorted']
+
+    n_hits = 0
+    n_dropped = 0
+    while not files[0].at_end():
+        ref_name = None
+
+        # Hits ending near the edge of a segment may be reported slightly
+        # differently by the shards on either side, resolve these here
+        edge_hits = [ ] # [ (name, direction, n_errors, end), line ]
+
+        segments = [ ]
+        marks = [ ]
+        for item in files:
+            name, segment = item.next_reference()
+            if ref_name is None:
+                ref_name = name
+                print >> out_file, '#Reference:', ref_name
+            elif name != ref_name:
+                raise Error('Shards do not list the same references (%s vs %s)' % (ref_name, name))
+            segments.append(segment)
+            marks.append(item.mark())
+
+            for line in item.hit_lines():
+                n_hits += 1
+                hit = edge_hit(line, segment, max_error)
+                if hit is not None:
+                    edge_hits.append((hit, line))
+                elif not is_sorted:
+                    out_file.write(line)
+
+        edge_lines, n_edge_dropped = resolve_edge_hits(edge_hits)
+        n_dropped += n_edge_dropped
+
+        if not is_sorted:
+            out_file.writelines(edge_lines)
+        else:
+            # Read each shard again, merging them in order
+            def shard_lines(item, segment):
+                for line in item.hit_lines():
+                    if edge_hit(line, segment, max_error) is None:
+                        yield line
+
+            iterators = [ ]
+            for item, segment, mark in zip(files, segments, marks):
+                item.restore(mark)
+                iterators.append(shard_lines(item, segment))
+            edge_lines.sort(key=extsort.hit_key)
+            iterators.append(edge_lines)
+
+            out_file.writelines(extsort.merge(iterators, extsort.hit_key))
+
+    for item in files[1:]:
+        if not item.at_end():
+            raise Error('%s lists more references than %s' % (item.filename, files[0].filename))
+
+    util.show_message('Merged %d hits from %d files, %d duplicates removed' % (n_hits, len(files), n_dropped))
+
+
+def merge(argv):
+    if not argv:
+        print >> sys.stderr, ''
+        print >> sys.stderr, 'myr merge <shard output> [<shard output>...]'
+        print >> sys.stderr, ''
+        print >> sys.stderr, 'Combine the outputs of "myr align --shard i/N ..." into a single'
+        print >> sys.stderr, 'alignment file, written to standard output. Hits found by two '
+        print >> sys.stderr, 'neighbouring reference segments are only reported once. If the shards'
+        print >> sys.stderr, 'were produced with --sorted, so is the output.'
+        print >> sys.stderr, ''
+        return 1
+
+    try:
+        merge_files(argv, sys.stdout)
+    except Error, error:
+        print >> sys.stderr, error[0]
+        return 1
+
+    return 0
+
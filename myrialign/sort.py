@@ -18,47 +18,92 @@
 #    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import heapq, sets
+"""
 
-def strongly_connected_components(graph):
+    Strongly connected components and topological sorting of graphs
+    given as { node : [ successor nodes ] }.
+    
+    Nodes are numbered in the order the graph gives them, and the work
+    is done iteratively over compressed adjacency lists (CSR: the
+    successors of node i are targets[offsets[i]:offsets[i+1]]), so
+    long chains do not hit the recursion limit.
+
+"""
+
+import heapq
+
+def adjacency(graph):
+    """ nodes, offsets, targets for graph, as described above. """
+    nodes = list(graph)
+    ids = dict(zip(nodes, xrange(len(nodes))))
+    offsets = [ 0 ]
+    targets = [ ]
+    for node in nodes:
+        targets.extend([ ids[successor] for successor in graph[node] ])
+        offsets.append(len(targets))
+    return nodes, offsets, targets
+
+def component_ids(offsets, targets):
+    """ Tarjan's algorithm. Returns components as lists of node ids, 
+        each component coming after any it leads to. """
+    n = len(offsets)-1
     result = [ ]
     stack = [ ]
-    low = { }
+    num = [ -1 ] * n
+    low = [ -1 ] * n
+    stack_pos = [ 0 ] * n
+    count = 0
+    
+    for root in xrange(n):
+        if low[root] != -1: continue
         
-    def visit(node):
-        if node in low: return
-	
-	num = len(low)
-        low[node] = num
-        stack_pos = len(stack)
-        stack.append(node)
-	
-        for successor in graph[node]:
-            visit(successor)
-            low[node] = min(low[node], low[successor])
+        num[root] = low[root] = count
+        count += 1
+        stack_pos[root] = len(stack)
+        stack.append(root)
+        calls = [ root ]
+        edges = [ offsets[root] ]
         
-        if num == low[node]:
-	    component = tuple(stack[stack_pos:])
-            del stack[stack_pos:]
-            result.append(component)
-	    for item in component:
-	        low[item] = len(graph)
-    
-    for node in graph:
-        visit(node)
+        while calls:
+            node = calls[-1]
+            edge = edges[-1]
+            if edge < offsets[node+1]:
+                edges[-1] = edge+1
+                successor = targets[edge]
+                if low[successor] == -1:
+                    num[successor] = low[successor] = count
+                    count += 1
+                    stack_pos[successor] = len(stack)
+                    stack.append(successor)
+                    calls.append(successor)
+                    edges.append(offsets[successor])
+                elif low[successor] < low[node]:
+                    low[node] = low[successor]
+                continue
+            
+            calls.pop()
+            edges.pop()
+            if num[node] == low[node]:
+                component = stack[stack_pos[node]:]
+                del stack[stack_pos[node]:]
+                result.append(component)
+                for item in component:
+                    low[item] = n
+            
+            if calls and low[node] < low[calls[-1]]:
+                low[calls[-1]] = low[node]
     
     return result
 
-
-def topological_sort(graph, priority=lambda x:x):
-    count = { }
-    for node in graph:
-        count[node] = 0
-    for node in graph:
-        for successor in graph[node]:
-            count[successor] += 1
-
-    ready = [ (priority(node), node) for node in graph if count[node] == 0 ]
+def topological_order(offsets, targets, keys):
+    """ Kahn's algorithm, taking the ready node with the smallest key 
+        first. Returns node ids. """
+    n = len(offsets)-1
+    count = [ 0 ] * n
+    for target in targets:
+        count[target] += 1
+    
+    ready = [ (keys[i], i) for i in xrange(n) if count[i] == 0 ]
     heapq.heapify(ready)
     
     result = [ ]
@@ -66,56 +111,84 @@ def topological_sort(graph, priority=lambda x:x):
         node = heapq.heappop(ready)[1]
         result.append(node)
         
-        for successor in graph[node]:
+        for successor in targets[offsets[node]:offsets[node+1]]:
             count[successor] -= 1
             if count[successor] == 0:
-                heapq.heappush(ready, (priority(successor), successor))
+                heapq.heappush(ready, (keys[successor], successor))
     
     return result
 
+def strongly_connected_components(graph):
+    nodes, offsets, targets = adjacency(graph)
+    return [ tuple([ nodes[i] for i in component ])
+             for component in component_ids(offsets, targets) ]
 
-def robust_topological_sort(graph, priority=lambda x:x):
-    components = strongly_connected_components(graph)
 
-    node_component = { }
-    for component in components:
-        for node in component:
-            node_component[node] = component
+def topological_sort(graph, priority=lambda x:x):
+    nodes, offsets, targets = adjacency(graph)
+    keys = [ (priority(node), node) for node in nodes ]
+    return [ nodes[i] for i in topological_order(offsets, targets, keys) ]
 
-    component_graph = { }
-    for component in components:
-        component_graph[component] = [ ]
+
+def robust_order(nodes, offsets, targets, priority):
+    """ Components of the graph, as lists of node ids and tuples of nodes,
+        and the order of the components. """
+    components = component_ids(offsets, targets)
+    tuples = [ tuple([ nodes[i] for i in component ]) for component in components ]
+    
+    node_component = [ 0 ] * len(nodes)
+    for c, component in enumerate(components):
+        for node in component:
+            node_component[node] = c
+    
+    component_offsets = [ 0 ]
+    component_targets = [ ]
+    for c, component in enumerate(components):
+        for node in component:
+            for successor in targets[offsets[node]:offsets[node+1]]:
+                successor_c = node_component[successor]
+                if successor_c != c:
+                    component_targets.append(successor_c)
+        component_offsets.append(len(component_targets))
     
-    for node in graph:
-        node_c = node_component[node]
-        for successor in graph[node]:
-            successor_c = node_component[successor]
-            if node_c != successor_c:
-                component_graph[node_c].append(successor_c) 
+    keys = [ (priority(item), item) for item in tuples ]
+    return components, tuples, topological_order(component_offsets, component_targets, keys)
 
-    return topological_sort(component_graph, priority)
+
+def robust_topological_sort(graph, priority=lambda x:x):
+    """ Topological sort of the strongly connected components of graph,
+        as tuples of nodes. """
+    components, tuples, order = robust_order(*adjacency(graph) + (priority,))
+    return [ tuples[c] for c in order ]
 
 
 def compact_robust_topological_sort(graph, priority=lambda x:x):
-    order = robust_topological_sort(graph, priority)
+    """ As robust_topological_sort, but components are merged into
+        groups, in order, as long as no node in a group leads to
+        another in the same group. """
+    nodes, offsets, targets = adjacency(graph)
+    components, tuples, order = robust_order(nodes, offsets, targets, priority)
     
     compacted = [ ]
-    next = sets.Set()
-    successors = sets.Set()
-    for component in order:
-        component = sets.Set(component)
-	if successors & component:
-	    compacted.append( tuple(next) )
-	    next = sets.Set()
-	    successors = sets.Set()
-    
-        next.union_update(component)
+    group = [ ]
+    group_no = 0
+    successor_of = [ -1 ] * len(nodes) # group number a node is a successor of
+    for c in order:
+        component = components[c]
+        for node in component:
+            if successor_of[node] == group_no:
+                compacted.append(tuple([ nodes[i] for i in group ]))
+                group = [ ]
+                group_no += 1
+                break
+        
+        group.extend(component)
         for node in component:
-	    for successor in graph[node]:
-	        successors.add(successor)
+            for successor in targets[offsets[node]:offsets[node+1]]:
+                successor_of[successor] = group_no
     
-    if next:
-        compacted.append(tuple(next))
+    if group:
+        compacted.append(tuple([ nodes[i] for i in group ]))
     
     return compacted
 
@@ -0,0 +1,220 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Summaries of hits: error profile, hit counts and coverage.
+
+    "myr align --summary" and "--coverage" have each child process
+    summarize the batches it aligns, and the parent merges the results,
+    so no second pass over the output is needed. "myr assess" uses the
+    same Summary for its report.
+
+"""
+
+import numpy
+
+class Summary:
+    """ Per read counts, accumulated with add_read and combined with merge.
+
+        A read whose best hit has at least two fewer errors than its
+        next best has a clear best hit. Substitutions and indels of clear
+        best hits are counted by position along the read. """
+
+    def __init__(self, max_errors):
+        self.n_reads = 0
+        self.n_unhit = 0
+        self.n_ambiguous = 0
+        self.error_counts = [ 0 ] * (max_errors+1) # reads with clear best hit having n errors
+        self.hit_counts = [ ] # reads with n hits
+        self.substitutions = [ ] # by read position
+        self.indels = [ ] # by read position
+
+    def add_read(self, read_length, hits):
+        """ Add a read and its hits, a list of (n_errors, forward, read_ali, ref_ali). """
+        self.add_best(read_length, *best_hits(hits))
+
+    def add_best(self, read_length, n_hits, best, next_errors):
+        """ Add a read given the result of best_hits. """
+        self.n_reads += 1
+        if read_length > len(self.substitutions):
+            self.substitutions.extend([ 0 ] * (read_length-len(self.substitutions)))
+            self.indels.extend([ 0 ] * (read_length-len(self.indels)))
+        if n_hits >= len(self.hit_counts):
+            self.hit_counts.extend([ 0 ] * (n_hits+1-len(self.hit_counts)))
+        self.hit_counts[n_hits] += 1
+
+        if best is None:
+            self.n_unhit += 1
+            return
+
+        if next_errors is not None and best[0]+2 > next_errors:
+            self.n_ambiguous += 1
+            return
+
+        self.error_counts[best[0]] += 1
+
+        forward, read_ali, ref_ali = best[1:]
+        if not forward:
+            read_ali = read_ali[::-1]
+            ref_ali = ref_ali[::-1]
+            # Don't worry about complementing...
+        read_pos = 0
+        for i in xrange(len(read_ali)):
+            if read_ali[i] == '-' or ref_ali[i] == '-':
+                self.indels[read_pos] += 1
+            elif read_ali[i] != ref_ali[i]:
+                self.substitutions[read_pos] += 1
+
+            if read_ali[i] != '-':
+                read_pos += 1
+
+    def merge(self, other):
+        self.n_reads += other.n_reads
+        self.n_unhit += other.n_unhit
+        self.n_ambiguous += other.n_ambiguous
+        self.error_counts = add_lists(self.error_counts, other.error_counts)
+        self.hit_counts = add_lists(self.hit_counts, other.hit_counts)
+        self.substitutions = add_lists(self.substitutions, other.substitutions)
+        self.indels = add_lists(self.indels, other.indels)
+
+    def write_report(self, f, verb='Sampled'):
+        print >> f, 'Error profile'
+        for i in xrange(len(self.substitutions)):
+            print >> f, 'pos=%5d snps=%5d indels=%5d' % (i+1,self.substitutions[i],self.indels[i])
+        print >> f
+
+        print >> f, verb, self.n_reads, 'reads'
+        print >> f, self.n_ambiguous, 'had no clear best hit'
+        print >> f, self.n_unhit, 'hit nothing'
+        for i in xrange(len(self.error_counts) -2):
+            print >> f, '%3d errors: %d' % (i,self.error_counts[i])
+
+        print >> f
+        print >> f, 'Hits per read'
+        for i in xrange(len(self.hit_counts)):
+            if self.hit_counts[i]:
+                print >> f, '%3d hits: %d' % (i,self.hit_counts[i])
+
+def best_hits(hits):
+    """ What Summary needs of a read's hits: the number of hits, the 
+        best hit (or None), and the errors of the next best (or None). """
+    hits = sorted(hits)
+    if not hits:
+        return 0, None, None
+    if len(hits) == 1:
+        return 1, hits[0], None
+    return len(hits), hits[0], hits[1][0]
+
+def merge_best_hits(a, b):
+    """ Combine the best_hits of two sets of hits of the same read. """
+    n_hits = a[0] + b[0]
+    if a[1] is None:
+        return n_hits, b[1], b[2]
+    if b[1] is None:
+        return n_hits, a[1], a[2]
+    if b[1] < a[1]:
+        a, b = b, a
+    next_errors = b[1][0]
+    if a[2] is not None:
+        next_errors = min(next_errors, a[2])
+    return n_hits, a[1], next_errors
+
+class Read_hits:
+    """ best_hits of each read, merged over the references it is aligned 
+        to, for a Summary with each read counted once. Reads are 
+        identified by number, and only reads with hits are held. """
+
+    def __init__(self):
+        self.reads = { } # read number -> (read length, best_hits)
+        self.n_reads = 0
+        self.read_length = 0
+
+    def add(self, read_no, read_length, best):
+        if read_no in self.reads:
+            best = merge_best_hits(self.reads[read_no][1], best)
+        self.reads[read_no] = (read_length, best)
+
+    def summary(self, max_errors):
+        """ Summary of all n_reads reads, of length up to read_length, 
+            those not in self.reads having hit nothing. """
+        result = Summary(max_errors)
+        for read_length, best in self.reads.itervalues():
+            result.add_best(read_length, *best)
+        for i in xrange(self.n_reads - len(self.reads)):
+            result.add_best(self.read_length, 0, None, None)
+        return result
+
+def add_lists(a, b):
+    """ Elementwise sum of lists, the shorter padded with zeros. """
+    if len(a) < len(b):
+        a, b = b, a
+    return [ a[i] + b[i] for i in xrange(len(b)) ] + a[len(b):]
+
+
+def coverage_changes(starts, ends, weights):
+    """ Changes in coverage at each position, from hits covering
+        starts[i]:ends[i] with weights[i], as sorted positions and
+        the total change at each. """
+    positions = numpy.concatenate((starts, ends)).astype('int64')
+    changes = numpy.concatenate((weights, -numpy.asarray(weights, 'float64')))
+    positions, inverse = numpy.unique(positions, return_inverse=True)
+    return positions, numpy.bincount(inverse, changes)
+
+class Coverage:
+    """ Coverage along a reference, accumulated from coverage_changes. """
+
+    def __init__(self, size):
+        self.changes = numpy.zeros(size+1, 'float64')
+
+    def add(self, changes):
+        positions, amounts = changes
+        numpy.add.at(self.changes, numpy.clip(positions, 0, len(self.changes)-1), amounts)
+
+    def depths(self):
+        return numpy.cumsum(self.changes)[:-1]
+
+
+def summarize_batch(reads, read_names, hits):
+    """ best_hits and coverage_changes of the hits from aligning a batch,
+        hits being as passed to align.Hit_eater's callback.
+
+        Reads come in pairs, each read then its reverse complement. 
+        best_hits are given as (i, best_hits) for the ith pair, for
+        pairs with hits. Each hit counts 1/(number of hits of the read) 
+        towards coverage. """
+    entries = dict(zip(read_names, xrange(len(read_names))))
+    read_hits = [ [ ] for i in xrange(len(reads)//2) ]
+    hit_reads = [ ]
+    for read_name, n_errors, ref_start, ref_pos, read_ali, ref_ali in hits:
+        entry = entries[read_name]
+        read_hits[entry//2].append((n_errors, entry%2 == 0, read_ali, ref_ali))
+        hit_reads.append(entry//2)
+
+    best = [ (i, best_hits(read_hits[i])) 
+             for i in xrange(len(read_hits)) 
+             if read_hits[i] ]
+
+    n_hits = numpy.array([ len(item) for item in read_hits ], 'float64')
+    changes = coverage_changes(
+        numpy.array([ hit[2] for hit in hits ], 'int64'),
+        numpy.array([ hit[3]+1 for hit in hits ], 'int64'),
+        1.0 / n_hits[numpy.array(hit_reads, 'int64')] )
+
+    return best, changes
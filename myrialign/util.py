@@ -1,6 +1,8 @@
 
 import sys
 
+class Bad_option(Exception): pass
+
 def show_status(message):
     sys.stderr.write('\r\x1b[K\r')
     sys.stderr.write(message)
@@ -8,3 +10,37 @@ def show_status(message):
 
 def show_message(message):
     show_status(message+'\n')
+
+def get_option(argv, option):
+    argv = argv[:]
+    has_option = False
+    while True:
+        try:
+	    location = argv.index(option)
+	except ValueError: #Not found
+	    break
+        has_option = True
+	del argv[location]
+
+    return has_option, argv
+
+def get_option_value(argv, option, conversion_function, default):
+    argv = argv[:]
+    value = default
+    while True:
+        try:
+	    location = argv.index(option)
+	except ValueError: #Not found
+	    break
+	    
+	if location == len(argv)-1 :
+	    raise Bad_option('Option %s requires a paramter' % option)
+	
+	try:
+	    value = conversion_function(argv[location+1])
+	except Exception:
+	    raise Bad_option('Option for %s not in expected format' % option)
+	
+	del argv[location:location+2]
+
+    return value, argv
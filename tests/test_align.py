@@ -0,0 +1,186 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Tests of "myr align", run as a separate process.
+
+    Run with: python -m unittest discover tests
+
+"""
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA = os.path.join(ROOT, 'testdata')
+sys.path.insert(0, ROOT)
+
+from myrialign import shard
+
+def myr(*args, **kwargs):
+    """ Run myr, returning its exit code, standard output and standard error. """
+    process = subprocess.Popen([ sys.executable, os.path.join(ROOT, 'myr') ] + list(args),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+def write_reads(filename, n_reads):
+    """ Write the first n_reads of the test reads to a file. """
+    f = open(filename, 'wb')
+    f.write(''.join(open(os.path.join(TESTDATA, 'test_reads.fna'), 'rb').readlines()[:n_reads*2]))
+    f.close()
+
+class Test_resume(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reads = os.path.join(self.dir, 'reads.fna')
+        write_reads(self.reads, 200)
+        self.output = os.path.join(self.dir, 'out.myr')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def align(self, *options):
+        return myr('align', '-o', self.output, *(options + ('2', '1', os.path.join(TESTDATA, 'test.fna'), self.reads)))
+
+    def interrupt(self, n_batches):
+        """ Cut the journal back to the first n_batches batches, as if the run had been interrupted. """
+        journal = self.output + '.journal'
+        lines = open(journal, 'rb').readlines()
+        kept = [ ]
+        for line in lines:
+            if line.startswith('batch '):
+                if n_batches == 0: break
+                n_batches -= 1
+            kept.append(line)
+        self.assertTrue(len(kept) < len(lines))
+        f = open(journal, 'wb')
+        f.write(''.join(kept))
+        f.close()
+
+    def test_resume(self):
+        self.assertEqual(self.align('--max-memory', '0.05')[0], 0)
+        expected = open(self.output, 'rb').read()
+
+        self.interrupt(2)
+        self.assertEqual(self.align('--resume', '--max-memory', '0.05')[0], 0)
+        self.assertEqual(open(self.output, 'rb').read(), expected)
+
+    def test_resume_changed_budget(self):
+        self.assertEqual(self.align('--max-memory', '0.05')[0], 0)
+
+        self.interrupt(2)
+        for options in [ ('--resume',), ('--resume', '--max-memory', '0.1') ]:
+            code, stdout, stderr = self.align(*options)
+            self.assertEqual(code, 1)
+            self.assertTrue('different arguments' in stderr)
+
+class Test_summary(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reads = os.path.join(self.dir, 'reads.fna')
+        write_reads(self.reads, 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_summary(self, reference):
+        """ "myr align --summary" should match "myr assess" of all the reads. """
+        summary_filename = os.path.join(self.dir, 'summary.txt')
+        code, stdout, stderr = myr('align', '-o', os.path.join(self.dir, 'out.myr'), 
+                                   '--summary', summary_filename, '2', '1', reference, self.reads)
+        self.assertEqual(code, 0)
+
+        environment = dict(os.environ)
+        environment['HOME'] = self.dir # Keep the cache out of the way
+        code, stdout, stderr = myr('assess', '1000', '2', reference, self.reads, env=environment)
+        self.assertEqual(code, 0)
+
+        self.assertEqual(open(summary_filename, 'rb').read(), stdout.replace('Sampled', 'Aligned'))
+
+    def test_one_reference(self):
+        self.check_summary(os.path.join(TESTDATA, 'test.fna'))
+
+    def test_several_references(self):
+        name, seq = open(os.path.join(TESTDATA, 'test.fna'), 'rb').read().split('\n')[:2]
+        reference = os.path.join(self.dir, 'reference.fna')
+        f = open(reference, 'wb')
+        f.write('>A\n%s\n>B\n%s\n' % (seq, seq))
+        f.close()
+        self.check_summary(reference)
+
+class Test_shard(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reads = os.path.join(self.dir, 'reads.fna')
+        write_reads(self.reads, 300)
+        self.reference = os.path.join(TESTDATA, 'test.fna')
+        
+        # Add reads straddling the edges of the reference segments
+        seq = open(self.reference, 'rb').read().split('\n')[1]
+        f = open(self.reads, 'ab')
+        for edge in (len(seq)//3, len(seq)*2//3):
+            for start in xrange(edge-40, edge+8, 3):
+                read = seq[start:start+33]
+                print >> f, '>edge%d' % start
+                print >> f, read
+                print >> f, '>edge%d-mutated' % start
+                print >> f, read[:10] + 'ACGT'[('ACGT'.index(read[10])+1) % 4] + read[11:]
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def align(self, output, *options):
+        code, stdout, stderr = myr('align', '-o', output, *(options + ('2', '1', self.reference, self.reads)))
+        self.assertEqual(code, 0)
+        return output
+
+    def headers_and_hits(self, text):
+        lines = text.splitlines()
+        return ([ line for line in lines if line.startswith('#') ], 
+                sorted([ line for line in lines if not line.startswith('#') ]))
+
+    def test_merge(self):
+        """ Shards run as separate processes and merged should give the 
+            same hits as an unsharded run. """
+        expected = self.headers_and_hits(open(self.align(os.path.join(self.dir, 'all.myr')), 'rb').read())
+        self.assertTrue(expected[1])
+
+        for shard_by in [ 'reads', 'reference' ]:
+            outputs = [ self.align(os.path.join(self.dir, '%s%d.myr' % (shard_by, i)), 
+                                   '--shard', '%d/3' % i, '--shard-by', shard_by)
+                        for i in xrange(3) ]
+            code, stdout, stderr = myr('merge', *outputs)
+            self.assertEqual(code, 0)
+            self.assertEqual(self.headers_and_hits(stdout), expected)
+
+    def test_resolve_edge_hits(self):
+        """ Of hits of a read found by both segments at an edge, 
+            only those not dominated by another should be kept. """
+        hits = [ (('r1', 'fwd', 2, 100), 'a'),
+                 (('r1', 'fwd', 0, 101), 'b'), # dominates a
+                 (('r1', 'rev', 1, 100), 'c'), # different direction
+                 (('r2', 'fwd', 1, 100), 'd'),
+                 (('r2', 'fwd', 1, 103), 'e'), # too far from d to be dominated
+                 (('r2', 'fwd', 3, 104), 'f') ] # dominated by e
+        self.assertEqual(shard.resolve_edge_hits(hits), (['b', 'c', 'd', 'e'], 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#
+#    Copyright 2008 Paul Harrison
+#
+#    This file is part of Myrialign.
+#
+#    Myrialign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Myrialign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Myrialign.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+    Tests of the browser's screens, drawn on a fake curses screen.
+
+    Run with: python -m unittest discover tests
+
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA = os.path.join(ROOT, 'testdata')
+sys.path.insert(0, ROOT)
+
+from myrialign import output, cache
+
+class Fake_screen:
+    """ Enough of a curses window for Browser.show """
+
+    def __init__(self, maxy, maxx):
+        self.maxy = maxy
+        self.maxx = maxx
+        self.clear()
+
+    def getmaxyx(self):
+        return self.maxy, self.maxx
+
+    def clear(self):
+        self.lines = [ ' '*self.maxx ] * self.maxy
+
+    def addstr(self, y, x, string):
+        assert 0 <= x and x+len(string) <= self.maxx
+        self.lines[y] = self.lines[y][:x] + string + self.lines[y][x+len(string):]
+
+    def move(self, y, x):
+        self.cursor = (y, x)
+
+    def refresh(self):
+        pass
+
+class Test_show(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = cache.cache_dir
+        cache.cache_dir = self.dir
+        self.layout_margin = output.LAYOUT_MARGIN
+        self.bin_size = output.BROWSE_BIN_SIZE
+        self.keep_distance = output.BROWSE_KEEP_DISTANCE
+
+    def tearDown(self):
+        cache.cache_dir = self.cache_dir
+        output.LAYOUT_MARGIN = self.layout_margin
+        output.BROWSE_BIN_SIZE = self.bin_size
+        output.BROWSE_KEEP_DISTANCE = self.keep_distance
+        shutil.rmtree(self.dir)
+
+    def walk(self, browser, starts, steps, step_size=1, radius=60):
+        """ Screens seen walking the cursor right along the reference 
+            from each of starts. """
+        browser.screen = Fake_screen(50, 160)
+        reference = browser.name_to_sequence['Test']
+
+        result = [ ]
+        for start in starts:
+            for i in xrange(steps):
+                cursor = output.make_location(reference, True, start+i*step_size)
+                browser.show(cursor, radius)
+                result.append((start+i*step_size, browser.screen.lines[:], browser.screen.cursor))
+        return result
+
+    def screens(self, layout_margin, starts, steps, radius=60):
+        """ Screens seen walking the cursor right along the reference 
+            from each of starts, with the layout made layout_margin wider 
+            than the display radius. """
+        output.LAYOUT_MARGIN = layout_margin
+
+        browser = output.Browser()
+        browser.load_sequences(os.path.join(TESTDATA, 'test.fna'))
+        browser.load_sequences(os.path.join(TESTDATA, 'test_reads.fna'))
+        browser.open_myr_hits(os.path.join(TESTDATA, 'test.aligns'))
+        return self.walk(browser, starts, steps, radius=radius)
+
+    def test_layout_margin(self):
+        """ A layout wider than the display radius should not change what is shown. """
+        starts = [ 0, 500, 1000, 2000, 3000 ]
+        expected = self.screens(0, starts, 30)
+        for layout_margin in [ 5, 20 ]:
+            for item, expected_item in zip(self.screens(layout_margin, starts, 30), expected):
+                self.assertEqual(item, expected_item)
+
+    def test_unload_bins(self):
+        """ Hits loaded in bins near the cursor should show as if all were 
+            loaded, and unloading bins should free their alignments and reads. """
+        output.BROWSE_BIN_SIZE = 256
+        output.BROWSE_KEEP_DISTANCE = 512
+        starts = [ 0, 5000, 2000, 9000, 100 ]
+
+        browser = output.Browser()
+        browser.load_sequences(os.path.join(TESTDATA, 'test.fna'))
+        browser.load_myr_hits(os.path.join(TESTDATA, 'test.aligns'))
+        expected = self.walk(browser, starts, 20, 37)
+        n_alignments = browser.alignments.length
+
+        browser = output.Browser()
+        browser.load_sequences(os.path.join(TESTDATA, 'test.fna'))
+        browser.open_myr_hits(os.path.join(TESTDATA, 'test.aligns'))
+        # Pieces of a read split by gaps are ordered by when they were found, 
+        # which can depend on sequence ids, so compare lines in sorted order
+        def sorted_lines(screens):
+            return [ (pos, sorted(lines), cursor) for pos, lines, cursor in screens ]
+        self.assertEqual(sorted_lines(self.walk(browser, starts, 20, 37)), sorted_lines(expected))
+
+        # Only the bins near the last cursor position remain
+        loaded_alignments = sum([ end-first for first, end, reads in browser.bins.values() ])
+        self.assertEqual(browser.alignments.length, loaded_alignments)
+        self.assertTrue(browser.alignments.length < n_alignments // 4)
+        self.assertEqual(len(browser.name_to_sequence), 1 + len(browser.read_users))
+        self.assertEqual(browser.sequences.length - len(browser.free_sequences), len(browser.name_to_sequence))
+
+if __name__ == '__main__':
+    unittest.main()